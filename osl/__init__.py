@@ -31,6 +31,15 @@ from . import maxfilter  # noqa: F401, F403
 from . import report  # noqa: F401, F403
 from . import source_recon  # noqa: F401, F403
 
+
+def __getattr__(name):
+    # The benchmarks are only imported when they are used
+    if name == "benchmarks":
+        import importlib
+        return importlib.import_module(".benchmarks", __name__)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
 # --------------------------------------------------------
 osl_logger = logging.getLogger(__name__)
 osl_logger.debug('osl main init complete')
@@ -0,0 +1,8 @@
+#!/usr/bin/python
+
+from .utils import *  # noqa: F401, F403
+from .preprocessing import *  # noqa: F401, F403
+
+import logging
+osl_logger = logging.getLogger(__name__)
+osl_logger.debug('osl benchmarks init complete')
@@ -0,0 +1,72 @@
+"""Run the benchmark suite from the command line.
+
+Example
+-------
+python -m osl.benchmarks results.json --duration 600 --n_jobs 4
+python -m osl.benchmarks new.json --compare old.json
+"""
+
+import sys
+import argparse
+
+from ..utils import logger as osl_logger
+from .preprocessing import run_preprocessing_benchmarks
+from .utils import save_results, compare_results
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description="Benchmark OSL preprocessing.")
+    parser.add_argument("outfile", type=str, help="JSON file to save results to")
+    parser.add_argument(
+        "--duration", type=float, default=60, help="Duration of the data in seconds"
+    )
+    parser.add_argument(
+        "--sfreq", type=float, default=150, help="Sampling frequency in Hz"
+    )
+    parser.add_argument(
+        "--n_channels", type=int, default=306, help="Number of channels"
+    )
+    parser.add_argument(
+        "--configs",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Configs to run through run_proc_chain",
+    )
+    parser.add_argument(
+        "--n_files", type=int, default=4, help="Number of files for run_proc_batch"
+    )
+    parser.add_argument(
+        "--n_jobs", type=int, default=1, help="Number of jobs for run_proc_batch"
+    )
+    parser.add_argument(
+        "--n_repeats", type=int, default=1, help="Number of repeats per benchmark"
+    )
+    parser.add_argument(
+        "--compare", type=str, default=None, help="Reference results to compare to"
+    )
+
+    args = parser.parse_args(argv)
+
+    osl_logger.set_up(level="INFO", startup=False)
+
+    results = run_preprocessing_benchmarks(
+        duration=args.duration,
+        sfreq=args.sfreq,
+        n_channels=args.n_channels,
+        configs=args.configs,
+        n_files=args.n_files,
+        n_jobs=args.n_jobs,
+        n_repeats=args.n_repeats,
+    )
+    save_results(args.outfile, results)
+
+    if args.compare is not None:
+        compare_results(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Benchmarks for the preprocessing pipeline.
+
+"""
+
+import os
+import shutil
+import tempfile
+
+from ..preprocessing import run_proc_chain, run_proc_batch, load_config
+from ..preprocessing import osl_wrappers
+from .utils import simulate_dataset, measure, get_system_info
+
+# Housekeeping for logging
+import logging
+osl_logger = logging.getLogger(__name__)
+
+# Representative preprocessing configs
+CONFIGS = {
+    "filter": """
+        preproc:
+          - filter:       {l_freq: 1, h_freq: 45}
+          - notch_filter: {freqs: 50}
+    """,
+    "artefacts": """
+        preproc:
+          - filter:       {l_freq: 1, h_freq: 45}
+          - bad_channels: {picks: 'mag'}
+          - bad_channels: {picks: 'grad'}
+          - bad_segments: {segment_len: 500, picks: 'mag'}
+          - bad_segments: {segment_len: 500, picks: 'grad'}
+          - bad_segments: {segment_len: 500, picks: 'mag', mode: 'diff'}
+          - bad_segments: {segment_len: 500, picks: 'grad', mode: 'diff'}
+    """,
+    "resample": """
+        preproc:
+          - pick_types: {meg: true}
+          - filter:     {l_freq: 1, h_freq: 45}
+          - resample:   {sfreq: 100}
+    """,
+    "ica": """
+        preproc:
+          - filter:  {l_freq: 1, h_freq: 45}
+          - ica_raw: {picks: 'meg', n_components: 20}
+    """,
+}
+
+
+def benchmark_wrappers(raw, n_repeats=1):
+    """Benchmark the OSL artefact detection functions.
+
+    Parameters
+    ----------
+    raw : mne.Raw
+        Data to benchmark with. It is not modified.
+    n_repeats : int
+        Number of repeats.
+
+    Returns
+    -------
+    list of dict
+        Result for each benchmark.
+    """
+    benchmarks = {
+        "detect_badchannels": (osl_wrappers.detect_badchannels, {"picks": "grad"}),
+        "detect_badsegments": (
+            osl_wrappers.detect_badsegments,
+            {"picks": "grad", "segment_len": 500},
+        ),
+        "detect_badsegments_diff": (
+            osl_wrappers.detect_badsegments,
+            {"picks": "grad", "segment_len": 500, "mode": "diff"},
+        ),
+        "detect_badchannels_and_segments": (
+            osl_wrappers.detect_badchannels_and_segments,
+            {"picks": ["mag", "grad"], "segment_len": 500, "modes": [None, "diff"]},
+        ),
+    }
+
+    results = []
+    for name, (func, kwargs) in benchmarks.items():
+        osl_logger.info("Benchmarking {0}".format(name))
+        result = measure(
+            func, n_repeats=n_repeats, setup=lambda: (raw.copy(),), **kwargs
+        )
+        result["name"] = "wrappers.{0}".format(name)
+        results.append(result)
+    return results
+
+
+def benchmark_chain(raw, configs=None, n_repeats=1):
+    """Benchmark run_proc_chain with representative configs.
+
+    The data is saved to a fif file, so the benchmark includes importing the
+    data.
+
+    Parameters
+    ----------
+    raw : mne.Raw
+        Data to benchmark with.
+    configs : list of str
+        Names of configs in CONFIGS to run. If None, all configs except 'ica'
+        are run.
+    n_repeats : int
+        Number of repeats.
+
+    Returns
+    -------
+    list of dict
+        Result for each config.
+    """
+    if configs is None:
+        configs = [name for name in CONFIGS if name != "ica"]
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, "sub-000_raw.fif")
+        raw.save(fname, verbose=False)
+
+        results = []
+        for name in configs:
+            osl_logger.info("Benchmarking run_proc_chain with {0} config".format(name))
+            result = measure(
+                run_proc_chain,
+                load_config(CONFIGS[name]),
+                fname,
+                n_repeats=n_repeats,
+                check=bool,  # run_proc_chain returns {} if it fails
+                gen_report=False,
+                verbose="WARNING",
+            )
+            result["name"] = "run_proc_chain.{0}".format(name)
+            result["throughput"] = (
+                raw.n_times * raw.info["nchan"] / result["wall_time"]
+            )
+            results.append(result)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return results
+
+
+def benchmark_batch(raw, n_files=4, n_jobs=1, config_name="filter", n_repeats=1):
+    """Benchmark run_proc_batch on files saved to disk.
+
+    Parameters
+    ----------
+    raw : mne.Raw
+        Data to save as each file.
+    n_files : int
+        Number of files to process.
+    n_jobs : int
+        Number of parallel jobs, see run_proc_batch.
+    config_name : str
+        Name of config in CONFIGS to run.
+    n_repeats : int
+        Number of repeats.
+
+    Returns
+    -------
+    dict
+        Result. The throughput is the number of files processed per hour.
+        If n_jobs is not 1, the peak memory only includes the parent process.
+    """
+    osl_logger.info(
+        "Benchmarking run_proc_batch with {0} files and n_jobs={1}".format(
+            n_files, n_jobs
+        )
+    )
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(n_files):
+            fname = os.path.join(tmpdir, "sub-{0:03d}_raw.fif".format(i))
+            raw.save(fname, verbose=False)
+            files.append(fname)
+
+        config = load_config(CONFIGS[config_name])
+
+        def setup():
+            # Make sure each repeat reprocesses the files
+            shutil.rmtree(os.path.join(tmpdir, "output"), ignore_errors=True)
+            return config, files
+
+        result = measure(
+            run_proc_batch,
+            n_repeats=n_repeats,
+            setup=setup,
+            check=all,  # run_proc_batch returns a flag for each file
+            outdir=os.path.join(tmpdir, "output"),
+            gen_report=False,
+            n_jobs=n_jobs,
+            verbose="WARNING",
+        )
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    result["name"] = "run_proc_batch.{0}.n_jobs{1}".format(config_name, n_jobs)
+    result["throughput"] = n_files * 3600 / result["wall_time"]
+    return result
+
+
+def run_preprocessing_benchmarks(
+    duration=60,
+    sfreq=150,
+    n_channels=306,
+    configs=None,
+    n_files=4,
+    n_jobs=1,
+    n_repeats=1,
+):
+    """Run the preprocessing benchmark suite.
+
+    Parameters
+    ----------
+    duration : float
+        Duration of the simulated data in seconds.
+    sfreq : float
+        Sampling frequency of the simulated data in Hz.
+    n_channels : int
+        Number of channels in the simulated data.
+    configs : list of str
+        Configs to benchmark run_proc_chain with, see benchmark_chain.
+    n_files : int
+        Number of files to benchmark run_proc_batch with.
+    n_jobs : int
+        Number of parallel jobs for run_proc_batch.
+    n_repeats : int
+        Number of repeats for each benchmark.
+
+    Returns
+    -------
+    dict
+        System info, dataset parameters and a list of benchmark results.
+        Each benchmark contains the median wall time (seconds), peak memory
+        (MB) and, where relevant, throughput (channel samples per second for
+        run_proc_chain, files per hour for run_proc_batch).
+    """
+    dataset = {"duration": duration, "sfreq": sfreq, "n_channels": n_channels}
+    osl_logger.info("Simulating dataset: {0}".format(dataset))
+    raw = simulate_dataset(**dataset)
+
+    benchmarks = []
+    benchmarks += benchmark_wrappers(raw, n_repeats=n_repeats)
+    benchmarks += benchmark_chain(raw, configs=configs, n_repeats=n_repeats)
+    if n_files > 0:
+        benchmarks.append(
+            benchmark_batch(raw, n_files=n_files, n_jobs=n_jobs, n_repeats=n_repeats)
+        )
+
+    return {"system": get_system_info(), "dataset": dataset, "benchmarks": benchmarks}
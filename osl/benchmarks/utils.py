@@ -0,0 +1,204 @@
+"""Utility functions for benchmarking.
+
+"""
+
+import os
+import json
+import time
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from ..utils.cache import get_package_versions
+from ..utils.simulate import simulate_raw_from_template
+
+# Housekeeping for logging
+import logging
+osl_logger = logging.getLogger(__name__)
+
+
+def simulate_dataset(duration=60, sfreq=150, n_channels=306):
+    """Simulate a Raw object for benchmarking.
+
+    Parameters
+    ----------
+    duration : float
+        Duration in seconds.
+    sfreq : float
+        Sampling frequency in Hz. The template model was fitted at 150 Hz,
+        other sampling frequencies only change the sample count/timing.
+    n_channels : int
+        Number of channels. Channels are picked evenly from the 306 channel
+        template so magnetometers and gradiometers are kept.
+
+    Returns
+    -------
+    raw : mne.io.RawArray
+        Simulated data.
+    """
+    raw = simulate_raw_from_template(int(duration * sfreq), sfreq=sfreq)
+    if n_channels < raw.info["nchan"]:
+        picks = np.linspace(0, raw.info["nchan"] - 1, n_channels).astype(int)
+        raw.pick(picks)
+    return raw
+
+
+def measure(func, *args, n_repeats=1, setup=None, check=None, **kwargs):
+    """Measure the time and peak memory used by a function.
+
+    tracemalloc slows down code which allocates a lot of memory, so the
+    timed calls are run without it and the peak memory is measured in one
+    extra call.
+
+    Parameters
+    ----------
+    func : function
+        Function to benchmark.
+    *args
+        Positional arguments for func.
+    n_repeats : int
+        Number of times to call func for timing.
+    setup : function
+        Called before each call (not timed). It must return a tuple of
+        positional arguments for func, which replace args. This can be used
+        to pass a fresh copy of the data to each call.
+    check : function
+        Called with the output of func. If it returns False, a RuntimeError
+        is raised, e.g. because func returns a flag instead of raising an
+        error when it fails.
+    **kwargs
+        Keyword arguments for func.
+
+    Returns
+    -------
+    dict
+        Wall time for each repeat and its median in seconds, and the peak
+        memory allocated during a call in MB. Memory is tracked with
+        tracemalloc, which includes numpy arrays.
+    """
+
+    def call():
+        call_args = args if setup is None else setup()
+        start = time.perf_counter()
+        out = func(*call_args, **kwargs)
+        wall_time = time.perf_counter() - start
+        if check is not None and not check(out):
+            raise RuntimeError("{0} failed".format(getattr(func, "__name__", func)))
+        return wall_time
+
+    wall_times = [call() for _ in range(n_repeats)]
+
+    tracemalloc.start()
+    try:
+        call()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "wall_time": float(np.median(wall_times)),
+        "wall_times": wall_times,
+        "peak_memory_mb": peak_memory / 1e6,
+    }
+
+
+def get_system_info():
+    """Get info about the machine and code being benchmarked.
+
+    Returns
+    -------
+    dict
+        Info.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.realpath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "date": datetime.now().isoformat(),
+        "commit": commit,
+        "versions": get_package_versions(("osl", "mne", "numpy", "scipy")),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "n_cpus": os.cpu_count(),
+    }
+
+
+def save_results(fname, results):
+    """Save benchmark results to a JSON file.
+
+    Parameters
+    ----------
+    fname : str
+        Path to JSON file.
+    results : dict
+        Output of a benchmark suite.
+    """
+    with open(fname, "w") as f:
+        json.dump(results, f, indent=2, default=str)
+    osl_logger.info("Saved benchmark results to {0}".format(fname))
+
+
+def compare_results(reference, results, threshold=1.2):
+    """Compare benchmark results to a reference, e.g. from a previous commit.
+
+    Parameters
+    ----------
+    reference : str or dict
+        Reference results or path to a JSON file containing them.
+    results : str or dict
+        New results or path to a JSON file containing them.
+    threshold : float
+        Ratio of new to reference wall time or memory above which a
+        benchmark is flagged as a regression.
+
+    Returns
+    -------
+    list of dict
+        Wall time and memory ratio for each benchmark in both results.
+        'regression' is True if either ratio exceeds the threshold.
+    """
+    if isinstance(reference, str):
+        with open(reference, "r") as f:
+            reference = json.load(f)
+    if isinstance(results, str):
+        with open(results, "r") as f:
+            results = json.load(f)
+
+    reference = {r["name"]: r for r in reference["benchmarks"]}
+
+    comparison = []
+    for new in results["benchmarks"]:
+        if new["name"] not in reference:
+            continue
+        old = reference[new["name"]]
+        time_ratio = new["wall_time"] / old["wall_time"]
+        memory_ratio = new["peak_memory_mb"] / max(old["peak_memory_mb"], 1e-6)
+        comparison.append(
+            {
+                "name": new["name"],
+                "time_ratio": time_ratio,
+                "memory_ratio": memory_ratio,
+                "regression": time_ratio > threshold or memory_ratio > threshold,
+            }
+        )
+        osl_logger.info(
+            "{0} : time x{1:.2f}, memory x{2:.2f}{3}".format(
+                new["name"],
+                time_ratio,
+                memory_ratio,
+                " - REGRESSION" if comparison[-1]["regression"] else "",
+            )
+        )
+
+    return comparison
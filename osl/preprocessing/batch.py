@@ -15,12 +15,16 @@ import sys
 import pprint
 import traceback
 import re
+import shutil
+import tempfile
+import inspect
 import logging
 from pathlib import Path
 from copy import deepcopy
 from functools import partial, wraps
 from time import localtime, strftime
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 import mne
 import numpy as np
@@ -29,7 +33,20 @@ import yaml
 from . import mne_wrappers, osl_wrappers
 from ..utils import find_run_id, validate_outdir, process_file_inputs
 from ..utils import logger as osl_logger
-from ..utils.parallel import dask_parallel_bag
+from ..utils.cache import (
+    hash_file,
+    hash_object,
+    get_package_versions,
+    read_manifest,
+    write_manifest,
+)
+from ..utils.parallel import dask_parallel_bag, process_parallel
+from ..utils.profiling import (
+    Profiler,
+    aggregate_profiles,
+    read_profile,
+    write_profile_csv,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -134,6 +151,90 @@ def import_data(infile, preload=True):
     return raw
 
 
+# --------------------------------------------------------------
+# Deferred loading
+
+# Stages which only change metadata or select a subset of the data, so can be
+# applied before the data is loaded into memory
+LAZY_STAGES = [
+    "crop",
+    "drop_channels",
+    "pick",
+    "pick_channels",
+    "pick_types",
+    "rename_channels",
+    "set_channel_types",
+]
+
+
+def plan_preload(config, extra_funcs=None):
+    """Find the first stage in a config which needs the data in memory.
+
+    Stages in LAZY_STAGES that act on the Raw object can be applied before the
+    data is loaded, i.e. channel picks and crops are applied at read time.
+
+    Parameters
+    ----------
+    config : dict
+        Preprocessing config.
+    extra_funcs : list
+        User-defined functions.
+
+    Returns
+    -------
+    int
+        Index of the first stage which needs the data to be loaded. This is
+        the number of stages if no stage needs the data.
+    """
+    custom_names = [func.__name__ for func in extra_funcs or []]
+    for ind, stage in enumerate(config["preproc"]):
+        method, userargs = next(iter(stage.items()))
+        if (
+            method not in LAZY_STAGES
+            or method in custom_names
+            or (userargs or {}).get("target", "raw") != "raw"
+        ):
+            return ind
+    return len(config["preproc"])
+
+
+def load_raw(raw, memmap_dir=None):
+    """Load data into a Raw object if it hasn't been already.
+
+    Parameters
+    ----------
+    raw : mne.Raw
+        Raw object.
+    memmap_dir : str
+        Directory to create a memory-mapped file for the data in. If None,
+        the data is loaded into memory.
+
+    Returns
+    -------
+    raw : mne.Raw
+        Raw object with data loaded.
+    """
+    if raw.preload:
+        return raw
+
+    if memmap_dir is None:
+        logger.info("Loading data into memory")
+        return raw.load_data()
+
+    fd, memmap_file = tempfile.mkstemp(suffix="_raw.dat", dir=memmap_dir)
+    os.close(fd)
+    logger.info("Loading data into memory-mapped file: {0}".format(memmap_file))
+    # Private MNE method (checked against MNE 1.0.3) which reads the data into
+    # a numpy.memmap backed by memmap_file when given a filename
+    raw._preload_data(memmap_file)
+    try:
+        # The data stays accessible until the memory map is closed
+        os.remove(memmap_file)
+    except OSError:
+        pass
+    return raw
+
+
 # --------------------------------------------------------------
 # Batch processing utilities
 
@@ -530,6 +631,266 @@ def plot_preproc_flowchart(
     return fig, ax
 
 
+# --------------------------------------------------------------
+# Checkpointing and caching
+
+
+def hash_extra_funcs(extra_funcs):
+    """Hash the source code of user-defined functions.
+
+    Parameters
+    ----------
+    extra_funcs : list
+        User-defined functions.
+
+    Returns
+    -------
+    str
+        Hash, which changes if any of the functions are edited.
+    """
+    func_sources = {}
+    for func in extra_funcs or []:
+        try:
+            func_sources[func.__name__] = inspect.getsource(func)
+        except (OSError, TypeError):
+            func_sources[func.__name__] = None
+    return hash_object(func_sources)
+
+
+def get_checkpoint_key(infile, config, stage_index, extra_funcs=None):
+    """Get the key identifying a checkpoint.
+
+    The key depends on the input file, user-defined functions and the config
+    up to and including the stage the checkpoint is saved after, so editing a
+    later stage doesn't invalidate checkpoints for earlier stages.
+
+    Parameters
+    ----------
+    infile : str
+        Path to the input file.
+    config : dict
+        Preprocessing config.
+    stage_index : int
+        Index of the stage in config["preproc"] the checkpoint is saved after.
+    extra_funcs : list
+        User-defined functions.
+
+    Returns
+    -------
+    str
+        Checkpoint key.
+    """
+    return hash_object(
+        [
+            hash_file(infile),
+            hash_extra_funcs(extra_funcs),
+            config["meta"],
+            config["preproc"][: stage_index + 1],
+        ]
+    )
+
+
+def get_checkpoint_dir(checkpoint_dir, infile):
+    """Get the directory checkpoints for an input file are saved to.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        Directory containing checkpoints for all files.
+    infile : str
+        Path to the input file.
+
+    Returns
+    -------
+    pathlib.Path
+        Subdirectory of checkpoint_dir for infile.
+    """
+    infile = os.path.abspath(infile)
+    name = os.path.basename(infile).split(".")[0]
+    return Path(checkpoint_dir) / "{0}_{1}".format(name, hash_object(infile)[:16])
+
+
+def remove_checkpoints(checkpoint_dir, keep=None):
+    """Remove checkpoints.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        Directory containing checkpoints, e.g. from get_checkpoint_dir.
+    keep : str
+        Key of a checkpoint to keep. If None, all checkpoints and
+        checkpoint_dir are removed.
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    if not checkpoint_dir.exists():
+        return
+    if keep is None:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        return
+    for ckdir in checkpoint_dir.iterdir():
+        if ckdir.name != keep:
+            shutil.rmtree(ckdir, ignore_errors=True)
+
+
+def save_checkpoint(dataset, checkpoint_dir, key):
+    """Save a dataset to a checkpoint.
+
+    Parameters
+    ----------
+    dataset : dict
+        Dataset dict containing the partially preprocessed data.
+    checkpoint_dir : str
+        Directory to save checkpoints to.
+    key : str
+        Checkpoint key, see get_checkpoint_key.
+
+    Returns
+    -------
+    bool
+        Was the checkpoint saved? We can only checkpoint raw, events, event_id,
+        epochs and ica.
+    """
+    extra_keys = set(dataset) - {"raw", "events", "event_id", "epochs", "ica"}
+    if len(extra_keys) > 0:
+        logger.info("Can't checkpoint dataset containing {0}".format(extra_keys))
+        return False
+
+    # Write to a temporary directory and rename once complete so that we
+    # never leave behind a partially written checkpoint
+    ckdir = Path(checkpoint_dir) / key
+    tmpdir = Path(checkpoint_dir) / (key + ".tmp")
+    if tmpdir.exists():
+        shutil.rmtree(tmpdir)
+    tmpdir.mkdir()
+
+    # Save the data in double precision so resuming gives the same result
+    dataset["raw"].save(tmpdir / "checkpoint_raw.fif", fmt="double", verbose=False)
+    if dataset["events"] is not None:
+        np.save(tmpdir / "checkpoint_events.npy", dataset["events"])
+    if dataset["event_id"] is not None:
+        with open(tmpdir / "checkpoint_event-id.yml", "w") as f:
+            yaml.dump(dataset["event_id"], f)
+    if dataset["epochs"] is not None:
+        dataset["epochs"].save(tmpdir / "checkpoint_epo.fif", fmt="double", verbose=False)
+    if dataset["ica"] is not None:
+        dataset["ica"].save(tmpdir / "checkpoint_ica.fif", verbose=False)
+
+    if ckdir.exists():
+        shutil.rmtree(ckdir)
+    os.rename(tmpdir, ckdir)
+
+    return True
+
+
+def load_checkpoint(checkpoint_dir, key):
+    """Load a dataset from a checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        Directory containing checkpoints.
+    key : str
+        Checkpoint key, see get_checkpoint_key.
+
+    Returns
+    -------
+    dict or None
+        Dataset dict. None is returned if the checkpoint doesn't exist.
+    """
+    ckdir = Path(checkpoint_dir) / key
+    if not (ckdir / "checkpoint_raw.fif").exists():
+        return None
+
+    dataset = {
+        "raw": mne.io.read_raw_fif(ckdir / "checkpoint_raw.fif", preload=True),
+        "events": None,
+        "event_id": None,
+        "epochs": None,
+        "ica": None,
+    }
+    if (ckdir / "checkpoint_events.npy").exists():
+        dataset["events"] = np.load(ckdir / "checkpoint_events.npy")
+    if (ckdir / "checkpoint_event-id.yml").exists():
+        with open(ckdir / "checkpoint_event-id.yml", "r") as f:
+            dataset["event_id"] = yaml.safe_load(f)
+    if (ckdir / "checkpoint_epo.fif").exists():
+        dataset["epochs"] = mne.read_epochs(ckdir / "checkpoint_epo.fif")
+    if (ckdir / "checkpoint_ica.fif").exists():
+        dataset["ica"] = mne.preprocessing.read_ica(ckdir / "checkpoint_ica.fif")
+
+    return dataset
+
+
+def find_checkpoint(infile, config, checkpoint_dir, extra_funcs=None):
+    """Find the checkpoint for the latest stage in a config.
+
+    Parameters
+    ----------
+    infile : str
+        Path to the input file.
+    config : dict
+        Preprocessing config.
+    checkpoint_dir : str
+        Directory containing checkpoints.
+    extra_funcs : list
+        User-defined functions.
+
+    Returns
+    -------
+    dataset : dict or None
+        Dataset dict loaded from the checkpoint. None if no checkpoint was found.
+    start : int
+        Index of the first stage in config["preproc"] which still needs running.
+    """
+    for ind in range(len(config["preproc"]) - 1, -1, -1):
+        key = get_checkpoint_key(infile, config, ind, extra_funcs)
+        try:
+            dataset = load_checkpoint(checkpoint_dir, key)
+        except Exception as e:
+            logger.warning("Unable to load checkpoint {0}: {1}".format(key, e))
+            continue
+        if dataset is not None:
+            method = next(iter(config["preproc"][ind]))
+            logger.info(
+                "Resuming from checkpoint after stage {0} ({1})".format(ind, method)
+            )
+            return dataset, ind + 1
+
+    return None, 0
+
+
+def get_cache_manifest(infile, config, extra_funcs=None):
+    """Get a manifest describing how a preprocessed file was created.
+
+    If the manifest saved with an existing output matches the manifest for a
+    new run, the output doesn't need to be recomputed.
+
+    Parameters
+    ----------
+    infile : str
+        Path to the input file.
+    config : dict
+        Preprocessing config.
+    extra_funcs : list
+        User-defined functions.
+
+    Returns
+    -------
+    dict
+        Manifest.
+    """
+    return {
+        "infile": os.path.abspath(infile),
+        "infile_hash": hash_file(infile),
+        "config_hash": hash_object(
+            {"meta": config["meta"], "preproc": config["preproc"]}
+        ),
+        # Editing custom functions invalidates the cache
+        "extra_funcs_hash": hash_extra_funcs(extra_funcs),
+        "versions": get_package_versions(),
+    }
+
+
 # --------------------------------------------------------------
 # Batch processing
 
@@ -547,6 +908,11 @@ def run_proc_chain(
     extra_funcs=None,
     verbose="INFO",
     mneverbose="WARNING",
+    checkpoint_dir=None,
+    checkpoint_stages=None,
+    keep_checkpoints=False,
+    memmap_dir=None,
+    ret_profile=False,
 ):
     """Run preprocessing for a single file.
 
@@ -569,7 +935,9 @@ def run_proc_chain(
     gen_report : bool
         Should we generate a report?
     overwrite : bool
-        Should we overwrite the output file if it already exists?
+        Should we overwrite the output file if it already exists? If False,
+        existing outputs are only recomputed if the input file, config or
+        package versions have changed since they were created.
     extra_funcs : list
         User-defined functions.
     verbose : str
@@ -578,6 +946,25 @@ def run_proc_chain(
     mneverbose : str
         Level of info from MNE to print.
         Can be: CRITICAL, ERROR, WARNING, INFO, DEBUG or NOTSET.
+    checkpoint_dir : str
+        Directory to save checkpoints to. If passed, the dataset is saved after
+        each stage in checkpoint_stages and a rerun resumes from the latest
+        checkpoint which matches the input file, config and extra_funcs. If
+        None, no checkpoints are saved.
+    checkpoint_stages : list of str
+        Names of the stages to save a checkpoint after. If None, a checkpoint
+        is saved after every stage. Each checkpoint contains the full data in
+        double precision, so it's worth only passing slow stages.
+    keep_checkpoints : bool
+        Should we keep all checkpoints? If False, only the latest checkpoint
+        for the input file is kept and it is removed once preprocessing
+        succeeds. If True, the checkpoints are kept so a rerun after editing
+        a later stage can resume from them.
+    memmap_dir : str
+        Directory to create a memory-mapped file for the data in. If None, the
+        data is loaded into memory.
+    ret_profile : bool
+        Should we also return the time and resources used by each stage?
 
     Returns
     -------
@@ -586,6 +973,15 @@ def run_proc_chain(
         following keys: raw, ica, epochs, events, event_id. An empty dict is returned
         if preprocessing fail. If return an empty dict. if ret_dataset=False, we
         return a flag indicating whether preprocessing was successful.
+    profile : list of dict
+        Only returned if ret_profile=True. Profile of this run, see
+        osl.utils.profiling.Profiler. None if preprocessing was skipped
+        because an output exists (including up to date outputs, whose
+        profile from the run which created them is kept in logsdir).
+    Notes
+    -----
+    The data is not loaded until the first stage that needs it, so initial
+    stages such as pick_types or crop reduce the amount of data read.
     """
     if not ret_dataset:
         # Let's make sure we have an output directory
@@ -635,8 +1031,12 @@ def run_proc_chain(
             run_id=run_id.replace("_raw", ""), ftype="preproc_raw", fext="log"
         )
         mne.utils._logging.set_log_file(logfile, overwrite=overwrite)
+        profilebase = os.path.join(
+            logsdir, "{0}_preproc_profile".format(run_id.replace("_raw", ""))
+        )
     else:
         logfile = None
+        profilebase = None
 
     # Finish setting up loggers
     osl_logger.set_up(prefix=run_id, log_file=logfile, level=verbose, startup=False)
@@ -646,50 +1046,118 @@ def run_proc_chain(
     logger.info("{0} : Starting OSL Processing".format(now))
     logger.info("input : {0}".format(infile))
 
+    # Load config
+    if not isinstance(config, dict):
+        config = load_config(config)
+
+    # Record the time and resources used by each stage
+    profiler = Profiler()
+
     # Write preprocessed data to output directory
+    manifest = None
     if outdir is not None:
         # Check for existing outputs - should be a .fif at least
         fifout = outbase.format(
             run_id=run_id.replace('_raw', ''), ftype='preproc_raw', fext='fif'
         )
+        cachefile = outbase.format(
+            run_id=run_id.replace('_raw', ''), ftype='cache', fext='json'
+        )
+        if isinstance(infile, str) and os.path.exists(infile):
+            manifest = get_cache_manifest(infile, config, extra_funcs)
         if os.path.exists(fifout) and (overwrite is False):
-            logger.critical('Skipping preprocessing - existing output detected')
-            return False
-
-    # Load config
-    if not isinstance(config, dict):
-        config = load_config(config)
+            existing_manifest = read_manifest(cachefile)
+            if existing_manifest is None or manifest is None:
+                logger.critical('Skipping preprocessing - existing output detected')
+                return (False, None) if ret_profile else False
+            elif existing_manifest == manifest:
+                # The profile and report data of the run which created the
+                # output are kept
+                logger.info('Skipping preprocessing - existing output is up to date')
+                out = read_dataset(fifout) if ret_dataset else True
+                return (out, None) if ret_profile else out
+            else:
+                logger.info('Input or config has changed - reprocessing')
+                overwrite = True
+
+    # We can only checkpoint data we can reload from a file
+    if checkpoint_dir is not None and not isinstance(infile, str):
+        logger.warning("Checkpointing is only available for file inputs")
+        checkpoint_dir = None
+    if checkpoint_dir is not None:
+        checkpoint_dir = get_checkpoint_dir(validate_outdir(checkpoint_dir), infile)
+        checkpoint_dir.mkdir(exist_ok=True)
+    if memmap_dir is not None:
+        memmap_dir = validate_outdir(memmap_dir)
 
     # MAIN BLOCK - Run the preproc chain and catch any exceptions
     try:
-        if isinstance(infile, str):
-            raw = import_data(infile)
-        elif isinstance(infile, mne.io.fiff.raw.Raw):
-            raw = infile
-            infile = raw.filenames[0]  # assuming only one file here
-
-        # Create a dataset dict to hold the preprocessed dataset
-        dataset = {
-            "raw": raw,
-            "events": None,
-            "epochs": None,
-            "event_id": config["meta"]["event_codes"],
-            "ica": None,
-        }
+        # Look for a checkpoint to resume from
+        dataset, start = None, 0
+        if checkpoint_dir is not None:
+            dataset, start = find_checkpoint(
+                infile, config, checkpoint_dir, extra_funcs
+            )
+
+        # Find when we need to load the data
+        load_stage = plan_preload(config, extra_funcs)
+
+        if dataset is None:
+            if isinstance(infile, str):
+                lazy = load_stage > 0 or memmap_dir is not None
+                with profiler.stage("import_data"):
+                    raw = import_data(infile, preload=not lazy)
+            elif isinstance(infile, mne.io.fiff.raw.Raw):
+                raw = infile
+                infile = raw.filenames[0]  # assuming only one file here
+
+            # Create a dataset dict to hold the preprocessed dataset
+            dataset = {
+                "raw": raw,
+                "events": None,
+                "epochs": None,
+                "event_id": config["meta"]["event_codes"],
+                "ica": None,
+            }
 
         # Do the preprocessing
-        for stage in deepcopy(config["preproc"]):
+        stages = deepcopy(config["preproc"])
+        for ind, stage in enumerate(stages[start:], start=start):
             method, userargs = next(iter(stage.items()))
             target = userargs.get("target", "raw")  # Raw is default
             func = find_func(method, target=target, extra_funcs=extra_funcs)
-            # Actual function call
-            dataset = func(dataset, userargs)
+            with profiler.stage(method, index=ind):
+                if ind >= load_stage:
+                    dataset["raw"] = load_raw(dataset["raw"], memmap_dir)
+                # Actual function call
+                dataset = func(dataset, userargs)
+
+            # Save a checkpoint
+            if checkpoint_dir is not None and (
+                checkpoint_stages is None or method in checkpoint_stages
+            ):
+                key = get_checkpoint_key(infile, config, ind, extra_funcs)
+                if save_checkpoint(dataset, checkpoint_dir, key):
+                    logger.info("Saved checkpoint after stage {0}".format(ind))
+                    if not keep_checkpoints:
+                        remove_checkpoints(checkpoint_dir, keep=key)
+
+        # Make sure the data is loaded if no stage needed it
+        if not dataset["raw"].preload:
+            with profiler.stage("load_data"):
+                dataset["raw"] = load_raw(dataset["raw"], memmap_dir)
 
         # Add preprocessing info to dataset dict
         dataset = append_preproc_info(dataset, config)
 
         if outdir is not None:
-            write_dataset(dataset, outbase, run_id, overwrite=overwrite)
+            with profiler.stage("write_dataset"):
+                write_dataset(dataset, outbase, run_id, overwrite=overwrite)
+            if manifest is not None:
+                write_manifest(cachefile, manifest)
+
+        if checkpoint_dir is not None and not keep_checkpoints:
+            remove_checkpoints(checkpoint_dir)
 
     except Exception as e:
         # Preprocessing failed
@@ -716,13 +1184,17 @@ def run_proc_chain(
             f.write("\n")
             traceback.print_tb(ex_traceback, file=f)
 
+        if profilebase is not None:
+            profiler.save(profilebase)
+
         if ret_dataset:
             # We return an empty dict to indicate preproc failed
             # This ensures the function consistently returns one
             # variable type
-            return {}
+            out = {}
         else:
-            return False
+            out = False
+        return (out, profiler.stages) if ret_profile else out
 
     now = strftime("%Y-%m-%d %H:%M:%S", localtime())
     logger.info("{0} : Processing Complete".format(now))
@@ -732,14 +1204,31 @@ def run_proc_chain(
         from ..report import gen_html_data  # avoids circular import
         logger.info("{0} : Generating Report".format(now))
         reportdir = validate_outdir(reportdir / run_id)
-        gen_html_data(
-            dataset["raw"], reportdir, ica=dataset["ica"], logger=logger
-        )
+        with profiler.stage("gen_report"):
+            gen_html_data(
+                dataset["raw"],
+                reportdir,
+                # Data resumed from a checkpoint was read from the checkpoint
+                filename=os.path.abspath(infile) if start > 0 else None,
+                ica=dataset["ica"],
+                logger=logger,
+                profile=profiler.stages,
+            )
 
-    if ret_dataset:
-        return dataset
-    else:
-        return True
+    # Save the profile
+    if profilebase is not None:
+        profiler.save(profilebase)
+
+    out = dataset if ret_dataset else True
+    return (out, profiler.stages) if ret_profile else out
+
+
+def _unpack_result(result):
+    # Get the flag and profile from the output of run_proc_chain with
+    # ret_profile=True, result is False if the job failed or timed out
+    if isinstance(result, tuple):
+        return result
+    return result, None
 
 
 def run_proc_batch(
@@ -755,6 +1244,14 @@ def run_proc_batch(
     mneverbose="WARNING",
     strictrun=False,
     dask_client=False,
+    n_jobs=1,
+    timeout=None,
+    checkpoint_dir=None,
+    checkpoint_stages=None,
+    keep_checkpoints=False,
+    memmap_dir=None,
+    async_report=False,
+    report_n_jobs=1,
 ):
     """Run batched preprocessing.
 
@@ -777,7 +1274,10 @@ def run_proc_batch(
     gen_report : bool
         Should we generate a report?
     overwrite : bool
-        Should we overwrite the output file if it exists?
+        Should we overwrite the output file if it exists? If False, only
+        files whose input or config has changed are reprocessed. The profile
+        and report data of files which are up to date are kept from the run
+        which created them (with or without async_report).
     extra_funcs : list
         User-defined functions.
     verbose : str
@@ -791,6 +1291,28 @@ def run_proc_batch(
     dask_client : bool
         Indicate whether to use a previously initialised dask.distributed.Client
         instance.
+    n_jobs : int
+        Number of files to process in parallel using a local pool of processes.
+        Only used if dask_client=False. -1 uses all available CPUs.
+    timeout : float
+        Maximum time in seconds to spend on a single file. Files which take
+        longer are marked as failed. Only used if n_jobs is not 1.
+    checkpoint_dir : str
+        Directory to save checkpoints to, see run_proc_chain.
+    checkpoint_stages : list of str
+        Names of the stages to save a checkpoint after, see run_proc_chain.
+    keep_checkpoints : bool
+        Should we keep all checkpoints? See run_proc_chain.
+    memmap_dir : str
+        Directory to create memory-mapped files for the data in, see
+        run_proc_chain.
+    async_report : bool
+        Should we generate the report in a separate pool of processes? If
+        True, report data is generated from the saved fif file as soon as
+        each file has been preprocessed, so preprocessing doesn't wait for
+        the figures to be rendered.
+    report_n_jobs : int
+        Number of processes to generate reports with if async_report=True.
 
     Returns
     -------
@@ -804,6 +1326,8 @@ def run_proc_batch(
     outdir = validate_outdir(outdir)
     logsdir = validate_outdir(logsdir or outdir / "logs")
     reportdir = validate_outdir(reportdir or outdir / "report")
+    if checkpoint_dir is not None:
+        checkpoint_dir = validate_outdir(checkpoint_dir)
 
     # Initialise Loggers
     mne.set_log_level(mneverbose)
@@ -847,9 +1371,16 @@ def run_proc_batch(
         run_proc_chain,
         outdir=outdir,
         logsdir=logsdir,
+        reportdir=reportdir,
+        gen_report=gen_report and not async_report,
         ret_dataset=False,
         overwrite=overwrite,
         extra_funcs=extra_funcs,
+        checkpoint_dir=checkpoint_dir,
+        checkpoint_stages=checkpoint_stages,
+        keep_checkpoints=keep_checkpoints,
+        memmap_dir=memmap_dir,
+        ret_profile=True,
     )
 
     # Loop through input files to generate arguments for run_proc_chain
@@ -857,25 +1388,96 @@ def run_proc_batch(
     for infile, outname in zip(infiles, outnames):
         args.append((config, infile, outname))
 
-    # Actually run the processes
-    if dask_client:
-        proc_flags = dask_parallel_bag(pool_func, args)
+    # Queue report jobs as files finish preprocessing
+    report_jobs = []
+    report_pool = None
+    if gen_report and async_report:
+        from ..report import raw_report  # avoids circular import
+        report_pool = ProcessPoolExecutor(max_workers=report_n_jobs)
+
+        def submit_report(ind, result):
+            flag, profile = _unpack_result(result)
+            if not flag or profile is None:
+                # Failed or up to date, the report data of the run which
+                # created an up to date output is kept
+                return
+            run_id = os.path.splitext(outnames[ind])[0]
+            fifout = os.path.join(
+                outdir, "{0}_preproc_raw.fif".format(run_id.replace("_raw", ""))
+            )
+            report_jobs.append(
+                report_pool.submit(
+                    raw_report.gen_html_data_from_fif,
+                    fifout,
+                    reportdir,
+                    run_id=run_id,
+                    profile=profile,
+                )
+            )
     else:
-        proc_flags = [pool_func(*aa) for aa in args]
+        submit_report = None
 
-    logger.info(
-        "Processed {0}/{1} files successfully".format(
-            np.sum(proc_flags), len(proc_flags)
+    try:
+        # Actually run the processes
+        if dask_client:
+            results = dask_parallel_bag(pool_func, args, callback=submit_report)
+        elif n_jobs != 1:
+            results = process_parallel(
+                pool_func, args, n_jobs=n_jobs, timeout=timeout, callback=submit_report
+            )
+        else:
+            results = []
+            for ind, aa in enumerate(args):
+                results.append(pool_func(*aa))
+                if submit_report is not None:
+                    submit_report(ind, results[-1])
+        proc_flags, profiles = [], []
+        for outname, result in zip(outnames, results):
+            flag, profile = _unpack_result(result)
+            if flag and profile is None:
+                # Output was up to date, use the profile of the run which
+                # created it
+                run_id = os.path.splitext(outname)[0].replace("_raw", "")
+                profile = read_profile(
+                    os.path.join(logsdir, "{0}_preproc_profile.json".format(run_id))
+                )
+            proc_flags.append(flag)
+            profiles.append(profile)
+
+        logger.info(
+            "Processed {0}/{1} files successfully".format(
+                np.sum(proc_flags), len(proc_flags)
+            )
         )
-    )
 
-    # Generate a report
-    if gen_report and len(infiles) > 0:
-        from ..report import raw_report # avoids circular import
-        if raw_report.gen_html_page(reportdir):
-            logger.info("******************************" + "*" * len(str(reportdir)))
-            logger.info(f"* REMEMBER TO CHECK REPORT: {reportdir} *")
-            logger.info("******************************" + "*" * len(str(reportdir)))
+        # Summarise the time and resources used by each stage in this batch
+        profiles = [profile for profile in profiles if profile]
+        if len(profiles) > 0:
+            summary = aggregate_profiles(profiles)
+            write_profile_csv(
+                os.path.join(logsdir, "batch_profile.csv"), summary, list(summary[0])
+            )
+            logger.info("Slowest stages (total wall time in seconds):")
+            for stage in summary[:5]:
+                logger.info(
+                    "{0} : {1:.1f} (p50={2:.1f}, p95={3:.1f})".format(
+                        stage["stage"],
+                        stage["wall_time_total"],
+                        stage["wall_time_p50"],
+                        stage["wall_time_p95"],
+                    )
+                )
+
+        # Generate a report
+        if gen_report and len(infiles) > 0:
+            from ..report import raw_report # avoids circular import
+            if raw_report.gen_html_page(reportdir, jobs=report_jobs, logger=logger):
+                logger.info("******************************" + "*" * len(str(reportdir)))
+                logger.info(f"* REMEMBER TO CHECK REPORT: {reportdir} *")
+                logger.info("******************************" + "*" * len(str(reportdir)))
+    finally:
+        if report_pool is not None:
+            report_pool.shutdown()
 
     # Return flags
     return proc_flags
@@ -925,6 +1527,18 @@ def main(argv=None):
         default="WARNING",
         help="Set the logging level for MNE functions",
     )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=1,
+        help="Number of files to process in parallel (-1 uses all CPUs)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Maximum time in seconds to spend on a single file",
+    )
 
     parser.usage = parser.format_help()
     args = parser.parse_args(argv)
@@ -19,16 +19,23 @@ logger = logging.getLogger(__name__)
 #
 
 
-def detect_badsegments(raw, segment_len=1000, picks="grad", mode=None):
-    """Set bad segments in MNE object."""
-    if mode is None:
-        XX = raw.get_data(picks=picks)
-    elif mode == "diff":
-        XX = np.diff(raw.get_data(picks=picks), axis=1)
+def _annotate_badsegments(raw, bad_segments, segment_len, n_samples, picks):
+    """Add annotations for bad segments to an MNE object.
 
-    bdinds = sails.utils.detect_artefacts(
-        XX, 1, reject_mode="segments", segment_len=segment_len, ret_mode="bad_inds"
-    )
+    Parameters
+    ----------
+    raw : mne.Raw
+        MNE Raw object.
+    bad_segments : np.ndarray
+        Boolean flag for each segment indicating if it's bad.
+    segment_len : int
+        Number of samples in each segment.
+    n_samples : int
+        Number of samples in the time series the segments were taken from.
+    picks : str
+        Modality the bad segments were found in.
+    """
+    bdinds = np.repeat(bad_segments, segment_len)[:n_samples]
 
     onsets = np.where(np.diff(bdinds.astype(float)) == 1)[0]
     if bdinds[0]:
@@ -51,7 +58,84 @@ def detect_badsegments(raw, segment_len=1000, picks="grad", mode=None):
     full_dur = raw.n_times / raw.info["sfreq"]
     pc = (mod_dur / full_dur) * 100
     s = "Modality {0} - {1:02f}/{2} seconds rejected     ({3:02f}%)"
-    logger.info(s.format("picks", mod_dur, full_dur, pc))
+    logger.info(s.format(picks, mod_dur, full_dur, pc))
+
+
+def _get_segment_metric(XX, segment_len):
+    """Standard deviation of each segment of a (channels, samples) array.
+
+    Parameters
+    ----------
+    XX : np.ndarray
+        Data with shape (channels, samples).
+    segment_len : int
+        Number of samples in each segment. If the number of samples is not a
+        multiple of segment_len, the last segment contains the samples left over.
+
+    Returns
+    -------
+    metric : np.ndarray
+        Standard deviation of each segment.
+    """
+    n_channels, n_samples = XX.shape
+    n_full = n_samples // segment_len
+    full = XX[:, : n_full * segment_len].reshape(n_channels, n_full, segment_len)
+    metric = np.std(full, axis=(0, 2))
+    if n_samples % segment_len:
+        metric = np.r_[metric, np.std(XX[:, n_full * segment_len :])]
+    return metric
+
+
+def detect_badsegments(raw, segment_len=1000, picks="grad", mode=None, max_block_size=2**22):
+    """Set bad segments in MNE object.
+
+    The data is read in blocks of whole segments, so at most around
+    max_block_size values are held in memory at once.
+
+    Parameters
+    ----------
+    raw : mne.Raw
+        MNE Raw object.
+    segment_len : int
+        Number of samples in each segment.
+    picks : str
+        Modality to detect bad segments in.
+    mode : str
+        None to use the data or 'diff' to use the first difference of the data.
+    max_block_size : int
+        Maximum number of values (channels x samples) to read at once. At
+        least one segment is always read.
+
+    Returns
+    -------
+    raw : mne.Raw
+        MNE Raw object.
+    """
+    if mode not in [None, "diff"]:
+        raise ValueError("mode must be None or 'diff', got {0}".format(mode))
+
+    # Number of samples in the time series we look for artefacts in
+    n_samples = raw.n_times - 1 if mode == "diff" else raw.n_times
+
+    # Number of samples to read at once
+    n_channels = raw.get_data(picks=picks, start=0, stop=1).shape[0]
+    block_len = max(1, max_block_size // (n_channels * segment_len)) * segment_len
+
+    # Calculate the standard deviation of each segment, the last segment
+    # contains any samples left over
+    metric = []
+    for start in range(0, n_samples, block_len):
+        stop = min(start + block_len, n_samples)
+        if mode is None:
+            XX = raw.get_data(picks=picks, start=start, stop=stop)
+        elif mode == "diff":
+            XX = np.diff(raw.get_data(picks=picks, start=start, stop=stop + 1), axis=1)
+        metric.append(_get_segment_metric(XX, segment_len))
+    metric = np.concatenate(metric)
+
+    # Find outlier segments
+    bad_segments, _ = sails.utils.gesd(metric)
+    _annotate_badsegments(raw, bad_segments, segment_len, n_samples, picks)
 
     return raw
 
@@ -80,6 +164,82 @@ def detect_badchannels(raw, picks="grad"):
     return raw
 
 
+def detect_badchannels_and_segments(
+    raw, picks=("grad",), segment_len=1000, modes=(None,), channels=True
+):
+    """Set bad channels and bad segments in MNE object for several modalities.
+
+    This is equivalent to calling detect_badchannels then detect_badsegments
+    for each modality and mode but the data for each modality is only
+    extracted once. Unlike detect_badchannels, bad channels found in one
+    modality are added to any existing bad channels rather than replacing
+    them, and reference MEG channels are never included in 'meg'.
+
+    Parameters
+    ----------
+    raw : mne.Raw
+        MNE Raw object.
+    picks : str or list of str
+        Modalities to detect artefacts in. Can be 'grad', 'mag', 'meg' or 'eeg'.
+    segment_len : int
+        Number of samples in each segment.
+    modes : list
+        Modes for bad segment detection, see detect_badsegments.
+    channels : bool
+        Should we detect bad channels before detecting bad segments?
+
+    Returns
+    -------
+    raw : mne.Raw
+        MNE Raw object.
+    """
+    if isinstance(picks, str):
+        picks = [picks]
+    if modes is None or isinstance(modes, str):
+        modes = [modes]
+    for mode in modes:
+        if mode not in [None, "diff"]:
+            raise ValueError("mode must be None or 'diff', got {0}".format(mode))
+
+    pick_kwargs = {
+        "grad": {"meg": "grad"},
+        "mag": {"meg": "mag"},
+        "meg": {"meg": True, "ref_meg": False},
+        "eeg": {"meg": False, "eeg": True},
+    }
+
+    for modality in picks:
+        # Extract the data once, like raw.get_data(picks=modality) this
+        # includes existing bad channels
+        chinds = mne.pick_types(raw.info, **pick_kwargs[modality], exclude=[])
+        XX = raw.get_data(picks=chinds)
+
+        # Bad channels
+        if channels:
+            bdinds, _ = sails.utils.gesd(np.std(XX, axis=1))
+
+            s = "Modality {0} - {1}/{2} channels rejected     ({3:02f}%)"
+            pc = (bdinds.sum() / len(bdinds)) * 100
+            logger.info(s.format(modality, bdinds.sum(), len(bdinds), pc))
+
+            if np.any(bdinds):
+                ch_names = np.array(raw.ch_names)[chinds]
+                new_bads = [ch for ch in ch_names[bdinds] if ch not in raw.info["bads"]]
+                raw.info["bads"] = raw.info["bads"] + new_bads
+
+        # Bad segments
+        for mode in modes:
+            if mode is None:
+                metric = _get_segment_metric(XX, segment_len)
+            elif mode == "diff":
+                metric = _get_segment_metric(np.diff(XX, axis=1), segment_len)
+            n_samples = raw.n_times - 1 if mode == "diff" else raw.n_times
+            bad_segments, _ = sails.utils.gesd(metric)
+            _annotate_badsegments(raw, bad_segments, segment_len, n_samples, modality)
+
+    return raw
+
+
 # Wrapper functions
 
 
@@ -99,6 +259,16 @@ def run_osl_bad_channels(dataset, userargs, logfile=None):
     return dataset
 
 
+def run_osl_bad_channels_and_segments(dataset, userargs, logfile=None):
+    target = userargs.pop("target", "raw")
+    logger.info(
+        "OSL Stage - {0} : {1}".format(target, "detect_badchannels_and_segments")
+    )
+    logger.info("userargs: {0}".format(str(userargs)))
+    dataset["raw"] = detect_badchannels_and_segments(dataset["raw"], **userargs)
+    return dataset
+
+
 def run_osl_ica_manualreject(dataset, userargs):
     target = userargs.pop("target", "raw")
     logger.info("OSL Stage - {0}".format("ICA Manual Reject"))
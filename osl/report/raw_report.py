@@ -17,6 +17,7 @@ import argparse
 import tempfile
 import pickle
 import pathlib
+from concurrent.futures import wait
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -60,10 +61,7 @@ def gen_report_from_fif(infiles, outdir):
     # Generate HTML data
     for infile in infiles:
         print("Generating report for", infile)
-        dataset = read_dataset(infile)
-        run_id = get_header_id(dataset['raw'])
-        htmldatadir = validate_outdir(outdir / run_id)
-        gen_html_data(dataset['raw'], htmldatadir, ica=dataset['ica'])
+        gen_html_data_from_fif(infile, outdir)
 
     # Create report
     gen_html_page(outdir)
@@ -73,12 +71,43 @@ def gen_report_from_fif(infiles, outdir):
     print("************" + "*" * len(str(outdir)))
 
 
+def gen_html_data_from_fif(infile, outdir, run_id=None, profile=None):
+    """Generate HTML web-report data for a preprocessed fif file.
+
+    This can be run separately from preprocessing, e.g. in a pool of report
+    workers.
+
+    Parameters
+    ----------
+    infile : str
+        Path to preprocessed fif file.
+    outdir : str
+        Report directory. The HTML data is written to a subdirectory.
+    run_id : str
+        Name of the subdirectory to write to. If None, the name of infile is
+        used.
+    profile : list of dict
+        Time and resources used by each preprocessing stage.
+
+    Returns
+    -------
+    bool
+        Flag indicating whether the report data was generated.
+    """
+    dataset = read_dataset(infile)
+    run_id = run_id or get_header_id(dataset['raw'])
+    htmldatadir = validate_outdir(pathlib.Path(outdir) / run_id)
+    gen_html_data(dataset['raw'], htmldatadir, ica=dataset['ica'],
+                  profile=profile)
+    return True
+
+
 def get_header_id(raw):
     """Extract scan name from MNE data object."""
     return raw.filenames[0].split('/')[-1].strip('.fif')
 
 
-def gen_html_data(raw, outdir, ica=None, logger=None):
+def gen_html_data(raw, outdir, ica=None, logger=None, profile=None, filename=None):
     """Generate HTML web-report for an MNE data object.
 
     Parameters
@@ -91,11 +120,22 @@ def gen_html_data(raw, outdir, ica=None, logger=None):
         ICA object.
     logger : logging.getLogger
         Logger.
+    profile : list of dict
+        Time and resources used by each preprocessing stage, see
+        osl.utils.profiling.Profiler.
+    filename : str
+        File the data was read from. If None, the file raw was read from is
+        used. This should be passed if raw was loaded from an intermediate
+        file, e.g. a checkpoint.
     """
 
     data = {}
-    data['filename'] = raw.filenames[0]
-    data['fif_id'] = get_header_id(raw)
+    if filename is None:
+        data['filename'] = raw.filenames[0]
+        data['fif_id'] = get_header_id(raw)
+    else:
+        data['filename'] = str(filename)
+        data['fif_id'] = str(filename).split('/')[-1].strip('.fif')
 
     # Scan info
     data['projname'] = raw.info['proj_name']
@@ -157,13 +197,27 @@ def gen_html_data(raw, outdir, ica=None, logger=None):
     else:
         data['bad_chans'] = 'Bad channels: {}'.format(', '.join(bad_chans))
 
+    # Time and resources used by each preprocessing stage
+    if profile is not None:
+        rows = [[p['stage'], p['wall_time'], p['cpu_time'],
+                 p['peak_rss_delta_mb'], p['read_mb'], p['write_mb']]
+                for p in profile]
+        data['profiletable'] = tabulate(
+            rows, tablefmt='html', floatfmt='.2f',
+            headers=['Stage', 'Wall Time (s)', 'CPU Time (s)',
+                     'Peak RSS Increase (MB)', 'Read (MB)', 'Written (MB)'])
+
     # Path to save plots
     savebase = str(outdir / '{0}.png')
     
+    # Statistics shared by several plots, this means we only need to extract
+    # the data once
+    stats = compute_channel_stats(raw)
+
     # Generate plots for the report
-    data['plt_temporalsumsq'] = plot_channel_time_series(raw, savebase)
+    data['plt_temporalsumsq'] = plot_channel_time_series(raw, savebase, stats=stats)
     data['plt_badchans'] = plot_sensors(raw, savebase)
-    data['plt_channeldev'] = plot_channel_dists(raw, savebase)
+    data['plt_channeldev'] = plot_channel_dists(raw, savebase, stats=stats)
     data['plt_spectra'], data['plt_zoomspectra'] = plot_spectra(raw, savebase)
     data['plt_digitisation'] = plot_digitisation_2d(raw, savebase)
     data['plt_artefacts_eog'] = plot_eog_summary(raw, savebase)
@@ -180,16 +234,32 @@ def gen_html_data(raw, outdir, ica=None, logger=None):
         pickle.dump(data, outfile)
 
 
-def gen_html_page(outdir):
+def gen_html_page(outdir, jobs=None, logger=None):
     """Generate an HTML page from a report directory.
 
     Parameters
     ----------
     outdir : str
         Directory to generate HTML report with.
+    jobs : list of concurrent.futures.Future
+        Outstanding report jobs, e.g. gen_html_data_from_fif submitted to a
+        pool of workers. We wait for these to finish before creating the page.
+    logger : logging.getLogger
+        Logger.
     """
     outdir = pathlib.Path(outdir)
 
+    # Wait for report data to be generated
+    if jobs:
+        log_or_print("Waiting for {0} report jobs".format(len(jobs)), logger)
+        wait(jobs)
+        for job in jobs:
+            if job.exception() is not None:
+                log_or_print(
+                    "Report generation failed: {0!r}".format(job.exception()),
+                    logger,
+                )
+
     # Subdirectories which contains plots for each fif file
     subdirs = sorted(
         [d.stem for d in pathlib.Path(outdir).iterdir() if d.is_dir()]
@@ -250,6 +320,44 @@ def load_template(tname):
 # ----------------------------------------------------------------------------------
 # Scan stats and figures
 
+def compute_channel_stats(raw):
+    """Compute summary statistics for each channel type.
+
+    The data is extracted once and reduced to the statistics needed by
+    plot_channel_time_series and plot_channel_dists.
+
+    Parameters
+    ----------
+    raw : mne.Raw
+        MNE Raw object.
+
+    Returns
+    -------
+    stats : dict
+        Dictionary with a key for each channel type present ('mag', 'grad',
+        'eeg' and/or 'csd'). Each value is a dict containing 'sumsq', the sum
+        of squares across channels at each time point, and 'std', the temporal
+        standard deviation of each channel.
+    """
+    channel_types = {
+        'mag': mne.pick_types(raw.info, meg='mag'),
+        'grad': mne.pick_types(raw.info, meg='grad'),
+        'eeg': mne.pick_types(raw.info, eeg=True),
+        'csd': mne.pick_types(raw.info, csd=True),
+    }
+    x = raw.get_data()
+
+    stats = {}
+    for name, chan_inds in channel_types.items():
+        if len(chan_inds) == 0:
+            continue
+        stats[name] = {
+            'sumsq': np.sum(x[chan_inds] ** 2, axis=0),
+            'std': x[chan_inds, :].std(axis=1),
+        }
+    return stats
+
+
 def plot_flowchart(raw, savebase=None):
     """Plots preprocessing flowchart(s)"""
     
@@ -287,24 +395,16 @@ def plot_flowchart(raw, savebase=None):
     filebase = savebase.parent.name + "/" + savebase.name
     return filebase.format('flowchart')
 
-def plot_channel_time_series(raw, savebase=None):
+def plot_channel_time_series(raw, savebase=None, stats=None):
     """Plots sum-square time courses."""
 
-    # Raw data
-    channel_types = {
-        'mag': mne.pick_types(raw.info, meg='mag'),
-        'grad': mne.pick_types(raw.info, meg='grad'),
-        'eeg': mne.pick_types(raw.info, eeg=True),
-        'csd': mne.pick_types(raw.info, csd=True),
-    }
+    # Sum-square for each channel type
+    if stats is None:
+        stats = compute_channel_stats(raw)
     t = raw.times
-    x = raw.get_data()
 
     # Number of subplots, i.e. the number of different channel types in the fif file
-    nrows = 0
-    for _, c in channel_types.items():
-        if len(c) > 0:
-            nrows += 1
+    nrows = len(stats)
 
     if nrows == 0:
         return None
@@ -314,11 +414,8 @@ def plot_channel_time_series(raw, savebase=None):
     if nrows == 1:
         ax = [ax]
     row = 0
-    for name, chan_inds in channel_types.items():
-        if len(chan_inds) == 0:
-            continue
-        ss = np.sum(x[chan_inds] ** 2, axis=0)
-        ss = uniform_filter1d(ss, int(raw.info['sfreq']))
+    for name, chan_stats in stats.items():
+        ss = uniform_filter1d(chan_stats['sumsq'], int(raw.info['sfreq']))
         ax[row].plot(t, ss)
         ax[row].legend([name], frameon=False, fontsize=16)
         ax[row].set_xlim(t[0], t[-1])
@@ -378,24 +475,21 @@ def plot_sensors(raw, savebase=None):
     return filebase.format('bad_chans')
 
 
-def plot_channel_dists(raw, savebase=None):
+def plot_channel_dists(raw, savebase=None, stats=None):
     """Plot distributions of temporal standard deviation."""
 
-    # Raw data
-    channel_types = {
-        'Magnetometers': mne.pick_types(raw.info, meg='mag'),
-        'Gradiometers': mne.pick_types(raw.info, meg='grad'),
-        'EEG': mne.pick_types(raw.info, eeg=True),
-        'CSD': mne.pick_types(raw.info, csd=True),
+    # Standard deviation of each channel
+    if stats is None:
+        stats = compute_channel_stats(raw)
+    titles = {
+        'mag': 'Magnetometers',
+        'grad': 'Gradiometers',
+        'eeg': 'EEG',
+        'csd': 'CSD',
     }
-    t = raw.times
-    x = raw.get_data()
 
     # Number of subplots, i.e. the number of different channel types in the fif file
-    ncols = 0
-    for _, c in channel_types.items():
-        if len(c) > 0:
-            ncols += 1
+    ncols = len(stats)
 
     if ncols == 0:
         return None
@@ -405,14 +499,12 @@ def plot_channel_dists(raw, savebase=None):
     if ncols == 1:
         ax = [ax]
     row = 0
-    for name, chan_inds in channel_types.items():
-        if len(chan_inds) == 0:
-            continue
-        ax[row].hist(x[chan_inds, :].std(axis=1), bins=24, histtype='step')
+    for name, chan_stats in stats.items():
+        ax[row].hist(chan_stats['std'], bins=24, histtype='step')
         ax[row].legend(['Temporal Std-Dev'], frameon=False)
         ax[row].set_xlabel('Std-Dev')
         ax[row].set_ylabel('Channel Count')
-        ax[row].set_title(name)
+        ax[row].set_title(titles[name])
         row += 1
 
     # Save
@@ -429,7 +521,11 @@ def plot_channel_dists(raw, savebase=None):
 
 
 def plot_spectra(raw, savebase=None):
-    """Plot power spectra for each sensor modality."""
+    """Plot power spectra for each sensor modality.
+
+    The PSD is only computed once, the zoomed in spectra are plotted by
+    changing the axis limits of the full spectra.
+    """
 
     # Plot spectra
     fig = raw.plot_psd(show=False, verbose=0)
@@ -439,11 +535,23 @@ def plot_spectra(raw, savebase=None):
     if savebase is not None:
         figname = savebase.format('spectra_full')
         fig.savefig(figname, dpi=150, transparent=True)
-        plt.close(fig)
 
-    # Plot zoomed in spectra
-    fig = raw.plot_psd(show=False, fmin=1, fmax=48, verbose=0)
-    fig.set_size_inches(8, 7)
+    # Zoom in on 1-48 Hz, we skip axes which don't contain spectra, e.g. the
+    # sensor location insets
+    fmin, fmax = 1, 48
+    for ax in fig.axes:
+        lines = [
+            (np.asarray(line.get_xdata()), np.asarray(line.get_ydata()))
+            for line in ax.get_lines()
+        ]
+        lines = [(x, y) for x, y in lines if len(x) > 0 and np.max(x) >= fmax]
+        if len(lines) == 0:
+            continue
+        ydata = np.concatenate([y[(x >= fmin) & (x <= fmax)] for x, y in lines])
+        ax.set_xlim(fmin, fmax)
+        ymin, ymax = np.min(ydata), np.max(ydata)
+        margin = 0.05 * (ymax - ymin)
+        ax.set_ylim(ymin - margin, ymax + margin)
 
     # Save zoomed in spectra
     if savebase is not None:
@@ -12,6 +12,7 @@ import os.path as op
 
 import numpy as np
 import mne
+from scipy.spatial import KDTree
 from mne import (
     read_forward_solution,
     Covariance,
@@ -23,11 +24,13 @@ from mne.io.pick import pick_channels_cov, pick_info
 from mne.io.proj import make_projector
 from mne.rank import compute_rank
 from mne.minimum_norm.inverse import _check_depth, _prepare_forward, _get_vertno
-from mne.source_estimate import _get_src_type
+from mne.annotations import _annotations_starts_stops
+from mne.source_estimate import _get_src_type, _make_stc
 from mne.forward import _subject_from_forward
 from mne.forward.forward import is_fixed_orient
 from mne.beamformer._lcmv import _apply_lcmv
 from mne.beamformer._compute_beamformer import (
+    _check_proj_match,
     _reduce_leadfield_rank,
     _sym_inv_sm,
     Beamformer,
@@ -72,6 +75,7 @@ def make_lcmv(
     verbose=None,
     logger=None,
     save_figs=False,
+    fwd=None,
 ):
     """Compute LCMV spatial filter.
 
@@ -105,6 +109,10 @@ def make_lcmv(
         Logger.
     save_figs : bool
         Should we save figures?
+    fwd : instance of mne.Forward
+        Forward solution. If None, the forward model in subjects_dir/subject
+        is loaded. Pass this to avoid reading the forward model repeatedly
+        when computing several filters.
 
     Returns
     -------
@@ -114,8 +122,11 @@ def make_lcmv(
     log_or_print("*** RUNNING OSL MAKE LCMV ***", logger)
 
     # load forward solution
-    fwd_fname = rhino.get_coreg_filenames(subjects_dir, subject)["forward_model_file"]
-    fwd = read_forward_solution(fwd_fname)
+    if fwd is None:
+        fwd_fname = rhino.get_coreg_filenames(subjects_dir, subject)[
+            "forward_model_file"
+        ]
+        fwd = read_forward_solution(fwd_fname)
 
     if data_cov is None:
         # Note that if chantypes are meg, eeg; and meg includes mag, grad
@@ -204,30 +215,215 @@ def make_lcmv(
     return filters
 
 
-def apply_lcmv_raw(raw, filters, reject_by_annotations="omit"):
+def apply_lcmv_raw(
+    raw,
+    filters,
+    reject_by_annotations="omit",
+    chunk_size=None,
+    dtype=None,
+    out=None,
+):
     """Modified version of mne.beamformer.apply_lcmv_raw.
 
     This function has the option to remove bad segments
     (reject_by_annotations='omit') whereas the MNE function does not.
+
+    Parameters
+    ----------
+    raw : mne.Raw
+        Data to apply the filters to.
+    filters : instance of MNE Beamformer
+        LCMV filters, see make_lcmv.
+    reject_by_annotations : str
+        'omit' to remove bad segments or None to keep them.
+    chunk_size : int
+        Number of time points to beamform at a time. If None, all time points
+        are beamformed at once, unless dtype or out is passed.
+    dtype : numpy.dtype
+        Data type of the source data, e.g. np.float32 to halve the memory.
+        Defaults to float64.
+    out : str or numpy.ndarray
+        Array to write the (ndipoles, ntpts) source data to. If a str, the
+        source data is written to a memory mapped .npy file with this path.
+
+    Returns
+    -------
+    stc : instance of mne.VolSourceEstimate
+        Source estimate.
+
+    Notes
+    -----
+    If chunk_size, dtype or out is passed, only fixed orientation filters can
+    be applied. The sensor data is read and beamformed one chunk at a time,
+    so the memory used is the source data (which can be memory mapped to disk
+    with out) and one chunk of sensor data.
     """
     _check_reference(raw)
 
-    # Get data from the mne.Raw object
-    data, times = raw.get_data(
-        reject_by_annotation=reject_by_annotations, return_times=True
+    if chunk_size is None and dtype is None and out is None:
+        # Get data from the mne.Raw object
+        data, times = raw.get_data(
+            reject_by_annotation=reject_by_annotations, return_times=True
+        )
+
+        # Select channels
+        sel = _check_channels_spatial_filter(raw.ch_names, filters)
+        data = data[sel]
+
+        info = raw.info
+        tmin = times[0]
+
+        # Apply LCMV beamformer
+        stc = _apply_lcmv(data=data, filters=filters, info=info, tmin=tmin)
+
+        return next(stc)
+
+    # Combine the beamformer weights with the projection/whitening
+    weights, sel = get_lcmv_weights(raw, filters)
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    weights = weights.astype(dtype)
+
+    # Time points to keep
+    good = _get_good_samples(raw, reject_by_annotations)
+    shape = (weights.shape[0], np.sum(good))
+
+    if out is None:
+        source_data = np.empty(shape, dtype=dtype)
+    elif isinstance(out, (str, os.PathLike)):
+        source_data = np.lib.format.open_memmap(
+            out, mode="w+", dtype=dtype, shape=shape
+        )
+    else:
+        if out.shape != shape:
+            raise ValueError(f"out must have shape {shape}, got {out.shape}")
+        source_data = out
+
+    if chunk_size is None:
+        chunk_size = raw.n_times
+
+    # Beamform each chunk of time points
+    sensor_data = LazySensorData(raw, sel, reject_by_annotations)
+    for start in range(0, shape[1], chunk_size):
+        chunk = slice(start, min(start + chunk_size, shape[1]))
+        data = sensor_data[:, chunk]
+        source_data[:, chunk] = weights @ data.astype(dtype)
+
+    if isinstance(source_data, np.memmap):
+        source_data.flush()
+
+    return _make_stc(
+        source_data,
+        vertices=filters["vertices"],
+        src_type=filters["src_type"],
+        tmin=raw.times[np.argmax(good)],
+        tstep=1.0 / raw.info["sfreq"],
+        subject=filters["subject"],
+        source_nn=filters["source_nn"],
     )
 
-    # Select channels
-    sel = _check_channels_spatial_filter(raw.ch_names, filters)
-    data = data[sel]
 
-    info = raw.info
-    tmin = times[0]
+def _get_good_samples(raw, reject_by_annotations="omit"):
+    """Get a mask for the time points not annotated as bad.
 
-    # Apply LCMV beamformer
-    stc = _apply_lcmv(data=data, filters=filters, info=info, tmin=tmin)
+    Parameters
+    ----------
+    raw : mne.Raw
+        Data.
+    reject_by_annotations : str
+        'omit' to remove bad segments or None to keep them.
+
+    Returns
+    -------
+    good : numpy.ndarray
+        (n_times,) boolean mask.
+    """
+    _check_option("reject_by_annotations", reject_by_annotations, ["omit", None])
+    good = np.ones(raw.n_times, dtype=bool)
+    if reject_by_annotations == "omit":
+        onsets, ends = _annotations_starts_stops(raw, "bad")
+        for onset, end in zip(onsets, ends):
+            good[onset:end] = False
+    if not good.any():
+        raise ValueError("All time points are annotated as bad")
+    return good
 
-    return next(stc)
+
+class LazySensorData:
+    """Sensor data which is read from an mne.Raw object when it is indexed.
+
+    This behaves like the (nchans, ntpts) array
+    raw.get_data(picks=picks, reject_by_annotation=reject_by_annotations),
+    but only the time points which are indexed are read, so the data can be
+    processed in chunks without loading it all into memory.
+
+    Parameters
+    ----------
+    raw : mne.Raw
+        Data.
+    picks : list
+        Indices of the channels to read.
+    reject_by_annotations : str
+        'omit' to remove bad segments or None to keep them.
+    """
+
+    def __init__(self, raw, picks, reject_by_annotations="omit"):
+        self.raw = raw
+        self.picks = picks
+        self.samples = np.flatnonzero(_get_good_samples(raw, reject_by_annotations))
+        self.shape = (len(picks), len(self.samples))
+        self.dtype = np.dtype(np.float64)
+
+    def __getitem__(self, key):
+        channels, times = key
+        if channels != slice(None) or not isinstance(times, slice):
+            raise IndexError("Only [:, start:stop] indexing is supported")
+        samples = self.samples[times]
+        if len(samples) == 0:
+            return np.empty([self.shape[0], 0])
+        data = self.raw.get_data(
+            picks=self.picks, start=samples[0], stop=samples[-1] + 1
+        )
+        return data[:, samples - samples[0]]
+
+
+def get_lcmv_weights(raw, filters):
+    """Get the matrix which applies LCMV filters to sensor data.
+
+    This combines the beamformer weights with the projection/whitening that
+    mne.beamformer.apply_lcmv_raw applies to the data, so that
+
+        apply_lcmv_raw(raw, filters).data == weights @ raw.get_data()[sel]
+
+    Parameters
+    ----------
+    raw : mne.Raw
+        Data the filters will be applied to.
+    filters : instance of MNE Beamformer
+        Fixed orientation LCMV filters, see make_lcmv.
+
+    Returns
+    -------
+    weights : numpy.ndarray
+        (ndipoles, nchans) weights.
+    sel : list
+        Indices of the channels in raw the weights apply to.
+    """
+    _check_reference(raw)
+
+    if filters["is_free_ori"]:
+        raise ValueError("Only fixed orientation filters can be combined")
+
+    sel = _check_channels_spatial_filter(raw.ch_names, filters)
+
+    weights = filters["weights"]
+    if filters.get("is_ssp", True):
+        _check_proj_match(raw.info["projs"], filters)
+        if filters["whitener"] is None:
+            weights = weights @ filters["proj"]
+    if filters["whitener"] is not None:
+        weights = weights @ filters["whitener"]
+
+    return weights, sel
 
 
 def get_recon_timeseries(subjects_dir, subject, coord_mni, recon_timeseries_head):
@@ -254,25 +450,14 @@ def get_recon_timeseries(subjects_dir, subject, coord_mni, recon_timeseries_head
     """
 
     surfaces_filenames = rhino.get_surfaces_filenames(subjects_dir, subject)
-    coreg_filenames = rhino.get_coreg_filenames(subjects_dir, subject)
 
     # get coord_mni in mri space
     mni_mri_t = rhino_utils.read_trans(surfaces_filenames["mni_mri_t_file"])
     coord_mri = rhino_utils.xform_points(mni_mri_t["trans"], coord_mni)
 
-    # Get hold of coords of points reconstructed to.
-    # Note, MNE forward model is done in head space in metres.
-    # Rhino does everything in mm
-    fwd = read_forward_solution(coreg_filenames["forward_model_file"])
-    vs = fwd["src"][0]
-    recon_coords_head = vs["rr"][vs["vertno"]] * 1000  # in mm
-
-    # convert coords_head from head to mri space to get index of reconstructed
-    # coordinate nearest to coord_mni
-    head_mri_t = rhino_utils.read_trans(coreg_filenames["head_mri_t_file"])
-    recon_coords_mri = rhino_utils.xform_points(
-        head_mri_t["trans"], recon_coords_head.T
-    ).T
+    # Get hold of coords (in mri space, in mm) of points reconstructed to
+    # get index of reconstructed coordinate nearest to coord_mni
+    recon_coords_mri = rhino.load_source_grid(subjects_dir, subject)["coords_mri"]
 
     recon_index, d = rhino_utils._closest_node(coord_mri.T, recon_coords_mri)
 
@@ -329,107 +514,143 @@ def transform_recon_timeseries(
         recon_timeseries_out in "reference_brain" space
     """
 
+    mapping = get_recon_mapping(
+        subjects_dir,
+        subject,
+        spatial_resolution=spatial_resolution,
+        reference_brain=reference_brain,
+    )
+    recon_timeseries_out = apply_recon_mapping(recon_timeseries, mapping)
+
+    return (
+        recon_timeseries_out,
+        mapping["reference_brain"],
+        mapping["coords"],
+        mapping["recon_indices"],
+    )
+
+
+def get_recon_mapping(
+    subjects_dir,
+    subject,
+    spatial_resolution=None,
+    reference_brain="mni",
+):
+    """Find the dipole nearest to each point on the reference brain grid.
+
+    This is the spatial resampling done by transform_recon_timeseries. It only
+    depends on the forward model, so can be reused for any reconstructed
+    time courses, see apply_recon_mapping.
+
+    Parameters
+    ----------
+    subjects_dir : string
+        Directory to find RHINO subject dirs in.
+    subject : string
+        Subject name dir to find RHINO files in.
+    spatial_resolution : int
+        Resolution to use for the reference brain in mm. If None, then the
+        gridstep used in coreg_filenames['forward_model_file'] is used.
+    reference_brain : string
+        'mni' or 'mri', see transform_recon_timeseries.
+
+    Returns
+    -------
+    mapping : dict
+        Contains:
+        'reference_brain', file name of the resampled reference brain;
+        'coords', (3, ndipoles) coordinates (in mm) of the reference brain grid;
+        'recon_indices', index of the nearest dipole for each grid point;
+        'matched', whether a dipole is within spatial_resolution of each grid
+        point.
+    """
+
     surfaces_filenames = rhino.get_surfaces_filenames(subjects_dir, subject)
-    coreg_filenames = rhino.get_coreg_filenames(subjects_dir, subject)
 
     # -------------------------------------------------------
-    # Get hold of coords of points reconstructed to.
-    # Note, MNE forward model is done in head space in metres.
-    # Rhino does everything in mm
-    fwd = read_forward_solution(coreg_filenames["forward_model_file"])
-    vs = fwd["src"][0]
-    recon_coords_head = vs["rr"][vs["vertno"]] * 1000  # in mm
+    # Get hold of coords (in mm) of points reconstructed to and the gridstep
+    # of the forward model
+    grid = rhino.load_source_grid(subjects_dir, subject)
 
     # -------------------------------------------------------
     if spatial_resolution is None:
-        # estimate gridstep from forward model
-        rr = fwd["src"][0]["rr"]
-
-        store = []
-        for ii in range(rr.shape[0]):
-            store.append(np.sqrt(np.sum(np.square(rr[ii, :] - rr[0, :]))))
-        store = np.asarray(store)
-        spatial_resolution = int(np.round(np.min(store[np.where(store > 0)]) * 1000))
+        spatial_resolution = grid["gridstep"]
 
     spatial_resolution = int(spatial_resolution)
 
     if reference_brain == "mni":
         # reference is mni stdbrain
-
-        # convert recon_coords_head from head to mni space
-        head_mri_t = rhino_utils.read_trans(coreg_filenames["head_mri_t_file"])
-        recon_coords_mri = rhino_utils.xform_points(
-            head_mri_t["trans"], recon_coords_head.T
-        ).T
-
-        mni_mri_t = rhino_utils.read_trans(surfaces_filenames["mni_mri_t_file"])
-        recon_coords_out = rhino_utils.xform_points(
-            np.linalg.inv(mni_mri_t["trans"]), recon_coords_mri.T
-        ).T
+        recon_coords_out = grid["coords_mni"]
 
         reference_brain = (
             os.environ["FSLDIR"] + "/data/standard/MNI152_T1_1mm_brain.nii.gz"
         )
 
-        # Sample reference_brain to the desired resolution
-        reference_brain_resampled = op.join(
-            coreg_filenames["basedir"],
-            "MNI152_T1_{}mm_brain.nii.gz".format(spatial_resolution),
-        )
+        # The resampled MNI brain is kept in the shared cache
+        reference_brain_resampled = None
 
     elif reference_brain == "mri":
         # reference is smri
-
-        # convert recon_coords_head from head to mri space
-        head_mri_t = rhino_utils.read_trans(coreg_filenames["head_mri_t_file"])
-        recon_coords_out = rhino_utils.xform_points(
-            head_mri_t["trans"], recon_coords_head.T
-        ).T
+        recon_coords_out = grid["coords_mri"]
 
         reference_brain = surfaces_filenames["smri_file"]
 
-        # Sample reference_brain to the desired resolution
+        # The resampled sMRI is kept in the subject's directory
         reference_brain_resampled = reference_brain.replace(
             ".nii.gz", "_{}mm.nii.gz".format(spatial_resolution)
         )
 
     else:
-        ValueError("Invalid out_space, should be mni or mri")
+        raise ValueError("Invalid out_space, should be mni or mri")
 
     # -------------------------------------------------------------------------
     # get coordinates from reference brain at resolution spatial_resolution
+    # (the resampled brain and its coordinates are cached)
 
-    # create std brain of the required resolution
-    rhino_utils.system_call(
-        "flirt -in {} -ref {} -out {} -applyisoxfm {}".format(
-            reference_brain,
-            reference_brain,
-            reference_brain_resampled,
-            spatial_resolution,
-        )
+    reference_brain_resampled, coords_out = rhino_utils.get_reference_brain_grid(
+        reference_brain, spatial_resolution, out_file=reference_brain_resampled
     )
 
-    coords_out, vals = rhino_utils.niimask2mmpointcloud(reference_brain_resampled)
-
     # -------------------------------------------------------------------------
-    # for each mni_coords_out find nearest coord in recon_coords_out
+    # for each coords_out find nearest coord in recon_coords_out
 
-    recon_timeseries_out = np.zeros(
-        np.insert(recon_timeseries.shape[1:], 0, coords_out.shape[1])
-    )
+    distance, recon_index = KDTree(recon_coords_out).query(coords_out.T)
+    matched = distance < spatial_resolution
 
-    recon_indices = np.zeros([coords_out.shape[1]])
+    return {
+        "reference_brain": reference_brain_resampled,
+        "coords": coords_out,
+        "recon_indices": np.where(matched, recon_index, 0),
+        "matched": matched,
+    }
 
-    for cc in range(coords_out.shape[1]):
-        recon_index, dist = rhino_utils._closest_node(
-            coords_out[:, cc], recon_coords_out
-        )
 
-        if dist < spatial_resolution:
-            recon_timeseries_out[cc, :] = recon_timeseries[recon_index, ...]
-            recon_indices[cc] = recon_index
+def apply_recon_mapping(recon_timeseries, mapping):
+    """Resample reconstructed time courses to the reference brain grid.
+
+    Parameters
+    ----------
+    recon_timeseries : numpy.ndarray
+        (ndipoles, ntpts) or (ndipoles, ntpts, ntrials) of reconstructed time
+        courses (in head (polhemus) space).
+    mapping : dict
+        Mapping from get_recon_mapping.
 
-    return recon_timeseries_out, reference_brain_resampled, coords_out, recon_indices
+    Returns
+    -------
+    recon_timeseries_out : numpy.ndarray
+        Reconstructed time courses resampled on the reference brain grid.
+        Grid points with no dipole nearby are zero.
+    """
+    matched = mapping["matched"]
+    recon_timeseries_out = np.zeros(
+        np.insert(recon_timeseries.shape[1:], 0, len(matched)),
+        dtype=recon_timeseries.dtype,
+    )
+    recon_timeseries_out[matched] = recon_timeseries[
+        mapping["recon_indices"][matched]
+    ]
+    return recon_timeseries_out
 
 
 @verbose
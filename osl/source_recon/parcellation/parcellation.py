@@ -11,8 +11,12 @@ import os
 import os.path as op
 from pathlib import Path
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import nibabel as nib
+import scipy.linalg
+import scipy.sparse
 import scipy.sparse.linalg
 from scipy.spatial import KDTree
 from nilearn.plotting import plot_markers
@@ -20,6 +24,7 @@ from nilearn.plotting import plot_markers
 import osl.source_recon.rhino.utils as rhino_utils
 from osl.utils import soft_import
 from osl.utils.logger import log_or_print
+from osl.utils.parallel import get_n_jobs
 
 
 class Parcellation:
@@ -80,16 +85,19 @@ class Parcellation:
         method="spatial_basis",
         working_dir=None,
         logger=None,
+        n_jobs=1,
+        chunk_size=None,
     ):
         """Parcellate voxel time series.
 
         Parameters
         ----------
-        voxel_timeseries : numpy.ndarray
+        voxel_timeseries : numpy.ndarray or str
             nvoxels x ntpts, or nvoxels x ntpts x ntrials
             Data to be parcellated. Data is assumed to be in same space as the
             parcellation (e.g. typically corresponds to the output from
-            rhino.resample_recon_ts).
+            rhino.resample_recon_ts). Can also be the path to a .npy file,
+            which is memory-mapped.
         voxel_coords : numpy.ndarray
             (nvoxels x 3) coordinates of voxel_timeseries in mm in same space as
             parcellation (e.g. typically corresponds to the output from
@@ -101,10 +109,17 @@ class Parcellation:
             is unweighted and non-overlapping, 'spatialBasis' will give the same
             result as 'PCA' except with a different normalization.
         working_dir : str
-            Dir to put temp file in. If None, attempt to use same dir as passed in
-            parcellation.
+            Dir to cache the resampled parcellation in. If None, the shared OSL
+            cache dir is used, see osl.utils.cache.get_cache_dir.
         logger : logging.getLogger
             Logger.
+        n_jobs : int
+            Number of threads to compute parcel time courses with. -1 uses all
+            available CPUs.
+        chunk_size : int
+            Number of time points to process at once. If None, all the data
+            is processed at once. Use with a memory-mapped voxel_timeseries
+            to parcellate data that doesn't fit in memory.
 
         Returns
         -------
@@ -123,11 +138,18 @@ class Parcellation:
                 Boolean assignments indicating for each voxel the winner takes all
                 parcel it belongs to
         """
+        if isinstance(voxel_timeseries, str):
+            voxel_timeseries = np.load(voxel_timeseries, mmap_mode="r")
+
         parcellation_asmatrix = _resample_parcellation(
             self, voxel_coords, working_dir, logger=logger
         )
         data, voxel_weightings, voxel_assignments = _get_parcel_timeseries(
-            voxel_timeseries, parcellation_asmatrix, method=method
+            voxel_timeseries,
+            parcellation_asmatrix,
+            method=method,
+            n_jobs=n_jobs,
+            chunk_size=chunk_size,
         )
 
         self.parcel_timeseries = {
@@ -137,6 +159,82 @@ class Parcellation:
             "voxel_assignments": voxel_assignments,
         }
 
+    def parcellate_sensor_data(
+        self,
+        sensor_data,
+        voxel_projection,
+        voxel_coords,
+        method="spatial_basis",
+        working_dir=None,
+        logger=None,
+        chunk_size=None,
+    ):
+        """Parcellate voxel time series that are a linear projection of sensor
+        data, without calculating the voxel time series.
+
+        This gives the same result as
+        parcellate(voxel_projection @ sensor_data, voxel_coords, ...), but
+        only the sensor data and (nparcels x ntpts) parcel time series are held
+        in memory.
+
+        Parameters
+        ----------
+        sensor_data : numpy.ndarray
+            nchans x ntpts sensor data. Can be a memory-mapped array.
+        voxel_projection : numpy.ndarray
+            nvoxels x nchans matrix which maps the sensor data to voxel time
+            series, e.g. beamformer weights resampled to the parcellation space
+            with rhino.transform_recon_timeseries.
+        voxel_coords : numpy.ndarray
+            (nvoxels x 3) coordinates of the voxels in mm in same space as
+            parcellation.
+        method : str
+            'pca' or 'spatial_basis', see parcellate.
+        working_dir : str
+            Dir to cache the resampled parcellation in. If None, the shared OSL
+            cache dir is used, see osl.utils.cache.get_cache_dir.
+        logger : logging.getLogger
+            Logger.
+        chunk_size : int
+            Number of time points to process at once. If None, all the data
+            is processed at once.
+
+        Returns
+        -------
+        parcel_timeseries : dict
+            See parcellate. Also contains:
+            "projection": numpy.ndarray
+                nparcels x nchans matrix which maps the sensor data to parcel
+                time series (before subtracting the mean for the 'pca' method).
+        """
+        if method not in ["spatial_basis", "pca"]:
+            raise ValueError("Invalid method specified")
+
+        parcellation_asmatrix = _resample_parcellation(
+            self, voxel_coords, working_dir, logger=logger
+        )
+        data, voxel_weightings, projection = _get_parcel_timeseries_from_sensors(
+            sensor_data,
+            voxel_projection,
+            parcellation_asmatrix,
+            method=method,
+            chunk_size=chunk_size,
+        )
+
+        # compute voxel_assignments using winner takes all
+        voxel_assignments = np.zeros(voxel_weightings.shape)
+        voxel_assignments[
+            np.arange(voxel_weightings.shape[0]), np.argmax(voxel_weightings, axis=1)
+        ] = 1
+
+        self.parcel_timeseries = {
+            "data": data,
+            "voxel_coords": voxel_coords,
+            "voxel_weightings": voxel_weightings,
+            "voxel_assignments": voxel_assignments,
+            "projection": projection,
+        }
+
     def symmetric_orthogonalise(self, maintain_magnitudes=False, compute_weights=False):
         self.parcel_timeseries["data"] = symmetric_orthogonalise(
             self.parcel_timeseries["data"],
@@ -219,7 +317,7 @@ def plot_parcellation(parcellation, **kwargs):
 
 
 def _resample_parcellation(
-    parcellation, voxel_coords, working_dir=None, logger=None,
+    parcellation, voxel_coords, working_dir=None, logger=None, sparse=False,
 ):
     """Resample parcellation so that its voxel coords correspond (using
     nearest neighbour) to passed in voxel_coords. Passed in voxel_coords
@@ -236,62 +334,100 @@ def _resample_parcellation(
     voxel_coords :
         (nvoxels x 3) coordinates in mm in same space as parcellation.
     working_dir : str
-        Dir to put temp file in. If None, attempt to use same dir as passed
-        in parcellation.
+        Dir to cache the resampled parcellation in. If None, the shared OSL
+        cache dir is used, see osl.utils.cache.get_cache_dir.
     logger : logging.getLogger
         Logger.
+    sparse : bool
+        Should we return a scipy.sparse matrix?
 
     Returns
     -------
-    parcellation_asmatrix : numpy.ndarray
+    parcellation_asmatrix : numpy.ndarray or scipy.sparse.csr_matrix
         (nvoxels x nparcels) resampled parcellation
     """
     gridstep = int(rhino_utils.get_gridstep(voxel_coords.T) / 1000)
     log_or_print(f"gridstep = {gridstep} mm", logger)
 
-    pth, parcellation_name = op.split(op.splitext(op.splitext(parcellation.file)[0])[0])
-
-    if working_dir is None:
-        working_dir = pth
-
-    parcellation_resampled = op.join(
-        working_dir, parcellation_name + "_{}mm.nii.gz".format(gridstep)
+    # Resampled parcellations are cached, so this is only done once for
+    # each parcellation file and gridstep
+    parcellation_resampled = rhino_utils.get_resampled_nii(
+        parcellation.file, gridstep, cache_dir=working_dir
     )
 
-    # create std brain of the required resolution
-    os.system(
-        "flirt -in {} -ref {} -out {} -applyisoxfm {}".format(
-            parcellation.file, parcellation.file, parcellation_resampled, gridstep
-        )
+    return _parcellation2matrix(
+        parcellation_resampled, voxel_coords, gridstep, sparse=sparse
     )
 
-    nparcels = nib.load(parcellation_resampled).get_fdata().shape[3]
 
-    # parcellation_asmatrix will be the parcels mapped onto the same dipole grid
-    # as voxel_coords
-    parcellation_asmatrix = np.zeros((voxel_coords.shape[1], nparcels))
-
-    for parcel_index in range(nparcels):
+def _parcellation2matrix(parcellation_file, voxel_coords, gridstep, sparse=False):
+    """Map a parcellation onto a set of voxel coordinates using nearest
+    neighbour.
 
-        parcellation_coords, parcellation_vals = rhino_utils.niimask2mmpointcloud(
-            parcellation_resampled, parcel_index
-        )
+    Parameters
+    ----------
+    parcellation_file : str
+        Parcellation niftii file, at the same resolution as voxel_coords.
+    voxel_coords : numpy.ndarray
+        (3 x nvoxels) coordinates in mm in same space as parcellation.
+    gridstep : int
+        Spatial resolution of voxel_coords in mm. Voxels that are further than
+        this from a parcel are not assigned to it.
+    sparse : bool
+        Should we return a scipy.sparse matrix?
 
-        kdtree = KDTree(parcellation_coords.T)
+    Returns
+    -------
+    parcellation_asmatrix : numpy.ndarray or scipy.sparse.csr_matrix
+        (nvoxels x nparcels) resampled parcellation
+    """
+    # Load the parcellation once rather than once per parcel
+    parcellation_data = nib.load(parcellation_file).get_fdata()
+    sform = rhino_utils._get_sform(parcellation_file)["trans"]
+    nvoxels = voxel_coords.shape[1]
+    nparcels = parcellation_data.shape[3]
 
-        # Find each voxel_coords best matching parcellation_coords and assign
-        # the corresponding parcel value to
-        for ind in range(voxel_coords.shape[1]):
-            distance, index = kdtree.query(voxel_coords[:, ind])
-            # Exclude from parcel any voxel_coords that are further than gridstep
-            # away from the best matching parcellation_coords
-            if distance < gridstep:
-                parcellation_asmatrix[ind, parcel_index] = parcellation_vals[index]
+    # parcellation_asmatrix will be the parcels mapped onto the same dipole grid
+    # as voxel_coords, we build it from the non-zero entries
+    rows, cols, vals = [], [], []
+    for parcel_index in range(nparcels):
+        parcel = parcellation_data[..., parcel_index]
+        parcellation_coords = rhino_utils.xform_points(
+            sform, np.asarray(np.nonzero(parcel))
+        )
+        parcellation_vals = parcel[parcel != 0]
+        if len(parcellation_vals) == 0:
+            continue
+
+        # Find each voxel_coords best matching parcellation_coords, all voxels
+        # are queried at once
+        distance, index = KDTree(parcellation_coords.T).query(voxel_coords.T)
+
+        # Exclude from parcel any voxel_coords that are further than gridstep
+        # away from the best matching parcellation_coords
+        inds = np.where(distance < gridstep)[0]
+        rows.append(inds)
+        cols.append(np.full(len(inds), parcel_index))
+        vals.append(parcellation_vals[index[inds]])
+
+    parcellation_asmatrix = scipy.sparse.csr_matrix(
+        (
+            np.concatenate(vals or [[]]),
+            (np.concatenate(rows or [[]]), np.concatenate(cols or [[]])),
+        ),
+        shape=(nvoxels, nparcels),
+    )
+    if not sparse:
+        parcellation_asmatrix = parcellation_asmatrix.toarray()
     return parcellation_asmatrix
 
 
 def _get_parcel_timeseries(
-    voxel_timeseries, parcellation_asmatrix, method="spatialbasis"
+    voxel_timeseries,
+    parcellation_asmatrix,
+    method="spatial_basis",
+    n_jobs=1,
+    chunk_size=None,
 ):
     """Calculate parcel timeseries
 
@@ -310,6 +446,14 @@ def _get_parcel_timeseries(
         1st PC from all voxels, weighted by the spatial map. If the parcellation
         is unweighted and non-overlapping, 'spatialBasis' will give the same
         result as 'PCA' except with a different normalization
+    n_jobs : int
+        Number of threads to compute parcels in parallel. -1 uses all
+        available CPUs. Not used if chunk_size is passed.
+    chunk_size : int
+        If not None, the time courses are processed in chunks of this many time
+        points (over the combined time and trial dimensions), so
+        voxel_timeseries can be a memory-mapped array that doesn't fit in
+        memory. See _get_parcel_timeseries_chunked.
 
     Returns
     -------
@@ -348,96 +492,14 @@ def _get_parcel_timeseries(
     voxel_timeseries_reshaped = np.reshape(
         voxel_timeseries, (voxel_timeseries.shape[0], ntpts * ntrials)
     )
-    parcel_timeseries_reshaped = np.zeros((nparcels, ntpts * ntrials))
+    parcel_timeseries_reshaped = np.zeros(
+        (nparcels, ntpts * ntrials), dtype=_get_compute_dtype(voxel_timeseries)
+    )
 
     voxel_weightings = np.zeros(parcellation_asmatrix.shape)
 
     if method == "spatial_basis":
-        # estimate temporal-STD of data for normalisation
-        temporal_std = np.maximum(
-            np.std(voxel_timeseries_reshaped, axis=1), np.finfo(float).eps
-        )
-
-        for pp in range(nparcels):
-            # scale group maps so all have a positive peak of height 1
-            # in case there is a very noisy outlier, choose the sign from the
-            # top 5% of magnitudes
-            thresh = np.percentile(np.abs(parcellation_asmatrix[:, pp]), 95)
-            mapsign = np.sign(
-                np.mean(
-                    parcellation_asmatrix[parcellation_asmatrix[:, pp] > thresh, pp]
-                )
-            )
-            scaled_parcellation = (
-                mapsign
-                * parcellation_asmatrix[:, pp]
-                / np.max(np.abs(parcellation_asmatrix[:, pp]))
-            )
-
-            # Weight all voxels by the spatial map in question
-            # Apply the mask first then weight, to reduce memory use
-            weighted_ts = voxel_timeseries_reshaped[scaled_parcellation > 0, :]
-            weighted_ts = np.multiply(
-                weighted_ts,
-                np.reshape(scaled_parcellation[scaled_parcellation > 0], [-1, 1]),
-            )
-
-            # Perform svd and take scores of 1st PC as the node time-series
-            # U is nVoxels by nComponents - the basis transformation
-            # S*V holds nComponents by time sets of PCA scores - the
-            # timeseries data in the new basis
-            d, U = scipy.sparse.linalg.eigs(weighted_ts @ weighted_ts.T, k=1)
-            U = np.real(U)
-            d = np.real(d)
-            S = np.sqrt(np.abs(np.real(d)))
-            V = weighted_ts.T @ U / S
-            pca_scores = S @ V.T
-
-            # 0.5 is a decent arbitrary threshold used in fslnets after playing
-            # with various maps
-            this_mask = scaled_parcellation[scaled_parcellation > 0] > 0.5
-
-            if np.any(this_mask):  # the mask is non-zero
-                # U is the basis by which voxels in the mask are weighted
-                # to form the scores of the 1st PC
-                relative_weighting = np.abs(U[this_mask]) / np.sum(np.abs(U[this_mask]))
-                ts_sign = np.sign(np.mean(U[this_mask]))
-                ts_scale = np.dot(
-                    np.reshape(relative_weighting, [-1]),
-                    temporal_std[scaled_parcellation > 0][this_mask],
-                )
-
-                node_ts = (
-                    ts_sign
-                    * (ts_scale / np.maximum(np.std(pca_scores), np.finfo(float).eps))
-                    * pca_scores
-                )
-
-                inds = np.where(scaled_parcellation > 0)[0]
-                voxel_weightings[inds, pp] = (
-                    ts_sign
-                    * ts_scale
-                    / np.maximum(np.std(pca_scores), np.finfo(float).eps)
-                    * (
-                        np.reshape(U, [-1])
-                        * scaled_parcellation[scaled_parcellation > 0].T
-                    )
-                )
-
-            else:
-                print(
-                    "WARNING: An empty parcel mask was found for parcel {} ".format(pp)
-                    + "when calculating its time-courses\n"
-                    + "The parcel will have a flat zero time-course.\n"
-                    + "Check this does not cause further problems with the analysis.\n"
-                )
-
-                node_ts = np.zeros(ntpts * ntrials)
-                inds = np.where(scaled_parcellation > 0)[0]
-                voxel_weightings[inds, pp] = 0
-
-            parcel_timeseries_reshaped[pp, :] = node_ts
-
+        get_parcel = _get_spatial_basis_parcel
     elif method == "pca":
         print(
             "PCA assumes a binary parcellation.\n"
@@ -454,74 +516,38 @@ def _get_parcel_timeseries(
                 "Results may not be sensible"
             )
 
+        get_parcel = _get_pca_parcel
+    else:
+        raise ValueError("Invalid method specified")
+
+    if chunk_size is not None:
+        # Stream over time, e.g. for memory-mapped voxel time courses
+        parcel_timeseries_reshaped, voxel_weightings = _get_parcel_timeseries_chunked(
+            voxel_timeseries_reshaped, parcellation_asmatrix, method, chunk_size
+        )
+
+    else:
         # estimate temporal-STD of data for normalisation
         temporal_std = np.maximum(
             np.std(voxel_timeseries_reshaped, axis=1), np.finfo(float).eps
         )
 
-        # perform PCA on each parcel and select 1st PC scores to represent parcel
-        for pp in range(nparcels):
-
-            if any(parcellation_asmatrix[:, pp]):  # non-zero
-                parcel_data = voxel_timeseries_reshaped[
-                    parcellation_asmatrix[:, pp] > 0, :
-                ]
-                parcel_data = parcel_data - np.reshape(
-                    np.mean(parcel_data, axis=1), [-1, 1]
-                )
-
-                # Perform svd and take scores of 1st PC as the node time-series
-                # U is nVoxels by nComponents - the basis transformation
-                # S*V holds nComponents by time sets of PCA scores - the
-                # timeseries data in the new basis
-
-                d, U = scipy.sparse.linalg.eigs(parcel_data @ parcel_data.T, k=1)
-                U = np.real(U)
-                d = np.real(d)
-                S = np.sqrt(np.abs(np.real(d)))
-                V = parcel_data.T @ U / S
-                pca_scores = S @ V.T
-
-                # Restore sign and scaling of parcel time-series
-                # U indicates the weight with which each voxel in the
-                # parcel contributes to the 1st PC
-                relative_weighting = np.abs(U) / np.sum(np.abs(U))
-                ts_sign = np.sign(np.mean(U))
-                ts_scale = np.dot(
-                    np.reshape(relative_weighting, [-1]),
-                    temporal_std[parcellation_asmatrix[:, pp] > 0],
-                )
-
-                node_ts = (
-                    ts_sign
-                    * ts_scale
-                    / np.maximum(np.std(pca_scores), np.finfo(float).eps)
-                ) * pca_scores
-
-                inds = np.where(parcellation_asmatrix[:, pp] > 0)[0]
-                voxel_weightings[inds, pp] = (
-                    ts_sign
-                    * ts_scale
-                    / np.maximum(np.std(pca_scores), np.finfo(float).eps)
-                    * np.reshape(U, [-1])
-                )
-
-            else:
-                print(
-                    "WARNING: An empty parcel mask was found for parcel {}".format(pp)
-                    + " when calculating its time-courses\n"
-                    + "The parcel will have a flat zero time-course.\n"
-                    + "Check this does not cause further problems with the analysis.\n"
-                )
-
-                node_ts = np.zeros(ntpts * ntrials)
-                inds = np.where(parcellation_asmatrix[:, pp] > 0)[0]
-                voxel_weightings[inds, pp] = 0
+        # Parcels are independent, so can be computed in parallel threads (numpy
+        # releases the GIL for the matrix products and eigendecomposition)
+        def compute_parcel(pp):
+            return get_parcel(
+                voxel_timeseries_reshaped,
+                parcellation_asmatrix[:, pp],
+                temporal_std,
+                pp,
+            )
 
-            parcel_timeseries_reshaped[pp, :] = node_ts
-
-    else:
-        Exception("Invalid method specified")
+        with ThreadPoolExecutor(max_workers=get_n_jobs(n_jobs)) as executor:
+            for pp, (node_ts, inds, weightings) in enumerate(
+                executor.map(compute_parcel, range(nparcels))
+            ):
+                parcel_timeseries_reshaped[pp, :] = node_ts
+                voxel_weightings[inds, pp] = weightings
 
     # Re-separate the trials and time dimensions
     parcel_timeseries = np.reshape(
@@ -532,13 +558,502 @@ def _get_parcel_timeseries(
 
     # compute voxel_assignments using winner takes all
     voxel_assignments = np.zeros(voxel_weightings.shape)
-    for ivoxel in range(voxel_weightings.shape[0]):
-        winning_parcel = np.argmax(voxel_weightings[ivoxel, :])
-        voxel_assignments[ivoxel, winning_parcel] = 1
+    voxel_assignments[
+        np.arange(voxel_weightings.shape[0]), np.argmax(voxel_weightings, axis=1)
+    ] = 1
 
     return parcel_timeseries, voxel_weightings, voxel_assignments
 
 
+def _get_parcel_timeseries_chunked(
+    voxel_timeseries, parcellation_asmatrix, method, chunk_size, max_gram_size=2**27
+):
+    """Calculate parcel timeseries reading the voxel time courses in chunks.
+
+    The voxel weightings are calculated from the mean, variance and Gram matrix
+    of the voxels in each parcel accumulated over chunks of time points. They
+    are then applied to each chunk. This gives the same result as
+    _get_parcel_timeseries with chunk_size=None (up to floating point error),
+    but only one chunk of voxel_timeseries is held in memory at once.
+
+    Parameters
+    ----------
+    voxel_timeseries : numpy.ndarray
+        nvoxels x ntpts. Can be a memory-mapped array.
+    parcellation_asmatrix: numpy.ndarray
+        nvoxels x nparcels
+    method : str
+        'pca' or 'spatial_basis', see _get_parcel_timeseries.
+    chunk_size : int
+        Number of time points in each chunk.
+    max_gram_size : int
+        Maximum number of elements in the parcel Gram matrices held in memory
+        at once (the default is 1 GB). If the Gram matrices for all parcels
+        are larger, they are accumulated for groups of parcels with an extra
+        pass over voxel_timeseries for each group.
+
+    Returns
+    -------
+    parcel_timeseries : numpy.ndarray
+        nparcels x ntpts
+    voxel_weightings : numpy.ndarray
+        nvoxels x nparcels
+    """
+    nvoxels, ntpts = voxel_timeseries.shape
+    dtype = _get_compute_dtype(voxel_timeseries)
+    parcel_inds, parcel_weights = _get_parcel_voxels(parcellation_asmatrix, method)
+    groups = _group_parcels(parcel_inds, max_gram_size)
+
+    def accumulate_grams(group, sums=None, sumsqs=None):
+        # One pass over the data accumulating the Gram matrices of the parcels
+        # in group (and the sums and sums of squares if passed)
+        grams = {pp: np.zeros([len(parcel_inds[pp])] * 2) for pp in group}
+        for chunk in _get_chunks(ntpts, chunk_size):
+            data = np.asarray(voxel_timeseries[:, chunk], dtype=dtype)
+            if sums is not None:
+                sums += np.sum(data, axis=1, dtype=np.float64)
+                sumsqs += np.sum(np.square(data), axis=1, dtype=np.float64)
+            for pp in group:
+                parcel_data = data[parcel_inds[pp]]
+                grams[pp] += parcel_data @ parcel_data.T
+        return grams
+
+    # First pass: accumulate sums, sums of squares and Gram matrices for the
+    # first group of parcels
+    sums = np.zeros(nvoxels)
+    sumsqs = np.zeros(nvoxels)
+    grams = accumulate_grams(groups[0], sums, sumsqs)
+
+    def get_gram(pp):
+        # Parcels are processed in order, so each group is only accumulated
+        # once
+        nonlocal grams
+        if pp not in grams:
+            grams = accumulate_grams(next(g for g in groups if pp in g))
+        return grams[pp]
+
+    voxel_weightings, offsets = _get_parcel_weightings(
+        parcellation_asmatrix,
+        method,
+        parcel_inds,
+        parcel_weights,
+        ntpts,
+        sums / ntpts,
+        sumsqs,
+        get_gram,
+    )
+
+    # Last pass: apply the weightings
+    parcel_timeseries = np.zeros([parcellation_asmatrix.shape[1], ntpts], dtype=dtype)
+    weightings = voxel_weightings.T.astype(dtype)
+    for chunk in _get_chunks(ntpts, chunk_size):
+        data = np.asarray(voxel_timeseries[:, chunk], dtype=dtype)
+        parcel_timeseries[:, chunk] = weightings @ data - offsets[:, None]
+
+    return parcel_timeseries, voxel_weightings
+
+
+def _group_parcels(parcel_inds, max_gram_size):
+    """Split parcels into consecutive groups whose Gram matrices have at most
+    max_gram_size elements in total (unless a group is a single parcel)."""
+    groups = [[]]
+    size = 0
+    for pp, inds in enumerate(parcel_inds):
+        if len(groups[-1]) > 0 and size + len(inds) ** 2 > max_gram_size:
+            groups.append([])
+            size = 0
+        groups[-1].append(pp)
+        size += len(inds) ** 2
+    return groups
+
+
+def _get_parcel_timeseries_from_sensors(
+    sensor_data, voxel_projection, parcellation_asmatrix, method, chunk_size=None
+):
+    """Calculate parcel timeseries for voxel time courses that are a linear
+    projection of sensor data, without calculating the voxel time courses.
+
+    I.e. the result is the same as
+    _get_parcel_timeseries(voxel_projection @ sensor_data, ...) (up to floating
+    point error). The voxel statistics needed for the voxel weightings are
+    calculated from the sensor covariance.
+
+    Parameters
+    ----------
+    sensor_data : numpy.ndarray
+        nchans x ntpts. Can be a memory-mapped array.
+    voxel_projection : numpy.ndarray
+        nvoxels x nchans matrix which maps sensor data to voxel time courses.
+    parcellation_asmatrix: numpy.ndarray
+        nvoxels x nparcels
+    method : str
+        'pca' or 'spatial_basis', see _get_parcel_timeseries.
+    chunk_size : int
+        Number of time points to read from sensor_data at once. If None, all
+        time points are read at once.
+
+    Returns
+    -------
+    parcel_timeseries : numpy.ndarray
+        nparcels x ntpts
+    voxel_weightings : numpy.ndarray
+        nvoxels x nparcels
+    parcel_projection : numpy.ndarray
+        nparcels x nchans matrix which maps sensor data to parcel time courses
+        (before subtracting the mean for the 'pca' method).
+    """
+    nchans, ntpts = sensor_data.shape
+    if chunk_size is None:
+        chunk_size = ntpts
+
+    # First pass: accumulate the sensor sums and Gram matrix
+    sums = np.zeros(nchans)
+    sensor_gram = np.zeros([nchans, nchans])
+    for chunk in _get_chunks(ntpts, chunk_size):
+        data = np.asarray(sensor_data[:, chunk], dtype=np.float64)
+        sums += np.sum(data, axis=1)
+        sensor_gram += data @ data.T
+
+    # Voxel statistics
+    parcel_inds, parcel_weights = _get_parcel_voxels(parcellation_asmatrix, method)
+    mean = voxel_projection @ sums / ntpts
+    sumsqs = np.sum((voxel_projection @ sensor_gram) * voxel_projection, axis=1)
+
+    def get_gram(pp):
+        projection = voxel_projection[parcel_inds[pp]]
+        return projection @ sensor_gram @ projection.T
+
+    voxel_weightings, offsets = _get_parcel_weightings(
+        parcellation_asmatrix,
+        method,
+        parcel_inds,
+        parcel_weights,
+        ntpts,
+        mean,
+        sumsqs,
+        get_gram,
+    )
+
+    # Second pass: apply the sensor to parcel projection
+    parcel_projection = voxel_weightings.T @ voxel_projection
+    parcel_timeseries = np.zeros([parcellation_asmatrix.shape[1], ntpts])
+    for chunk in _get_chunks(ntpts, chunk_size):
+        data = np.asarray(sensor_data[:, chunk], dtype=np.float64)
+        parcel_timeseries[:, chunk] = parcel_projection @ data - offsets[:, None]
+
+    return parcel_timeseries, voxel_weightings, parcel_projection
+
+
+def _get_chunks(ntpts, chunk_size):
+    return [
+        slice(start, min(start + chunk_size, ntpts))
+        for start in range(0, ntpts, chunk_size)
+    ]
+
+
+def _get_parcel_voxels(parcellation_asmatrix, method):
+    """Get the voxels in each parcel and their weighting.
+
+    Returns
+    -------
+    parcel_inds : list of numpy.ndarray
+        Indices of voxels in each parcel.
+    parcel_weights : list of numpy.ndarray
+        Weighting of each voxel in each parcel. For the 'spatial_basis' method
+        this is the scaled spatial map, for 'pca' it is one.
+    """
+    parcel_inds = []
+    parcel_weights = []
+    for pp in range(parcellation_asmatrix.shape[1]):
+        if method == "spatial_basis":
+            scaled_parcellation = _scale_spatial_map(parcellation_asmatrix[:, pp])
+            inds = np.where(scaled_parcellation > 0)[0]
+            weights = scaled_parcellation[inds]
+        else:
+            inds = np.where(parcellation_asmatrix[:, pp] > 0)[0]
+            weights = np.ones(len(inds))
+        parcel_inds.append(inds)
+        parcel_weights.append(weights)
+    return parcel_inds, parcel_weights
+
+
+def _get_parcel_weightings(
+    parcellation_asmatrix,
+    method,
+    parcel_inds,
+    parcel_weights,
+    ntpts,
+    mean,
+    sumsqs,
+    get_gram,
+):
+    """Calculate voxel weightings from voxel statistics.
+
+    Parameters
+    ----------
+    parcellation_asmatrix: numpy.ndarray
+        nvoxels x nparcels
+    method : str
+        'pca' or 'spatial_basis', see _get_parcel_timeseries.
+    parcel_inds, parcel_weights : list of numpy.ndarray
+        See _get_parcel_voxels.
+    ntpts : int
+        Number of time points the statistics were calculated from.
+    mean : numpy.ndarray
+        (nvoxels,) mean of each voxel.
+    sumsqs : numpy.ndarray
+        (nvoxels,) sum of squares of each voxel.
+    get_gram : function
+        Returns the (uncentered) Gram matrix of the voxels in parcel_inds[pp]
+        given pp.
+
+    Returns
+    -------
+    voxel_weightings : numpy.ndarray
+        nvoxels x nparcels
+    offsets : numpy.ndarray
+        (nparcels,) value to subtract from voxel_weightings.T @ voxel_timeseries
+        to get the parcel time courses (non-zero for the 'pca' method, which
+        uses demeaned data).
+    """
+    nparcels = parcellation_asmatrix.shape[1]
+    temporal_std = np.maximum(
+        np.sqrt(np.maximum(sumsqs / ntpts - mean**2, 0)), np.finfo(float).eps
+    )
+
+    voxel_weightings = np.zeros(parcellation_asmatrix.shape)
+    offsets = np.zeros(nparcels)
+    for pp in range(nparcels):
+        inds = parcel_inds[pp]
+        weights = parcel_weights[pp]
+
+        if method == "spatial_basis":
+            # 0.5 is a decent arbitrary threshold used in fslnets after playing
+            # with various maps
+            mask = weights > 0.5
+        else:
+            mask = np.ones(len(inds), dtype=bool)
+
+        if not np.any(mask):
+            _warn_empty_parcel(pp)
+            continue
+
+        parcel_gram = get_gram(pp)
+        if method == "pca":
+            # Gram matrix of the demeaned data
+            parcel_gram = parcel_gram - ntpts * np.outer(mean[inds], mean[inds])
+
+        # 1st PC of the (weighted) voxels and the std of its scores
+        U = _get_top_eigenvector(parcel_gram * np.outer(weights, weights))
+        a = U * weights
+        if method == "spatial_basis":
+            scores_mean = a @ mean[inds]
+        else:
+            scores_mean = 0
+        scores_std = np.sqrt(max(a @ parcel_gram @ a / ntpts - scores_mean**2, 0))
+
+        norm = _get_pc_normalisation(U, scores_std, temporal_std[inds], mask)
+        voxel_weightings[inds, pp] = norm * a
+
+        if method == "pca":
+            # The PCA method uses the demeaned data
+            offsets[pp] = voxel_weightings[inds, pp] @ mean[inds]
+
+    return voxel_weightings, offsets
+
+
+def _get_compute_dtype(voxel_timeseries):
+    """Precision to compute parcel time courses in: float32 if the voxel
+    time courses are float32, otherwise float64."""
+    if voxel_timeseries.dtype == np.float32:
+        return np.float32
+    return np.float64
+
+
+def _get_first_pc(data, weights=None):
+    """First principal component of (weighted) data, without demeaning.
+
+    Uses a symmetric eigendecomposition of the smaller of the voxel and time
+    Gram matrices.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        nvoxels x ntpts
+    weights : numpy.ndarray
+        (nvoxels,) weight to multiply each voxel's time course by. Applying
+        this to the Gram matrix avoids copying the data.
+
+    Returns
+    -------
+    U : numpy.ndarray
+        (nvoxels,) unit-norm weighting of each (weighted) voxel for the 1st PC.
+    pca_scores : numpy.ndarray
+        (ntpts,) scores of the 1st PC.
+    """
+    nvoxels, ntpts = data.shape
+    if weights is not None and nvoxels > ntpts:
+        data = data * weights[:, None]
+        weights = None
+
+    if nvoxels <= ntpts:
+        gram = data @ data.T
+        if weights is not None:
+            gram *= np.outer(weights, weights)
+        U = _get_top_eigenvector(gram)
+    else:
+        U = data @ _get_top_eigenvector(data.T @ data)
+        U /= np.linalg.norm(U)
+
+    if weights is None:
+        pca_scores = U @ data
+    else:
+        pca_scores = (U * weights) @ data
+
+    return U, pca_scores
+
+
+def _get_top_eigenvector(gram):
+    """Eigenvector with the largest eigenvalue of a symmetric positive
+    semi-definite matrix."""
+    n = gram.shape[0]
+    if n <= 256:
+        # A full symmetric eigendecomposition is quickest for small matrices
+        _, U = scipy.linalg.eigh(gram, subset_by_index=[n - 1, n - 1])
+    else:
+        _, U = scipy.sparse.linalg.eigsh(gram, k=1, which="LA")
+    return U[:, 0]
+
+
+def _scale_spatial_map(parcel_map):
+    """Scale a spatial map so it has a positive peak of height 1."""
+    # in case there is a very noisy outlier, choose the sign from the
+    # top 5% of magnitudes
+    thresh = np.percentile(np.abs(parcel_map), 95)
+    mapsign = np.sign(np.mean(parcel_map[parcel_map > thresh]))
+    return mapsign * parcel_map / np.max(np.abs(parcel_map))
+
+
+def _get_pc_normalisation(U, pca_scores_std, temporal_std, mask=None):
+    """Factor to restore the sign and scale of a parcel time course.
+
+    Parameters
+    ----------
+    U : numpy.ndarray
+        (nvoxels,) weighting of each voxel in the parcel for the 1st PC.
+    pca_scores_std : float
+        Standard deviation of the 1st PC scores.
+    temporal_std : numpy.ndarray
+        (nvoxels,) standard deviation of each voxel in the parcel.
+    mask : numpy.ndarray
+        Boolean mask for voxels used to calculate the sign and scale. If None,
+        all voxels are used.
+
+    Returns
+    -------
+    norm : float
+        Factor to multiply the 1st PC scores by.
+    """
+    if mask is not None:
+        U = U[mask]
+        temporal_std = temporal_std[mask]
+    relative_weighting = np.abs(U) / np.sum(np.abs(U))
+    ts_sign = np.sign(np.mean(U))
+    ts_scale = np.dot(relative_weighting, temporal_std)
+    return ts_sign * ts_scale / np.maximum(pca_scores_std, np.finfo(float).eps)
+
+
+def _warn_empty_parcel(pp):
+    print(
+        "WARNING: An empty parcel mask was found for parcel {} ".format(pp)
+        + "when calculating its time-courses\n"
+        + "The parcel will have a flat zero time-course.\n"
+        + "Check this does not cause further problems with the analysis.\n"
+    )
+
+
+def _get_spatial_basis_parcel(voxel_timeseries, parcel_map, temporal_std, pp):
+    """Parcel time course using the 'spatial_basis' method, see
+    _get_parcel_timeseries.
+
+    Returns
+    -------
+    node_ts : numpy.ndarray
+        (ntpts,) parcel time course.
+    inds : numpy.ndarray
+        Indices of voxels with a non-zero weighting.
+    weightings : numpy.ndarray
+        Voxel weightings for voxels in inds.
+    """
+    dtype = _get_compute_dtype(voxel_timeseries)
+
+    # scale group maps so all have a positive peak of height 1
+    scaled_parcellation = _scale_spatial_map(parcel_map)
+    inds = np.where(scaled_parcellation > 0)[0]
+
+    # 0.5 is a decent arbitrary threshold used in fslnets after playing
+    # with various maps
+    this_mask = scaled_parcellation[inds] > 0.5
+
+    if not np.any(this_mask):  # the mask is zero
+        _warn_empty_parcel(pp)
+        return np.zeros(voxel_timeseries.shape[1]), inds, 0
+
+    # Take scores of 1st PC of all voxels weighted by the spatial map in
+    # question as the node time-series
+    # U is the basis by which voxels are weighted to form the scores of the 1st PC
+    U, pca_scores = _get_first_pc(
+        voxel_timeseries[inds, :].astype(dtype, copy=False),
+        weights=scaled_parcellation[inds].astype(dtype),
+    )
+
+    norm = _get_pc_normalisation(
+        U, np.std(pca_scores), temporal_std[inds], this_mask
+    )
+
+    node_ts = norm * pca_scores
+    weightings = norm * U * scaled_parcellation[inds]
+
+    return node_ts, inds, weightings
+
+
+def _get_pca_parcel(voxel_timeseries, parcel_map, temporal_std, pp):
+    """Parcel time course using the 'pca' method, see _get_parcel_timeseries.
+
+    Returns
+    -------
+    node_ts : numpy.ndarray
+        (ntpts,) parcel time course.
+    inds : numpy.ndarray
+        Indices of voxels in the parcel.
+    weightings : numpy.ndarray
+        Voxel weightings for voxels in inds.
+    """
+    inds = np.where(parcel_map > 0)[0]
+
+    if not np.any(parcel_map):  # zero
+        _warn_empty_parcel(pp)
+        return np.zeros(voxel_timeseries.shape[1]), inds, 0
+
+    parcel_data = voxel_timeseries[inds, :].astype(
+        _get_compute_dtype(voxel_timeseries), copy=False
+    )
+    parcel_data -= np.mean(parcel_data, axis=1, keepdims=True)
+
+    # Take scores of 1st PC as the node time-series
+    # U indicates the weight with which each voxel in the parcel contributes
+    # to the 1st PC
+    U, pca_scores = _get_first_pc(parcel_data)
+
+    # Restore sign and scaling of parcel time-series
+    norm = _get_pc_normalisation(U, np.std(pca_scores), temporal_std[inds])
+
+    node_ts = norm * pca_scores
+    weightings = norm * U
+
+    return node_ts, inds, weightings
+
+
 def _parcel_timeseries2nii(
     parcellation,
     parcel_timeseries_data,
@@ -617,21 +1132,8 @@ def _parcel_timeseries2nii(
     gridstep = int(rhino_utils.get_gridstep(voxel_coords.T) / 1000)
 
     # Sample parcellation_mask to the desired resolution
-    pth, ref_brain_name = op.split(
-        op.splitext(op.splitext(parcellation_mask_file)[0])[0]
-    )
-    parcellation_mask_resampled = op.join(
-        working_dir, ref_brain_name + "_{}mm_brain.nii.gz".format(gridstep)
-    )
-
-    # create std brain of the required resolution
-    os.system(
-        "flirt -in {} -ref {} -out {} -applyisoxfm {}".format(
-            parcellation_mask_file,
-            parcellation_mask_file,
-            parcellation_mask_resampled,
-            gridstep,
-        )
+    parcellation_mask_resampled = rhino_utils.get_resampled_nii(
+        parcellation_mask_file, gridstep, cache_dir=working_dir
     )
 
     parcellation_mask_coords, vals = rhino_utils.niimask2mmpointcloud(
@@ -73,6 +73,8 @@ def get_coreg_filenames(subjects_dir, subject):
         "polhemus_lpa_file": op.join(basedir, "polhemus_lpa.txt"),
         "polhemus_headshape_file": op.join(basedir, "polhemus_headshape.txt"),
         "forward_model_file": op.join(basedir, "forward-fwd.fif"),
+        "source_grid_file": op.join(basedir, "source_grid.npz"),
+        "forward_model_manifest_file": op.join(basedir, "forward_model_manifest.json"),
         "std_brain": op.join(
             os.environ["FSLDIR"],
             "data",
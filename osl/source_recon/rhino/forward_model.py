@@ -9,15 +9,21 @@
 
 import os
 import os.path as op
+from glob import glob
 from copy import deepcopy
 
+import numpy as np
 import nibabel as nib
 
 from mne import (
     make_bem_model,
     make_bem_solution,
     make_forward_solution,
+    read_forward_solution,
+    read_source_spaces,
+    write_bem_solution,
     write_forward_solution,
+    write_source_spaces,
 )
 from mne.bem import ConductorModel, read_bem_solution
 from mne.transforms import read_trans, Transform
@@ -26,8 +32,16 @@ from mne.io.constants import FIFF
 from mne.surface import read_surface, write_surface
 from mne.source_space import _make_volume_source_space, _complete_vol_src
 
+import osl.source_recon.rhino.utils as rhino_utils
 from osl.source_recon.rhino import get_coreg_filenames
 from osl.source_recon.rhino.surfaces import get_surfaces_filenames
+from osl.utils.cache import (
+    hash_file,
+    hash_object,
+    get_package_versions,
+    read_manifest,
+    write_manifest,
+)
 from osl.utils.logger import log_or_print
 
 
@@ -42,9 +56,16 @@ def forward_model(
     meg=True,
     verbose=False,
     logger=None,
+    n_jobs=1,
+    use_cache=True,
 ):
     """Compute forward model.
 
+    The BEM solution, source space and forward model are cached. They are
+    only recomputed if their inputs (surfaces, coregistration, sensors and
+    parameters) have changed since they were last computed. Only the cached
+    BEM solution and source space for the current inputs are kept.
+
     Parameters
     ----------
     subjects_dir : string
@@ -69,6 +90,11 @@ def forward_model(
         Whether to compute forward model for meg sensors
     logger : logging.getLogger
         Logger.
+    n_jobs : int
+        Number of jobs to compute the forward solution with, see
+        mne.make_forward_solution.
+    use_cache : bool
+        Should we reuse cached results if the inputs haven't changed?
     """
     log_or_print("*** RUNNING OSL RHINO FORWARD MODEL ***", logger)
 
@@ -80,15 +106,49 @@ def forward_model(
     else:
         raise ValueError("{} is an invalid model choice".format(model))
 
-    vol_src = setup_volume_source_space(
+    filenames = get_coreg_filenames(subjects_dir, subject)
+    keys = _get_forward_model_keys(
         subjects_dir,
         subject,
+        conductivity=conductivity,
         gridstep=gridstep,
         mindist=mindist,
         exclude=exclude,
-        logger=logger,
+        eeg=eeg,
+        meg=meg,
     )
 
+    manifest = read_manifest(filenames["forward_model_manifest_file"])
+    if (
+        use_cache
+        and manifest is not None
+        and manifest.get("forward") == keys["forward"]
+        and op.exists(filenames["forward_model_file"])
+    ):
+        log_or_print("Using cached forward model", logger)
+        log_or_print("*** OSL RHINO FORWARD MODEL COMPLETE ***", logger)
+        return
+
+    # Cached BEM solutions and source spaces are kept in the bem directory
+    # named by the hash of their inputs
+    bem_dir = op.join(subjects_dir, subject, "bem")
+    src_file = op.join(bem_dir, "rhino-{}-src.fif".format(keys["src"][:16]))
+    bem_file = op.join(bem_dir, "rhino-{}-bem-sol.fif".format(keys["bem"][:16]))
+
+    if use_cache and op.exists(src_file):
+        log_or_print("Using cached source space", logger)
+        vol_src = read_source_spaces(src_file, verbose=verbose)
+    else:
+        vol_src = setup_volume_source_space(
+            subjects_dir,
+            subject,
+            gridstep=gridstep,
+            mindist=mindist,
+            exclude=exclude,
+            logger=logger,
+        )
+        write_source_spaces(src_file, vol_src, overwrite=True, verbose=verbose)
+
     # The BEM solution requires a BEM model which describes the geometry of the
     # head the conductivities of the different tissues. See:
     # https://mne.tools/stable/auto_tutorials/forward/30_forward.html#sphx-glr-auto-tutorials-forward-30-forward-py
@@ -100,15 +160,20 @@ def forward_model(
     # This will get the surfaces from: subjects_dir/subject/bem/inner_skull.surf
     # which is where rhino.setup_volume_source_space will have put it.
 
-    model = make_bem_model(
-        subjects_dir=subjects_dir,
-        subject=subject,
-        ico=None,
-        conductivity=conductivity,
-        verbose=verbose,
-    )
-
-    bem = make_bem_solution(model)
+    if use_cache and op.exists(bem_file):
+        log_or_print("Using cached BEM solution", logger)
+        bem = read_bem_solution(bem_file, verbose=verbose)
+    else:
+        _write_bem_surfaces(subjects_dir, subject, logger=logger)
+        model = make_bem_model(
+            subjects_dir=subjects_dir,
+            subject=subject,
+            ico=None,
+            conductivity=conductivity,
+            verbose=verbose,
+        )
+        bem = make_bem_solution(model)
+        write_bem_solution(bem_file, bem, overwrite=True, verbose=verbose)
 
     fwd = make_fwd_solution(
         subjects_dir,
@@ -118,15 +183,190 @@ def forward_model(
         bem=bem,
         eeg=eeg,
         meg=meg,
+        n_jobs=n_jobs,
         verbose=verbose,
     )
 
-    filenames = get_coreg_filenames(subjects_dir, subject)
     write_forward_solution(filenames["forward_model_file"], fwd, overwrite=True)
+    save_source_grid(subjects_dir, subject, fwd, gridstep=gridstep)
+    write_manifest(filenames["forward_model_manifest_file"], keys)
+    _remove_old_cache_files(bem_dir, keep=[src_file, bem_file])
 
     log_or_print("*** OSL RHINO FORWARD MODEL COMPLETE ***", logger)
 
 
+def _remove_old_cache_files(bem_dir, keep):
+    """Remove cached source spaces and BEM solutions for previous inputs.
+
+    Parameters
+    ----------
+    bem_dir : string
+        Directory containing the cached files.
+    keep : list of str
+        Files to keep.
+    """
+    keep = [op.abspath(f) for f in keep]
+    for pattern in ["rhino-*-src.fif", "rhino-*-bem-sol.fif"]:
+        for f in glob(op.join(bem_dir, pattern)):
+            if op.abspath(f) not in keep:
+                os.remove(f)
+
+
+def _get_forward_model_keys(
+    subjects_dir, subject, conductivity, gridstep, mindist, exclude, eeg, meg
+):
+    """Hash the inputs to the source space, BEM solution and forward model.
+
+    Returns
+    -------
+    keys : dict
+        Hex digest for 'src', 'bem' and 'forward'.
+    """
+    coreg_filenames = get_coreg_filenames(subjects_dir, subject)
+    surfaces_filenames = get_surfaces_filenames(subjects_dir, subject)
+    versions = get_package_versions(("osl", "mne"))
+
+    surfaces = {
+        name: hash_file(surfaces_filenames[name], content=True)
+        for name in [
+            "bet_inskull_surf_file",
+            "bet_outskull_surf_file",
+            "bet_outskin_surf_file",
+        ]
+    }
+
+    # Only the sensor geometry is used from the fif file
+    info = read_info(coreg_filenames["fif_file"], verbose=False)
+    sensors = {
+        "ch_names": info["ch_names"],
+        "chs": [[ch["coil_type"], ch["loc"].tolist()] for ch in info["chs"]],
+        "dev_head_t": info["dev_head_t"]["trans"].tolist(),
+        "comps": len(info["comps"]),
+    }
+
+    src = {
+        "inskull": surfaces["bet_inskull_surf_file"],
+        "smri": hash_file(surfaces_filenames["smri_file"], content=True),
+        "gridstep": gridstep,
+        "mindist": mindist,
+        "exclude": exclude,
+        "versions": versions,
+    }
+    bem = {"surfaces": surfaces, "conductivity": conductivity, "versions": versions}
+    forward = {
+        "src": hash_object(src),
+        "bem": hash_object(bem),
+        "head_mri_t": hash_file(coreg_filenames["head_mri_t_file"], content=True),
+        "mni_mri_t": hash_file(surfaces_filenames["mni_mri_t_file"], content=True),
+        "sensors": hash_object(sensors),
+        "eeg": eeg,
+        "meg": meg,
+    }
+
+    return {
+        "src": forward["src"],
+        "bem": forward["bem"],
+        "forward": hash_object(forward),
+    }
+
+
+def save_source_grid(subjects_dir, subject, fwd, gridstep=None):
+    """Save the source space grid of a forward model.
+
+    The grid is saved to
+    get_coreg_filenames(subjects_dir, subject)['source_grid_file'],
+    so downstream steps can use it without reading the forward model.
+
+    Parameters
+    ----------
+    subjects_dir : string
+        Directory to find RHINO subject dirs in.
+    subject : string
+        Subject name dir to find RHINO files in.
+    fwd : instance of Forward
+        Forward solution (in head space).
+    gridstep : int
+        Spacing of the grid in mm. If None, it is estimated from the source
+        space.
+
+    Returns
+    -------
+    grid : dict
+        Source grid, see load_source_grid.
+    """
+    coreg_filenames = get_coreg_filenames(subjects_dir, subject)
+    surfaces_filenames = get_surfaces_filenames(subjects_dir, subject)
+
+    vs = fwd["src"][0]
+    if gridstep is None:
+        gridstep = rhino_utils.get_gridstep(vs["rr"])
+
+    # Coordinates of the points reconstructed to. The forward model is in
+    # head space in metres, RHINO does everything in mm
+    coords_head = vs["rr"][vs["vertno"]] * 1000
+
+    head_mri_t = read_trans(coreg_filenames["head_mri_t_file"])
+    coords_mri = rhino_utils.xform_points(head_mri_t["trans"], coords_head.T).T
+
+    mni_mri_t = read_trans(surfaces_filenames["mni_mri_t_file"])
+    coords_mni = rhino_utils.xform_points(
+        np.linalg.inv(mni_mri_t["trans"]), coords_mri.T
+    ).T
+
+    grid = {
+        "gridstep": int(gridstep),
+        "vertno": vs["vertno"],
+        "coords_head": coords_head,
+        "coords_mri": coords_mri,
+        "coords_mni": coords_mni,
+        "src_mri_t": vs["src_mri_t"]["trans"] if "src_mri_t" in vs else np.eye(4),
+    }
+    np.savez(coreg_filenames["source_grid_file"], **grid)
+
+    return grid
+
+
+def load_source_grid(subjects_dir, subject):
+    """Load the source space grid of the forward model.
+
+    If the grid file doesn't exist or is older than the forward model (e.g.
+    the forward model was computed with an older version of OSL), it is
+    created from the forward model.
+
+    Parameters
+    ----------
+    subjects_dir : string
+        Directory to find RHINO subject dirs in.
+    subject : string
+        Subject name dir to find RHINO files in.
+
+    Returns
+    -------
+    grid : dict
+        Source grid, containing:
+            'gridstep' - spacing of the grid in mm.
+            'vertno' - indices of the source space points in use.
+            'coords_head', 'coords_mri', 'coords_mni' - (ndipoles, 3) coordinates
+            of the points reconstructed to in mm in head, native MRI and MNI
+            space. These are in the same order as the dipoles in the forward
+            model.
+            'src_mri_t' - source space voxel to MRI transform (in metres).
+    """
+    coreg_filenames = get_coreg_filenames(subjects_dir, subject)
+    grid_file = coreg_filenames["source_grid_file"]
+    fwd_file = coreg_filenames["forward_model_file"]
+
+    if not op.exists(grid_file) or op.getmtime(grid_file) < op.getmtime(fwd_file):
+        fwd = read_forward_solution(fwd_file, verbose=False)
+        return save_source_grid(subjects_dir, subject, fwd)
+
+    with np.load(grid_file) as f:
+        grid = {key: f[key] for key in f.files}
+    grid["gridstep"] = int(grid["gridstep"])
+
+    return grid
+
+
 def make_fwd_solution(
     subjects_dir,
     subject,
@@ -227,11 +467,8 @@ def make_fwd_solution(
     return fwd
 
 
-def setup_volume_source_space(
-    subjects_dir, subject, gridstep=5, mindist=5.0, exclude=0.0, logger=None
-):
-    """Set up a volume source space grid inside the inner skull surface.
-    This is a RHINO specific version of mne.setup_volume_source_space.
+def _write_bem_surfaces(subjects_dir, subject, logger=None):
+    """Copy the BET surfaces to where MNE expects to find them.
 
     Parameters
     ----------
@@ -239,48 +476,9 @@ def setup_volume_source_space(
         Directory to find RHINO subject dirs in.
     subject : string
         Subject name dir to find RHINO files in.
-    gridstep : int
-        A grid will be constructed with the spacing given by ``gridstep`` in mm,
-        generating a volume source space.
-    mindist : float
-        Exclude points closer than this distance (mm) to the bounding surface.
-    exclude : float
-        Exclude points closer than this distance (mm) from the center of mass
-        of the bounding surface.
     logger : logging.getLogger
         Logger
-
-    Returns
-    -------
-    src : SourceSpaces
-        A single source space object.
-
-    See Also
-    --------
-    mne.setup_volume_source_space
-
-    Notes
-    -----
-    This is a RHINO specific version of mne.setup_volume_source_space, which
-    can handle smri's that are niftii files. This specifically
-    uses the inner skull surface in:
-        get_surfaces_filenames(subjects_dir, subject)['bet_inskull_surf_file']
-    to define the source space grid.
-
-    This will also copy the:
-        get_surfaces_filenames(subjects_dir, subject)['bet_inskull_surf_file']
-    file to:
-        subjects_dir/subject/bem/inner_skull.surf
-    since this is where mne expects to find it when mne.make_bem_model
-    is called.
-
-    The coords of points to reconstruct to can be found in the output here:
-        src[0]['rr'][src[0]['vertno']]
-    where they are in native MRI space in metres.
     """
-
-    pos = int(gridstep)
-
     surfaces_filenames = get_surfaces_filenames(subjects_dir, subject)
 
     # -------------------------------------------------------------------------
@@ -358,6 +556,65 @@ def setup_volume_source_space(
         overwrite=True,
     )
 
+
+def setup_volume_source_space(
+    subjects_dir, subject, gridstep=5, mindist=5.0, exclude=0.0, logger=None
+):
+    """Set up a volume source space grid inside the inner skull surface.
+    This is a RHINO specific version of mne.setup_volume_source_space.
+
+    Parameters
+    ----------
+    subjects_dir : string
+        Directory to find RHINO subject dirs in.
+    subject : string
+        Subject name dir to find RHINO files in.
+    gridstep : int
+        A grid will be constructed with the spacing given by ``gridstep`` in mm,
+        generating a volume source space.
+    mindist : float
+        Exclude points closer than this distance (mm) to the bounding surface.
+    exclude : float
+        Exclude points closer than this distance (mm) from the center of mass
+        of the bounding surface.
+    logger : logging.getLogger
+        Logger
+
+    Returns
+    -------
+    src : SourceSpaces
+        A single source space object.
+
+    See Also
+    --------
+    mne.setup_volume_source_space
+
+    Notes
+    -----
+    This is a RHINO specific version of mne.setup_volume_source_space, which
+    can handle smri's that are niftii files. This specifically
+    uses the inner skull surface in:
+        get_surfaces_filenames(subjects_dir, subject)['bet_inskull_surf_file']
+    to define the source space grid.
+
+    This will also copy the:
+        get_surfaces_filenames(subjects_dir, subject)['bet_inskull_surf_file']
+    file to:
+        subjects_dir/subject/bem/inner_skull.surf
+    since this is where mne expects to find it when mne.make_bem_model
+    is called.
+
+    The coords of points to reconstruct to can be found in the output here:
+        src[0]['rr'][src[0]['vertno']]
+    where they are in native MRI space in metres.
+    """
+
+    pos = int(gridstep)
+
+    surfaces_filenames = get_surfaces_filenames(subjects_dir, subject)
+
+    _write_bem_surfaces(subjects_dir, subject, logger=logger)
+
     # -------------------------------------------------------------------------
     # Setup main MNE call to _make_volume_source_space
 
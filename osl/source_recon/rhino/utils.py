@@ -9,6 +9,8 @@
 
 import os
 import os.path as op
+import tempfile
+import functools
 
 from pathlib import Path
 
@@ -47,21 +49,189 @@ def get_gridstep(coords):
     Parameters
     ----------
     coords : numpy.ndarray
-        Coordinates.
+        (npoints, 3) coordinates.
 
     Returns
     -------
     gridstep: int
         Spatial resolution of dipole grid in mm
     """
-    store = []
-    for ii in range(coords.shape[0]):
-        store.append(np.sqrt(np.sum(np.square(coords[ii, :] - coords[0, :]))))
-    store = np.asarray(store)
-    gridstep = int(np.round(np.min(store[np.where(store > 0)]) * 1000))
+    store = np.linalg.norm(coords - coords[0], axis=1)
+    gridstep = int(np.round(np.min(store[store > 0]) * 1000))
     return gridstep
 
 
+def resample_nii(nii_file, out_file, gridstep):
+    """Resample a niftii file to an isotropic resolution.
+
+    The data is trilinearly interpolated (scipy.ndimage.affine_transform) onto
+    a grid covering the same field of view in FSL coordinates. The output grid
+    (shape, affine and sform/qform codes) is the same as
+    'flirt -in nii_file -ref nii_file -out out_file -applyisoxfm gridstep',
+    but the voxel values are not the same as FLIRT's. E.g. resampling
+    fMRI_parcellation_ds2mm.nii.gz to 8 mm gives values which have a
+    correlation of 0.986 with the fMRI_parcellation_ds8mm.nii.gz shipped with
+    OSL, and about 9% of voxels have a different most likely parcel.
+
+    Parameters
+    ----------
+    nii_file : str
+        Niftii file to resample. Can be 3D or 4D.
+    out_file : str
+        Output niftii file.
+    gridstep : int
+        Output resolution in mm.
+    """
+    from scipy.ndimage import affine_transform
+
+    img = nib.load(nii_file)
+    data = img.get_fdata()
+    affine = img.affine
+
+    # Voxel indices in the input for each voxel in the output
+    voxel_size = np.array(img.header.get_zooms()[:3])
+    scale = gridstep / voxel_size
+    shape = np.round(np.array(data.shape[:3]) / scale).astype(int)
+    offset = np.zeros(3)
+    if np.linalg.det(affine[:3, :3]) > 0:
+        # FSL coordinates are flipped in x for images in neurological order
+        offset[0] = (data.shape[0] - 1) - (shape[0] - 1) * scale[0]
+
+    # Interpolate each volume
+    vols = data.reshape(data.shape[:3] + (-1,))
+    resampled = np.zeros(tuple(shape) + (vols.shape[3],), dtype=np.float32)
+    for i in range(vols.shape[3]):
+        resampled[..., i] = affine_transform(
+            vols[..., i],
+            np.diag(scale),
+            offset=offset,
+            output_shape=tuple(shape),
+            order=1,
+            mode="constant",
+            cval=0,
+        )
+    resampled = resampled.reshape(tuple(shape) + data.shape[3:])
+
+    # Affine mapping the output voxel indices to the same space
+    resampled_affine = affine @ np.block(
+        [[np.diag(scale), offset[:, None]], [np.zeros([1, 3]), np.ones([1, 1])]]
+    )
+
+    out_img = nib.Nifti1Image(resampled, resampled_affine, header=img.header)
+    out_img.set_sform(resampled_affine, code=int(img.header["sform_code"]))
+    out_img.set_qform(resampled_affine, code=int(img.header["qform_code"]))
+    out_img.header.set_zooms(tuple(np.full(3, gridstep)) + img.header.get_zooms()[3:])
+    nib.save(out_img, out_file)
+
+
+def get_resampled_nii(nii_file, gridstep, cache_dir=None, out_file=None):
+    """Get a niftii file resampled to an isotropic resolution.
+
+    By default, resampled files are cached in a shared directory using the
+    hash of the input file and the gridstep, so each file is only resampled
+    once for each resolution. This is intended for fixed templates, such as
+    the MNI brain or parcellations. For subject specific files, pass out_file
+    to keep the resampled file with the subject's data, it is then only
+    recomputed if it is older than nii_file. Files are written atomically, so
+    this is safe to call from parallel workers.
+
+    Parameters
+    ----------
+    nii_file : str
+        Niftii file to resample.
+    gridstep : int
+        Resolution in mm.
+    cache_dir : str
+        Directory to cache the resampled file in. If None, the 'nii'
+        subdirectory of osl.utils.cache.get_cache_dir() is used. Ignored if
+        out_file is passed.
+    out_file : str
+        File to save the resampled file to.
+
+    Returns
+    -------
+    resampled_file : str
+        Path to resampled file.
+    """
+    from osl.utils.cache import hash_file, get_cache_dir
+
+    if out_file is not None:
+        resampled_file = out_file
+        out_dir = op.dirname(op.abspath(out_file))
+        up_to_date = (
+            op.exists(resampled_file)
+            and op.getmtime(resampled_file) >= op.getmtime(nii_file)
+        )
+    else:
+        if cache_dir is None:
+            out_dir = get_cache_dir("nii")
+        else:
+            out_dir = cache_dir
+            os.makedirs(out_dir, exist_ok=True)
+
+        name = op.basename(nii_file).split(".")[0]
+        key = hash_file(nii_file, content=True)[:16]
+        resampled_file = op.join(out_dir, f"{name}_{key}_{gridstep}mm.nii.gz")
+        up_to_date = op.exists(resampled_file)
+
+    if not up_to_date:
+        fd, tmp_file = tempfile.mkstemp(suffix=".nii.gz", dir=out_dir)
+        os.close(fd)
+        try:
+            resample_nii(nii_file, tmp_file, gridstep)
+            os.replace(tmp_file, resampled_file)
+        finally:
+            if op.exists(tmp_file):
+                os.remove(tmp_file)
+
+    return resampled_file
+
+
+def get_reference_brain_grid(
+    reference_brain, spatial_resolution, cache_dir=None, out_file=None
+):
+    """Get the dipole grid of a reference brain at a given resolution.
+
+    The resampled reference brain and its grid coordinates are cached, so
+    each resolution is only computed once, see get_resampled_nii.
+
+    Parameters
+    ----------
+    reference_brain : str
+        Niftii file containing the reference brain
+        (with zero for background, and !=0 for brain).
+    spatial_resolution : int
+        Resolution of the grid in mm.
+    cache_dir : str
+        Directory to cache the resampled reference brain in.
+    out_file : str
+        File to save the resampled reference brain to. Should be passed for
+        subject specific reference brains.
+
+    Returns
+    -------
+    reference_brain_resampled : str
+        Reference brain at the requested resolution.
+    coords : numpy.ndarray
+        (3, ndipoles) coordinates (in mm) of the grid.
+    """
+    reference_brain_resampled = get_resampled_nii(
+        reference_brain, spatial_resolution, cache_dir=cache_dir, out_file=out_file
+    )
+    coords = _cached_mmpointcloud(
+        reference_brain_resampled, op.getmtime(reference_brain_resampled)
+    )
+    return reference_brain_resampled, coords.copy()
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_mmpointcloud(nii_mask, mtime):
+    # mtime is part of the key so the cache is invalidated if the file is
+    # rewritten
+    pc, _ = niimask2mmpointcloud(nii_mask)
+    return pc
+
+
 def niimask2indexpointcloud(nii_fname, volindex=None):
     """Takes in a nii.gz mask file name (which equals zero for background and
     neq zero for the mask) and returns the mask as a 3 x npoints point cloud.
@@ -4,7 +4,9 @@
 
 # Authors: Chetan Gohil <chetan.gohil@psych.ox.ac.uk>
 
+import os
 import pickle
+import tempfile
 import os.path as op
 from pathlib import Path
 
@@ -13,10 +15,22 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from tqdm import trange
 
+from osl.utils.cache import hash_file, hash_object, get_package_versions
 from osl.utils.logger import log_or_print
-
-
-def find_flips(cov, template_cov, n_embeddings, n_init, n_iter, max_flips, logger=None):
+from osl.utils.parallel import process_parallel
+
+
+def find_flips(
+    cov,
+    template_cov,
+    n_embeddings,
+    n_init,
+    n_iter,
+    max_flips,
+    logger=None,
+    n_jobs=1,
+    random_state=None,
+):
     """Find channels to flip.
 
     We search for the channels to flip by randomly flipping them and saving the
@@ -38,6 +52,12 @@ def find_flips(cov, template_cov, n_embeddings, n_init, n_iter, max_flips, logge
         Maximum number of channels to flip in an iteration.
     logger : logging.getLogger
         Logger.
+    n_jobs : int
+        Number of initializations to run in parallel processes.
+    random_state : int
+        Seed for the random flips. Each initialization gets its own seed
+        derived from this, so the result doesn't depend on n_jobs. If None
+        and n_jobs=1, numpy's global random state is used.
 
     Returns
     -------
@@ -60,34 +80,45 @@ def find_flips(cov, template_cov, n_embeddings, n_init, n_iter, max_flips, logge
             f"max_flips ({max_flips}) must be less than the number of channels ({n_channels})"
         )
 
+    # Sums needed to calculate the correlation between the flipped covariance
+    # and template covariance without building the flipped covariance
+    flip_sums = _get_flip_sums(cov, template_cov, n_embeddings)
+
+    # Calculate the evaluation metric before sign flipping
+    unflipped_metric = _flip_correlation(
+        flip_sums, *_get_flip_state(flip_sums, np.ones(n_channels))[2:]
+    )
+    log_or_print(f"init 0, unflipped metric: {unflipped_metric}", logger)
+
+    # Seeds for each initialization
+    if random_state is None and n_jobs == 1:
+        seeds = [None] * n_init
+    else:
+        seeds = np.random.SeedSequence(random_state).spawn(n_init)
+
+    # Randomly permute the sign of different channels starting from no flips
+    kwargs = {"flip_sums": flip_sums, "n_iter": n_iter, "max_flips": max_flips}
+    if n_jobs == 1:
+        results = [
+            _find_flips_init(seed, use_tqdm=logger is None, **kwargs)
+            for seed in seeds
+        ]
+    else:
+        results = process_parallel(
+            _find_flips_init,
+            [[seed] for seed in seeds],
+            n_jobs=n_jobs,
+            func_kwargs=kwargs,
+        )
+        if any(result is False for result in results):
+            raise RuntimeError("sign flipping failed")
+
     # Find the best channels to flip
     best_flips = np.ones(n_channels)
     best_metric = 0
     metrics = []
-    for n in range(n_init):
-
-        # Reset the flips and calculate the evaluation metric before sign flipping
-        flips = np.ones(n_channels)
-        metric = covariance_matrix_correlation(cov, template_cov, n_embeddings)
-        metrics.append(metric)
-        if n == 0:
-            log_or_print(f"init {n}, unflipped metric: {metric}", logger)
-
-        # Randomly permute the sign of different channels and calculate the metric
-        if logger is None:
-            iterator = trange(n_iter, desc="sign flipping", ncols=98)
-        else:
-            iterator = range(n_iter)
-        for j in iterator:
-            new_flips = randomly_flip(flips, max_flips)
-            new_cov = apply_flips_to_covariance(cov, new_flips, n_embeddings)
-            new_metric = covariance_matrix_correlation(
-                new_cov, template_cov, n_embeddings
-            )
-            if new_metric > metric:
-                # We've found an improved solution, let's save it
-                flips = new_flips
-                metric = new_metric
+    for n, (flips, metric) in enumerate(results):
+        metrics.append(unflipped_metric)
 
         # Update best_flips if this was the best init
         if metric > best_metric:
@@ -101,8 +132,155 @@ def find_flips(cov, template_cov, n_embeddings, n_init, n_iter, max_flips, logge
     return best_flips, metrics
 
 
+def _find_flips_init(seed, flip_sums, n_iter, max_flips, use_tqdm=False):
+    """Run one initialization of the sign flipping search.
+
+    Parameters
+    ----------
+    seed : numpy.random.SeedSequence
+        Seed for the random flips. If None, numpy's global random state is used.
+    flip_sums : dict
+        See _get_flip_sums.
+    n_iter : int
+        Number of sign flipping iterations.
+    max_flips : int
+        Maximum number of channels to flip in an iteration.
+    use_tqdm : bool
+        Should we display a tqdm progress bar?
+
+    Returns
+    -------
+    flips : numpy.ndarray
+        Best flips found.
+    metric : float
+        Evaluation metric for the best flips.
+    """
+    rng = None if seed is None else np.random.default_rng(seed)
+
+    # Start with no flips
+    flips = np.ones(flip_sums["cov"].shape[0])
+    state = _get_flip_state(flip_sums, flips)
+    metric = _flip_correlation(flip_sums, *state[2:])
+
+    if use_tqdm:
+        iterator = trange(n_iter, desc="sign flipping", ncols=98)
+    else:
+        iterator = range(n_iter)
+    for j in iterator:
+        new_flips = randomly_flip(flips, max_flips, rng=rng)
+        new_metric = _flip_correlation(
+            flip_sums, *_update_flip_sums(flip_sums, state, flips, new_flips)
+        )
+        if new_metric > metric:
+            # We've found an improved solution, let's save it
+            flips = new_flips
+            metric = new_metric
+            state = _get_flip_state(flip_sums, flips)
+
+    return flips, metric
+
+
+def _get_flip_sums(cov, template_cov, n_embeddings):
+    """Get the sums needed to calculate the correlation between a flipped
+    covariance and the template covariance.
+
+    The correlation is calculated between the upper triangles (offset by
+    n_embeddings) of the covariances, see covariance_matrix_correlation.
+    Flipping a channel only changes the sign of the elements in its rows and
+    columns, so we sum the elements of each pair of channels once. The
+    correlation for any flips can then be calculated from these sums.
+
+    Parameters
+    ----------
+    cov : numpy.ndarray
+        Covariance matrix we would like to sign flip.
+    template_cov : numpy.ndarray
+        Template covariance matrix.
+    n_embeddings : int
+        Number of time-delay embeddings.
+
+    Returns
+    -------
+    flip_sums : dict
+        Sums of the covariance ('cov') and covariance times template ('prod')
+        elements for each pair of channels, with the pairs of the same channel
+        (which never change sign) summed separately.
+    """
+    n_channels = cov.shape[-1] // n_embeddings
+    mask = np.triu(np.ones(cov.shape, dtype=bool), k=n_embeddings)
+    x = np.where(mask, cov, 0)
+    y = np.where(mask, template_cov, 0)
+
+    flip_sums = {
+        "n": np.sum(mask),
+        "sum_sq": np.sum(x * x),
+        "template_sum": np.sum(y),
+        "template_sum_sq": np.sum(y * y),
+    }
+    for name, values in [("cov", x), ("prod", x * y)]:
+        sums = values.reshape(n_channels, n_embeddings, n_channels, n_embeddings)
+        sums = sums.sum(axis=(1, 3))
+        flip_sums[name + "_diag"] = np.trace(sums)
+        sums = sums + sums.T
+        np.fill_diagonal(sums, 0)
+        flip_sums[name] = sums
+
+    return flip_sums
+
+
+def _get_flip_state(flip_sums, flips):
+    """Get the flipped pair sums for some flips.
+
+    Returns
+    -------
+    state : tuple
+        The flipped sums for each channel (with the flips of the channel
+        itself not applied), the flipped covariance sum and flipped
+        covariance times template sum.
+    """
+    cov_rows = flip_sums["cov"] @ flips
+    prod_rows = flip_sums["prod"] @ flips
+    cov_sum = flip_sums["cov_diag"] + flips @ cov_rows / 2
+    prod_sum = flip_sums["prod_diag"] + flips @ prod_rows / 2
+    return cov_rows, prod_rows, cov_sum, prod_sum
+
+
+def _update_flip_sums(flip_sums, state, flips, new_flips):
+    """Update the flipped sums for a change in flips.
+
+    Only the pairs with one channel that's changed sign change, so this is
+    O(k^2) for k changed channels.
+    """
+    cov_rows, prod_rows, cov_sum, prod_sum = state
+    k = np.flatnonzero(new_flips != flips)
+    if len(k) == 0:
+        return cov_sum, prod_sum
+    sk = flips[k]
+    cov_sum -= 2 * (sk @ cov_rows[k] - sk @ flip_sums["cov"][np.ix_(k, k)] @ sk)
+    prod_sum -= 2 * (sk @ prod_rows[k] - sk @ flip_sums["prod"][np.ix_(k, k)] @ sk)
+    return cov_sum, prod_sum
+
+
+def _flip_correlation(flip_sums, cov_sum, prod_sum):
+    """Pearson correlation between the flipped covariance and template."""
+    n = flip_sums["n"]
+    template_sum = flip_sums["template_sum"]
+    numerator = n * prod_sum - cov_sum * template_sum
+    denominator = np.sqrt(
+        (n * flip_sums["sum_sq"] - cov_sum**2)
+        * (n * flip_sums["template_sum_sq"] - template_sum**2)
+    )
+    return numerator / denominator
+
+
 def load_covariances(
-    parc_files, n_embeddings=1, standardize=True, loader=np.load, use_tqdm=True
+    parc_files,
+    n_embeddings=1,
+    standardize=True,
+    loader=np.load,
+    use_tqdm=True,
+    chunk_size=100000,
+    use_cache=False,
 ):
     """Loads data and returns its covariance matrix.
 
@@ -118,6 +296,12 @@ def load_covariances(
         Custom function to load parcellated data files.
     use_tqdm : bool
         Should we display a tqdm progress bar?
+    chunk_size : int
+        Number of samples to process at a time, see time_embedded_covariance.
+    use_cache : bool
+        Should we save the covariances alongside the parcellated data files
+        and reuse them if the file, n_embeddings and standardize haven't
+        changed? The covariance of <name>.npy is saved to <name>_cov.npz.
 
     Returns
     -------
@@ -130,21 +314,153 @@ def load_covariances(
     else:
         iterator = range(len(parc_files))
     for i in iterator:
+        if use_cache:
+            cache_file = op.splitext(parc_files[i])[0] + "_cov.npz"
+            key = hash_object(
+                {
+                    "parc_file": hash_file(parc_files[i]),
+                    "n_embeddings": n_embeddings,
+                    "standardize": standardize,
+                    "versions": get_package_versions(("osl", "numpy")),
+                }
+            )
+            cov = _load_cached_covariance(cache_file, key)
+            if cov is not None:
+                covs.append(cov)
+                continue
+
         # Load data
         x = loader(parc_files[i])
 
-        # Prepare
-        x = time_embed(x, n_embeddings)
-        if standardize:
-            x = std_data(x)
-
         # Calculate the covariance
-        covs.append(np.cov(x, rowvar=False))
+        cov = time_embedded_covariance(x, n_embeddings, standardize, chunk_size)
+        covs.append(cov)
+
+        if use_cache:
+            _save_cached_covariance(cache_file, key, cov)
 
     return np.array(covs)
 
 
-def find_template_subject(covs, diag_offset=0):
+def _load_cached_covariance(cache_file, key):
+    """Load a covariance saved by load_covariances.
+
+    Returns None if there isn't a covariance saved with this key.
+    """
+    try:
+        with np.load(cache_file) as cache:
+            if str(cache["key"]) == key:
+                return cache["cov"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def _save_cached_covariance(cache_file, key, cov):
+    """Save a covariance for load_covariances."""
+    # Write to a temporary file first so other processes never read a
+    # partially written file
+    fd, tmp_file = tempfile.mkstemp(suffix=".npz", dir=op.dirname(cache_file))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, cov=cov, key=key)
+        os.replace(tmp_file, cache_file)
+    finally:
+        if op.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def time_embedded_covariance(x, n_embeddings, standardize=True, chunk_size=100000):
+    """Covariance of time-delay embedded data.
+
+    This gives the same result as::
+
+        y = time_embed(x, n_embeddings)
+        if standardize:
+            y = std_data(y)
+        np.cov(y, rowvar=False)
+
+    without creating the time-delay embedded data. Each element of the
+    covariance is a cross-product of the data with a lagged copy of itself, so
+    we sum the cross-products for each lag (in chunks of samples), then correct
+    for the samples dropped at the edges by the embedding.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Time series data. Shape must be (n_samples, n_channels).
+    n_embeddings : int
+        Number of time-delay embeddings. Must be an odd number.
+    standardize : bool
+        Should we standardize the time-delay embedded data?
+    chunk_size : int
+        Number of samples to process at a time.
+
+    Returns
+    -------
+    cov : numpy.ndarray
+        Covariance matrix. Shape is (n_channels * n_embeddings,
+        n_channels * n_embeddings).
+    """
+    if n_embeddings % 2 == 0:
+        raise ValueError("n_embeddings must be an odd number.")
+
+    n_samples, n_channels = x.shape
+    n_lags = n_embeddings
+    n_embedded_samples = n_samples - (n_lags - 1)
+
+    # Removing the mean doesn't change the covariance but avoids losing
+    # precision when we subtract the mean from the cross-products
+    mean = np.mean(x, axis=0)
+
+    # Sum of x[t].T @ x[t + lag] for each lag
+    total = np.zeros(n_channels)
+    lagged_products = np.zeros([n_lags, n_channels, n_channels])
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        x_chunk = x[start:stop] - mean
+        total += np.sum(x_chunk, axis=0)
+        x_lagged = x[start : min(stop + n_lags - 1, n_samples)] - mean
+        for lag in range(n_lags):
+            n = min(stop, n_samples - lag) - start
+            if n > 0:
+                lagged_products[lag] += x_chunk[:n].T @ x_lagged[lag : lag + n]
+
+    # Samples at the edges which are dropped by the embedding
+    head = x[: n_lags - 1] - mean
+    tail = x[n_embedded_samples:] - mean
+
+    # The embedded channel (c, e) is channel c lagged by n_lags - 1 - e
+    # samples, i.e. x[t + n_lags - 1 - e, c] for t in range(n_embedded_samples)
+    sums = np.empty([n_channels, n_lags])
+    products = np.empty([n_channels, n_lags, n_channels, n_lags])
+    for lag1 in range(n_lags):
+        e1 = n_lags - 1 - lag1
+        sums[:, e1] = total - np.sum(head[:lag1], axis=0) - np.sum(tail[lag1:], axis=0)
+        for lag2 in range(lag1, n_lags):
+            e2 = n_lags - 1 - lag2
+            lag = lag2 - lag1
+            product = (
+                lagged_products[lag]
+                - head[:lag1].T @ head[lag : lag1 + lag]
+                - tail[lag1 : n_lags - 1 - lag].T @ tail[lag1 + lag :]
+            )
+            products[:, e1, :, e2] = product
+            products[:, e2, :, e1] = product.T
+
+    sums = sums.reshape(-1)
+    products = products.reshape(n_channels * n_lags, n_channels * n_lags)
+    means = sums / n_embedded_samples
+    cov = products - n_embedded_samples * np.outer(means, means)
+
+    if standardize:
+        std = np.sqrt(np.diag(cov) / n_embedded_samples)
+        cov /= np.outer(std, std)
+
+    return cov / (n_embedded_samples - 1)
+
+
+def find_template_subject(covs, diag_offset=0, chunk_size=10000):
     """Find a good template subject to use to align dipoles.
 
     We select the median subject after calculating the similarity between
@@ -158,24 +474,45 @@ def find_template_subject(covs, diag_offset=0):
     diag_offset : int
         Offset to apply when getting the upper triangle of the covariance matrix
         before calculating the correlation between covariances.
+    chunk_size : int
+        Number of elements of the upper triangle to process at a time.
 
     Returns
     -------
     index : int
         Index for the template subject.
     """
-    # Calculate the similarity between subjects
+    # The similarity between two subjects is the correlation between the
+    # (absolute value of the) upper triangles of their covariances, i.e. the
+    # dot product of the standardized upper triangles, z. We only need the
+    # total similarity of each subject to all other subjects, which is
+    # z_i . sum_j(z_j) - 1, so we never need to compare each pair of subjects
     n_subjects = len(covs)
-    metric = np.zeros([n_subjects, n_subjects])
-    for i in trange(n_subjects, desc="Comparing subjects", ncols=98):
-        for j in range(i + 1, n_subjects):
-            metric[i, j] = covariance_matrix_correlation(
-                covs[i], covs[j], diag_offset, mode="abs"
-            )
-            metric[j, i] = metric[i, j]
+    i, j = np.triu_indices(covs.shape[-1], k=diag_offset)
+    n_features = len(i)
+    chunks = [
+        (i[start : start + chunk_size], j[start : start + chunk_size])
+        for start in range(0, n_features, chunk_size)
+    ]
+
+    # Mean and standard deviation of each subject's upper triangle
+    sums = np.zeros(n_subjects)
+    sum_sqs = np.zeros(n_subjects)
+    for ii, jj in chunks:
+        x = np.abs(covs[:, ii, jj])
+        sums += np.sum(x, axis=1)
+        sum_sqs += np.sum(x * x, axis=1)
+    means = sums / n_features
+    norms = np.sqrt(sum_sqs - n_features * means**2)
+
+    # Calculate the similarity between subjects
+    metric_sum = np.zeros(n_subjects)
+    for ii, jj in chunks:
+        z = (np.abs(covs[:, ii, jj]) - means[:, np.newaxis]) / norms[:, np.newaxis]
+        metric_sum += z @ np.sum(z, axis=0)
+    metric_sum -= 1
 
     # Get the median subject
-    metric_sum = np.sum(metric, axis=1)
     argmedian = np.argsort(metric_sum)[len(metric_sum) // 2]
 
     return argmedian
@@ -213,7 +550,7 @@ def covariance_matrix_correlation(M1, M2, diag_offset=0, mode=None):
     return np.corrcoef([M1, M2])[0, 1]
 
 
-def randomly_flip(flips, max_flips):
+def randomly_flip(flips, max_flips, rng=None):
     """Randomly flips some channels.
 
     Parameters
@@ -222,19 +559,23 @@ def randomly_flip(flips, max_flips):
         Vector of 1s and -1s indicating which channels to flip.
     max_flips : int
         Maximum number of channels to change in this function.
+    rng : numpy.random.Generator
+        Random number generator. If None, numpy's global random state is used.
 
     Returns
     -------
     new_flips : numpy.ndarray
         Vector of 1s and -1s indicating which channels to flip.
     """
+    if rng is None:
+        rng = np.random
 
     # Select the number of channels to flip
-    n_channels_to_flip = np.random.choice(max_flips, size=1)
+    n_channels_to_flip = rng.choice(max_flips, size=1)
 
     # Select the channels to flip
     n_channels = flips.shape[0]
-    random_channels_to_flip = np.random.choice(
+    random_channels_to_flip = rng.choice(
         n_channels, size=n_channels_to_flip, replace=False
     )
     new_flips = np.copy(flips)
@@ -270,7 +611,29 @@ def apply_flips_to_covariance(cov, flips, n_embeddings=1):
     return cov * flips
 
 
-def apply_flips(src_dir, subject, flips, logger=None):
+def get_parc_file(src_dir, subject, band=None):
+    """Get the path to the parcellated data of a subject.
+
+    Parameters
+    ----------
+    src_dir : str
+        Path to source reconstruction directory.
+    subject : str
+        Subject name/id.
+    band : str
+        Name of the frequency band if beamform_and_parcellate was run with
+        multiple bands.
+
+    Returns
+    -------
+    parc_file : str
+        src_dir/subject/rhino/parc.npy, or parc_<band>.npy.
+    """
+    name = "parc.npy" if band is None else f"parc_{band}.npy"
+    return op.join(src_dir, subject, "rhino", name)
+
+
+def apply_flips(src_dir, subject, flips, logger=None, band=None):
     """Saves the sign flipped data.
 
     Parameters
@@ -283,22 +646,27 @@ def apply_flips(src_dir, subject, flips, logger=None):
         Flips to apply.
     logger : logging.getLogger
         Logger.
+    band : str
+        Name of the frequency band, see get_parc_file. The flipped data is
+        saved to src_dir/subject/sflip_parc.npy, or sflip_parc_<band>.npy.
     """
     # Load parcellated data
-    parc_file = op.join(src_dir, subject, "rhino", "parc.npy")
+    parc_file = get_parc_file(src_dir, subject, band)
     data = np.load(parc_file)
 
     # Flip the sign of the channels
     flipped_data = data * flips[np.newaxis, ...]
 
     # Save
-    outfile = op.join(src_dir, subject, "sflip_parc.npy")
+    outfile = op.join(
+        src_dir, subject, "sflip_parc.npy" if band is None else f"sflip_parc_{band}.npy"
+    )
     log_or_print(f"saving: {outfile}", logger)
     np.save(outfile, flipped_data)
 
 
 def plot_sign_flipping(
-    src_dir, subject, cov, template_cov, n_embeddings, flips, metrics
+    src_dir, subject, cov, template_cov, n_embeddings, flips, metrics, band=None
 ):
     """Plots the results of the sign flipping.
 
@@ -321,8 +689,17 @@ def plot_sign_flipping(
         a channels. Shape must be (n_channels,).
     metrics : numpy.ndarray
         Metrics calculated during sign flipping.
+    band : str
+        Name of the frequency band, see get_parc_file.
     """
-    plot_filename = op.join(src_dir, "report", subject, "sign_flipping_results.png")
+    plot_filename = op.join(
+        src_dir,
+        "report",
+        subject,
+        "sign_flipping_results.png"
+        if band is None
+        else f"sign_flipping_results_{band}.png",
+    )
 
     # Create a figure
     fig, ax = plt.subplots(nrows=1, ncols=2, figsize=(6, 3))
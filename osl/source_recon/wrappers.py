@@ -17,13 +17,17 @@ must also conform to this.
 
 import logging
 import os.path as op
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from glob import glob
 
 import numpy as np
 
 from . import rhino, beamforming, parcellation, sign_flipping
-from ..utils import validate_outdir
+from ..utils import validate_outdir, parallel
 
 
 logger = logging.getLogger(__name__)
@@ -87,6 +91,7 @@ def coregister(
     use_headshape,
     model,
     eeg=False,
+    n_jobs=1,
 ):
     """Wrapper for coregistration.
 
@@ -112,6 +117,8 @@ def coregister(
         Forward model to use.
     eeg : bool
         Are we using EEG channels in the source reconstruction?
+    n_jobs : int
+        Number of jobs to compute the forward model with.
     """
     # Compute surface
     rhino.compute_surfaces(
@@ -139,6 +146,7 @@ def coregister(
         model=model,
         eeg=eeg,
         logger=logger,
+        n_jobs=n_jobs,
     )
 
 
@@ -158,6 +166,9 @@ def beamform_and_parcellate(
     parcellation_file,
     method,
     orthogonalisation,
+    fused=False,
+    n_jobs=1,
+    chunk_size=50000,
 ):
     """Wrapper function for beamforming and parcellation.
 
@@ -177,97 +188,196 @@ def beamform_and_parcellate(
         Channel types to use in beamforming.
     rank : dict
         Keys should be the channel types and the value should be the rank to use.
-    freq_range : list
+    freq_range : list or dict
         Lower and upper band to bandpass filter before beamforming. If None,
-        no filtering is done.
+        no filtering is done. Can also be a list of bands, e.g.
+        [[1, 4], [4, 8]], or a dict of named bands, e.g.
+        {'delta': [1, 4], 'theta': [4, 8]}. Multiple bands are beamformed and
+        parcellated in one run and saved to rhino/parc_<band>.npy, where
+        <band> is the name or e.g. '1-4Hz'.
     parcellation_file : str
         Path to the parcellation file to use.
     method : str
         Method to use in the parcellation.
     orthogonalisation : bool
         Should we do orthogonalisation?
+    fused : bool
+        Should we combine the beamformer, MNI resampling and parcellation into
+        a single sensor to parcel projection? This gives the same result but
+        never computes the voxel time courses, which uses much less memory.
+    n_jobs : int
+        Number of frequency bands to parcellate in parallel threads. -1 uses
+        all available CPUs. The filtering and beamforming use MNE, which isn't
+        thread safe, so are done one band at a time (while previous bands
+        are parcellated). At most n_jobs bands are held in memory at once.
+    chunk_size : int
+        Number of time points to read from the sensor data at a time when
+        fused=True and there is a single band.
     """
+    from mne import read_forward_solution
     from ..preprocessing import import_data
 
-    # Load preprocessed data
-    preproc_data = import_data(preproc_file)
-    preproc_data.pick(chantypes)
-
-    if freq_range is not None:
-        # Bandpass filter
-        logger.info("bandpass filtering: {}-{} Hz".format(freq_range[0], freq_range[1]))
-        preproc_data = preproc_data.filter(
-            l_freq=freq_range[0],
-            h_freq=freq_range[1],
-            method="iir",
-            iir_params={"order": 5, "ftype": "butter"},
-        )
-
     # Validation
     if isinstance(chantypes, str):
         chantypes = [chantypes]
 
-    # Create beamforming filters
-    logger.info("beamforming.make_lcmv")
-    logger.info(f"chantypes: {chantypes}")
-    logger.info(f"rank: {rank}")
-    filters = beamforming.make_lcmv(
-        subjects_dir=src_dir,
-        subject=subject,
-        data=preproc_data,
-        chantypes=chantypes,
-        weight_norm="nai",
-        rank=rank,
-        logger=logger,
-        save_figs=True,
-    )
+    if orthogonalisation not in [None, "symmetric"]:
+        raise NotImplementedError(orthogonalisation)
 
-    # Apply beamforming
-    logger.info("beamforming.apply_lcmv_raw")
-    src_data = beamforming.apply_lcmv_raw(preproc_data, filters)
-    src_ts_mni, _, src_coords_mni, _ = beamforming.transform_recon_timeseries(
-        subjects_dir=src_dir,
-        subject=subject,
-        recon_timeseries=src_data.data,
-    )
+    bands = _get_freq_bands(freq_range)
 
-    # Parcellation
-    logger.info("parcellation")
-    logger.info(parcellation_file)
-    p = parcellation.Parcellation(parcellation_file)
-    p.parcellate(
-        voxel_timeseries=src_ts_mni,
-        voxel_coords=src_coords_mni,
-        method=method,
-        logger=logger,
-    )
-    parcel_ts = p.parcel_timeseries["data"]
+    # Load preprocessed data
+    preproc_data = import_data(preproc_file)
+    preproc_data.pick(chantypes)
 
-    # Orthogonalisation
-    if orthogonalisation not in [None, "symmetric"]:
-        raise NotImplementedError(orthogonalisation)
+    # The forward model and resampling to MNI space are the same for every band
+    fwd = read_forward_solution(
+        rhino.get_coreg_filenames(src_dir, subject)["forward_model_file"]
+    )
+    mapping = beamforming.get_recon_mapping(subjects_dir=src_dir, subject=subject)
 
-    if orthogonalisation == "symmetric":
-        logger.info(f"{orthogonalisation} orthogonalisation")
-        parcel_ts = parcellation.symmetric_orthogonalise(
-            parcel_ts, maintain_magnitudes=True
+    def _beamform_band(band):
+        # MNE functions aren't thread safe, so this is always run in the main
+        # thread. Returns the inputs for _parcellate_band.
+        if len(bands) == 1:
+            data = preproc_data
+        else:
+            data = preproc_data.copy()
+
+        if band is not None:
+            # Bandpass filter
+            logger.info("bandpass filtering: {}-{} Hz".format(band[0], band[1]))
+            data = data.filter(
+                l_freq=band[0],
+                h_freq=band[1],
+                method="iir",
+                iir_params={"order": 5, "ftype": "butter"},
+            )
+
+        # Create beamforming filters
+        logger.info("beamforming.make_lcmv")
+        logger.info(f"chantypes: {chantypes}")
+        logger.info(f"rank: {rank}")
+        filters = beamforming.make_lcmv(
+            subjects_dir=src_dir,
+            subject=subject,
+            data=data,
+            chantypes=chantypes,
+            weight_norm="nai",
+            rank=rank,
+            logger=logger,
+            save_figs=len(bands) == 1,
+            fwd=fwd,
         )
 
-    # Save parcellated data
-    parc_data_file = src_dir / subject / "rhino/parc.npy"
-    logger.info(f"saving {parc_data_file}")
-    np.save(parc_data_file, parcel_ts.T)
+        if fused:
+            # Every step is linear, so we can apply the beamformer weights
+            # resampled to MNI space and parcel weights to the sensor data in
+            # one go
+            logger.info("beamforming.get_lcmv_weights")
+            weights, sel = beamforming.get_lcmv_weights(data, filters)
+            voxel_projection = beamforming.apply_recon_mapping(weights, mapping)
+            if len(bands) == 1:
+                # Read the sensor data in chunks while parcellating
+                sensor_data = beamforming.LazySensorData(data, sel)
+            else:
+                # The filtered data is a copy in memory, so we get the good
+                # samples now rather than reading the Raw in another thread
+                sensor_data = data.get_data(picks=sel, reject_by_annotation="omit")
+            return sensor_data, voxel_projection
+
+        # Apply beamforming
+        logger.info("beamforming.apply_lcmv_raw")
+        src_data = beamforming.apply_lcmv_raw(data, filters)
+        return beamforming.apply_recon_mapping(src_data.data, mapping), None
+
+    def _parcellate_band(name, data, voxel_projection):
+        # Only uses numpy, so can be run in parallel threads
+        p = parcellation.Parcellation(parcellation_file)
+
+        logger.info("parcellation")
+        logger.info(parcellation_file)
+        if fused:
+            p.parcellate_sensor_data(
+                sensor_data=data,
+                voxel_projection=voxel_projection,
+                voxel_coords=mapping["coords"],
+                method=method,
+                logger=logger,
+                chunk_size=chunk_size,
+            )
+        else:
+            p.parcellate(
+                voxel_timeseries=data,
+                voxel_coords=mapping["coords"],
+                method=method,
+                logger=logger,
+            )
+
+        parcel_ts = p.parcel_timeseries["data"]
+
+        # Orthogonalisation
+        if orthogonalisation == "symmetric":
+            logger.info(f"{orthogonalisation} orthogonalisation")
+            parcel_ts = parcellation.symmetric_orthogonalise(
+                parcel_ts, maintain_magnitudes=True
+            )
+
+        # Save parcellated data
+        if name is None:
+            parc_data_file = src_dir / subject / "rhino/parc.npy"
+        else:
+            parc_data_file = src_dir / subject / f"rhino/parc_{name}.npy"
+        logger.info(f"saving {parc_data_file}")
+        np.save(parc_data_file, parcel_ts.T)
+
+    n_jobs = parallel.get_n_jobs(n_jobs)
+    if n_jobs == 1 or len(bands) == 1:
+        for name, band in bands:
+            _parcellate_band(name, *_beamform_band(band))
+    else:
+        # Beamform the next band while previous bands are parcellated. At
+        # most n_jobs bands are held in memory, so we wait for the oldest
+        # band to finish before beamforming another
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = deque()
+            for name, band in bands:
+                if len(futures) >= n_jobs:
+                    futures.popleft().result()
+                futures.append(
+                    executor.submit(_parcellate_band, name, *_beamform_band(band))
+                )
+            for future in futures:
+                future.result()
+
+
+def _get_freq_bands(freq_range):
+    """Get a list of (name, band) from the freq_range passed to
+    beamform_and_parcellate.
+
+    The name is None if a single band (or None) was passed.
+    """
+    if isinstance(freq_range, dict):
+        return list(freq_range.items())
+
+    if freq_range is None or not isinstance(freq_range[0], (list, tuple)):
+        return [(None, freq_range)]
+
+    return [("{}-{}Hz".format(band[0], band[1]), band) for band in freq_range]
 
 
 # ------------------------------------------------------------------
 # Sign flipping wrappers
 
 
-def find_template_subject(src_dir, subjects, n_embeddings=1, standardize=True):
+def find_template_subject(
+    src_dir, subjects, n_embeddings=1, standardize=True, band=None
+):
     """Function to find a good subject to align other subjects to in the sign flipping.
 
     Note, this function expects parcellated data to exist in the following location:
-    src_dir/*/rhino/parc.npy, the * here represents subject directories.
+    src_dir/*/rhino/parc.npy (or parc_<band>.npy), the * here represents subject
+    directories.
 
     Parameters
     ----------
@@ -279,6 +389,10 @@ def find_template_subject(src_dir, subjects, n_embeddings=1, standardize=True):
         Number of time-delay embeddings that we will use (if we are doing any).
     standardize : bool
         Should we standardize (z-transform) the data before sign flipping?
+    band : str
+        Frequency band to use if beamform_and_parcellate was run with multiple
+        bands, i.e. the name of the band in rhino/parc_<band>.npy. If None,
+        rhino/parc.npy is used.
 
     Returns
     -------
@@ -290,7 +404,7 @@ def find_template_subject(src_dir, subjects, n_embeddings=1, standardize=True):
     # Get the parcellated data files
     parc_files = []
     for subject in subjects:
-        parc_file = op.join(src_dir, subject, "rhino", "parc.npy")
+        parc_file = sign_flipping.get_parc_file(src_dir, subject, band)
         if Path(parc_file).exists():
             parc_files.append(parc_file)
         else:
@@ -305,7 +419,9 @@ def find_template_subject(src_dir, subjects, n_embeddings=1, standardize=True):
         )
 
     # Calculate the covariance matrix of each subject
-    covs = sign_flipping.load_covariances(parc_files, n_embeddings, standardize)
+    covs = sign_flipping.load_covariances(
+        parc_files, n_embeddings, standardize, use_cache=True
+    )
 
     # Find a subject to use as a template
     template_index = sign_flipping.find_template_subject(covs, n_embeddings)
@@ -327,6 +443,9 @@ def fix_sign_ambiguity(
     n_init,
     n_iter,
     max_flips,
+    n_jobs=1,
+    random_state=None,
+    band=None,
 ):
     """Wrapper function for fixing the dipole sign ambiguity.
 
@@ -354,6 +473,14 @@ def fix_sign_ambiguity(
         Number of sign flipping iterations per subject to perform.
     max_flips : int
         Maximum number of channels to flip in an iteration.
+    n_jobs : int
+        Number of initializations to run in parallel.
+    random_state : int
+        Seed for the random flips.
+    band : str
+        Frequency band to use if beamform_and_parcellate was run with multiple
+        bands, i.e. the name of the band in rhino/parc_<band>.npy. If None,
+        rhino/parc.npy is used.
     """
     logger.info("fix_sign_ambiguity")
     logger.info(f"using template: {template}")
@@ -361,25 +488,200 @@ def fix_sign_ambiguity(
     # Get path to the parcellated data file for this subject and the template
     parc_files = []
     for sub in [subject, template]:
-        parc_file = op.join(src_dir, sub, "rhino", "parc.npy")
+        parc_file = sign_flipping.get_parc_file(src_dir, sub, band)
         if not Path(parc_file).exists():
             raise ValueError(f"{parc_file} not found")
         parc_files.append(parc_file)
 
     # Calculate the covariance of this subject and the template
     [cov, template_cov] = sign_flipping.load_covariances(
-        parc_files, n_embeddings, standardize, use_tqdm=False
+        parc_files, n_embeddings, standardize, use_tqdm=False, use_cache=True
     )
 
     # Find the channels to flip
     flips, metrics = sign_flipping.find_flips(
-        cov, template_cov, n_embeddings, n_init, n_iter, max_flips, logger
+        cov,
+        template_cov,
+        n_embeddings,
+        n_init,
+        n_iter,
+        max_flips,
+        logger,
+        n_jobs=n_jobs,
+        random_state=random_state,
     )
 
     # Apply flips to the parcellated data
-    sign_flipping.apply_flips(src_dir, subject, flips, logger)
+    sign_flipping.apply_flips(src_dir, subject, flips, logger, band=band)
 
     # Plot a summary figure describing the sign flipping solution
     sign_flipping.plot_sign_flipping(
-        src_dir, subject, cov, template_cov, n_embeddings, flips, metrics
+        src_dir, subject, cov, template_cov, n_embeddings, flips, metrics, band=band
     )
+
+
+def fix_sign_ambiguity_group(
+    src_dir,
+    subjects,
+    template,
+    n_embeddings,
+    standardize,
+    n_init,
+    n_iter,
+    max_flips,
+    n_jobs=1,
+    random_state=None,
+    band=None,
+    n_init_jobs=1,
+):
+    """Fix the dipole sign ambiguity for a group of subjects.
+
+    This is the same as calling fix_sign_ambiguity for each subject, except
+    the template covariance is only calculated once and the subjects are
+    sign flipped in parallel.
+
+    Parameters
+    ----------
+    src_dir : str
+        Path to where to output the source reconstruction files.
+    subjects : list of str
+        Subjects to sign flip.
+    template : str
+        Template subject.
+    n_embeddings : int
+        Number of time-delay embeddings that we will use (if we are doing any).
+    standardize : bool
+        Should we standardize (z-transform) the data before sign flipping?
+    n_init : int
+        Number of initializations.
+    n_iter : int
+        Number of sign flipping iterations per subject to perform.
+    max_flips : int
+        Maximum number of channels to flip in an iteration.
+    n_jobs : int
+        Number of subjects to sign flip in parallel.
+    random_state : int
+        Seed for the random flips. Each subject gets its own seed derived from
+        this, so the result doesn't depend on n_jobs.
+    band : str
+        Frequency band to use if beamform_and_parcellate was run with multiple
+        bands, i.e. the name of the band in rhino/parc_<band>.npy. If None,
+        rhino/parc.npy is used.
+    n_init_jobs : int
+        Number of initializations to run in parallel for each subject. The
+        total number of processes used is n_jobs * n_init_jobs.
+
+    Returns
+    -------
+    summary : dict
+        Unflipped and best metric for each subject. Subjects which failed
+        have a value of None.
+    """
+    logger.info("fix_sign_ambiguity_group")
+    logger.info(f"using template: {template}")
+
+    src_dir = Path(src_dir)
+    template_parc_file = Path(sign_flipping.get_parc_file(src_dir, template, band))
+    if not template_parc_file.exists():
+        raise ValueError(f"{template_parc_file} not found")
+
+    # The template covariance is shared with the workers via a memory mapped
+    # file so it's only calculated once
+    [template_cov] = sign_flipping.load_covariances(
+        [template_parc_file],
+        n_embeddings,
+        standardize,
+        use_tqdm=False,
+        use_cache=True,
+    )
+    tmpdir = tempfile.mkdtemp(dir=src_dir)
+    template_cov_file = op.join(tmpdir, "template_cov.npy")
+    np.save(template_cov_file, template_cov)
+
+    seeds = np.random.SeedSequence(random_state).generate_state(len(subjects))
+    try:
+        results = parallel.process_parallel(
+            _fix_sign_ambiguity_subject,
+            [[subject, seed] for subject, seed in zip(subjects, seeds)],
+            n_jobs=n_jobs,
+            func_kwargs={
+                "src_dir": src_dir,
+                "template_cov_file": template_cov_file,
+                "n_embeddings": n_embeddings,
+                "standardize": standardize,
+                "n_init": n_init,
+                "n_iter": n_iter,
+                "max_flips": max_flips,
+                "band": band,
+                "n_init_jobs": n_init_jobs,
+            },
+        )
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    summary = {}
+    for subject, result in zip(subjects, results):
+        if result is False:
+            logger.error(f"{subject}: sign flipping failed")
+            summary[subject] = None
+        else:
+            logger.info(
+                f"{subject}: unflipped metric {result['unflipped_metric']:.3f}, "
+                + f"best metric {result['metric']:.3f}"
+            )
+            summary[subject] = result
+    logger.info(
+        "Sign flipped {0}/{1} subjects successfully".format(
+            sum(result is not None for result in summary.values()), len(subjects)
+        )
+    )
+
+    return summary
+
+
+def _fix_sign_ambiguity_subject(
+    subject,
+    seed,
+    src_dir,
+    template_cov_file,
+    n_embeddings,
+    standardize,
+    n_init,
+    n_iter,
+    max_flips,
+    band=None,
+    n_init_jobs=1,
+):
+    """Fix the dipole sign ambiguity for one subject in fix_sign_ambiguity_group."""
+    parc_file = sign_flipping.get_parc_file(src_dir, subject, band)
+    if not Path(parc_file).exists():
+        raise ValueError(f"{parc_file} not found")
+
+    # Calculate the covariance of this subject
+    [cov] = sign_flipping.load_covariances(
+        [parc_file], n_embeddings, standardize, use_tqdm=False, use_cache=True
+    )
+    template_cov = np.load(template_cov_file, mmap_mode="r")
+
+    # Find the channels to flip
+    flips, metrics = sign_flipping.find_flips(
+        cov,
+        template_cov,
+        n_embeddings,
+        n_init,
+        n_iter,
+        max_flips,
+        logger,
+        n_jobs=n_init_jobs,
+        random_state=seed,
+    )
+
+    # Apply flips to the parcellated data
+    sign_flipping.apply_flips(src_dir, subject, flips, logger, band=band)
+
+    # Plot a summary figure describing the sign flipping solution
+    sign_flipping.plot_sign_flipping(
+        src_dir, subject, cov, template_cov, n_embeddings, flips, metrics, band=band
+    )
+
+    return {"unflipped_metric": metrics[0], "metric": metrics[-1]}
@@ -1,5 +1,8 @@
 """Tests for passing arguments into batch preprocessing."""
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import numpy as np
@@ -54,14 +57,18 @@ class TestFunctionFinding(unittest.TestCase):
     def test_find_func_in_osl_wrapper(self):
         from ..preprocessing import find_func
         from ..preprocessing.osl_wrappers import run_osl_bad_segments, run_osl_bad_channels
+        from ..preprocessing.osl_wrappers import run_osl_bad_channels_and_segments
 
-        # Check we can find OSL wrapper functions - only 2...
+        # Check we can find OSL wrapper functions
         ff = find_func('bad_segments')
         assert(ff == run_osl_bad_segments)
 
         ff = find_func('bad_channels')
         assert(ff == run_osl_bad_channels)
 
+        ff = find_func('bad_channels_and_segments')
+        assert(ff == run_osl_bad_channels_and_segments)
+
 
     def test_find_func_from_userlist(self):
         from ..preprocessing import find_func
@@ -73,3 +80,85 @@ class TestFunctionFinding(unittest.TestCase):
 
         ff = find_func('filter', extra_funcs=[filter])
         assert(ff(1, None) == 1)
+
+
+class TestPreloadPlanning(unittest.TestCase):
+
+    def test_plan_preload(self):
+        from ..preprocessing import plan_preload
+
+        # Picks and crops can be applied before loading the data
+        config = {'preproc': [{'pick_types': {'meg': True}},
+                              {'crop': {'tmax': 10}},
+                              {'filter': {'l_freq': 1}}]}
+        assert(plan_preload(config) == 2)
+
+        # Stages on other targets need the data
+        config = {'preproc': [{'crop': {'tmax': 10, 'target': 'epochs'}}]}
+        assert(plan_preload(config) == 0)
+
+        # User functions may need the data
+        def crop(dataset, userargs):
+            return dataset
+
+        config = {'preproc': [{'crop': {'tmax': 10}}]}
+        assert(plan_preload(config) == 1)
+        assert(plan_preload(config, extra_funcs=[crop]) == 0)
+
+
+class TestMemmap(unittest.TestCase):
+
+    def setUp(self):
+        import mne
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.tmpdir, 'sub-01_raw.fif')
+        info = mne.create_info(
+            ['MEG{0:03d}'.format(i) for i in range(4)] + ['EEG{0:03d}'.format(i) for i in range(3)],
+            200.0,
+            ['mag'] * 4 + ['eeg'] * 3,
+        )
+        data = np.random.default_rng(0).normal(size=(7, 2000)) * 1e-12
+        mne.io.RawArray(data, info, verbose=False).save(self.infile, verbose=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_memmap_dir(self):
+        from unittest import mock
+        from ..preprocessing import batch, run_proc_chain
+
+        config = """
+            preproc:
+              - pick:   {picks: mag}
+              - crop:   {tmin: 1, tmax: 5}
+              - filter: {l_freq: 1, h_freq: 40}
+        """
+        memmap_dir = os.path.join(self.tmpdir, 'memmap')
+
+        # Record the state of the data when load_raw is called
+        load_raw = batch.load_raw
+        calls = []
+
+        def spy_load_raw(raw, memmap_dir=None):
+            calls.append((raw.preload, len(raw.ch_names), raw.n_times))
+            return load_raw(raw, memmap_dir)
+
+        datasets = []
+        for mdir in [None, memmap_dir]:
+            calls.clear()
+            with mock.patch.object(batch, 'load_raw', spy_load_raw):
+                dataset = run_proc_chain(
+                    config, self.infile, gen_report=False, verbose='WARNING', memmap_dir=mdir
+                )
+            raw = dataset['raw']
+
+            # The pick and crop are applied before the data is loaded
+            assert(calls == [(False, 4, 801)])
+            assert(raw.get_data().shape == (4, 801))
+            assert(isinstance(raw._data, np.memmap) == (mdir is not None))
+            datasets.append(dataset)
+
+        # The memory-mapped file is removed once it's been opened
+        assert(os.listdir(memmap_dir) == [])
+        assert(np.allclose(datasets[0]['raw'].get_data(), datasets[1]['raw'].get_data()))
@@ -0,0 +1,292 @@
+"""Tests for checkpointing and caching in batch preprocessing."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import mne
+
+
+def _make_raw(fname, n_channels=5, n_times=2000):
+    info = mne.create_info(
+        ['MEG{0:03d}'.format(i) for i in range(n_channels)], 200.0, 'mag'
+    )
+    data = np.random.default_rng(0).normal(size=(n_channels, n_times)) * 1e-12
+    raw = mne.io.RawArray(data, info, verbose=False)
+    raw.save(fname, overwrite=True, verbose=False)
+    return raw
+
+
+def double_data(dataset, userargs):
+    dataset['raw'].apply_function(lambda x: 2 * x)
+    return dataset
+
+
+def halve_data(dataset, userargs):
+    dataset['raw'].apply_function(lambda x: x / 2)
+    return dataset
+
+
+CONFIG = """
+    preproc:
+      - filter:   {l_freq: 1, h_freq: 40}
+      - crop:     {tmin: 1}
+      - resample: {sfreq: 100}
+"""
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.tmpdir, 'sub-01_raw.fif')
+        self.raw = _make_raw(self.infile)
+        self.outdir = os.path.join(self.tmpdir, 'output')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class TestCheckpoints(BatchTestCase):
+
+    def test_save_load(self):
+        from ..preprocessing.batch import save_checkpoint, load_checkpoint
+
+        checkpoint_dir = os.path.join(self.tmpdir, 'checkpoints')
+        os.makedirs(checkpoint_dir)
+        events = np.array([[10, 0, 1], [20, 0, 2]])
+        dataset = {
+            'raw': self.raw,
+            'events': events,
+            'event_id': {'a': 1, 'b': 2},
+            'epochs': None,
+            'ica': None,
+        }
+        assert(save_checkpoint(dataset, checkpoint_dir, 'key'))
+        assert(os.listdir(checkpoint_dir) == ['key'])
+
+        loaded = load_checkpoint(checkpoint_dir, 'key')
+        assert(np.array_equal(loaded['raw'].get_data(), self.raw.get_data()))
+        assert(np.array_equal(loaded['events'], events))
+        assert(loaded['event_id'] == {'a': 1, 'b': 2})
+        assert(loaded['epochs'] is None and loaded['ica'] is None)
+
+        assert(load_checkpoint(checkpoint_dir, 'other_key') is None)
+
+        # Datasets with other items can't be checkpointed
+        dataset['glm'] = None
+        assert(not save_checkpoint(dataset, checkpoint_dir, 'key2'))
+        assert(os.listdir(checkpoint_dir) == ['key'])
+
+    def test_key(self):
+        from ..preprocessing import load_config
+        from ..preprocessing.batch import get_checkpoint_key
+
+        config = load_config(CONFIG)
+        keys = [get_checkpoint_key(self.infile, config, i) for i in range(3)]
+        assert(len(set(keys)) == 3)
+
+        # Editing a later stage only invalidates checkpoints after it
+        edited = load_config(CONFIG.replace('sfreq: 100', 'sfreq: 50'))
+        assert(get_checkpoint_key(self.infile, edited, 1) == keys[1])
+        assert(get_checkpoint_key(self.infile, edited, 2) != keys[2])
+        edited = load_config(CONFIG.replace('h_freq: 40', 'h_freq: 30'))
+        assert(get_checkpoint_key(self.infile, edited, 0) != keys[0])
+
+        # as does editing a user-defined function
+        assert(get_checkpoint_key(self.infile, config, 0, [double_data]) != keys[0])
+        assert(
+            get_checkpoint_key(self.infile, config, 0, [double_data])
+            != get_checkpoint_key(self.infile, config, 0, [halve_data])
+        )
+
+        # or the input file
+        os.utime(self.infile, (0, 0))
+        assert(get_checkpoint_key(self.infile, config, 0) != keys[0])
+
+    def test_find(self):
+        from ..preprocessing import load_config
+        from ..preprocessing.batch import (
+            find_checkpoint,
+            get_checkpoint_key,
+            save_checkpoint,
+        )
+
+        checkpoint_dir = os.path.join(self.tmpdir, 'checkpoints')
+        os.makedirs(checkpoint_dir)
+        config = load_config(CONFIG)
+        assert(find_checkpoint(self.infile, config, checkpoint_dir) == (None, 0))
+
+        dataset = {'raw': self.raw, 'events': None, 'event_id': None,
+                   'epochs': None, 'ica': None}
+        for ind in [0, 1]:
+            key = get_checkpoint_key(self.infile, config, ind)
+            save_checkpoint(dataset, checkpoint_dir, key)
+
+        # The latest checkpoint is used
+        dataset, start = find_checkpoint(self.infile, config, checkpoint_dir)
+        assert(start == 2)
+        assert(np.array_equal(dataset['raw'].get_data(), self.raw.get_data()))
+
+        edited = load_config(CONFIG.replace('tmin: 1', 'tmin: 2'))
+        assert(find_checkpoint(self.infile, edited, checkpoint_dir)[1] == 1)
+        assert(find_checkpoint(self.infile, config, checkpoint_dir, [double_data])[1] == 0)
+
+    def test_run_proc_chain(self):
+        from ..preprocessing import run_proc_chain, load_config
+        from ..preprocessing.batch import get_checkpoint_dir, get_checkpoint_key
+
+        checkpoint_dir = os.path.join(self.tmpdir, 'checkpoints')
+        file_checkpoint_dir = get_checkpoint_dir(checkpoint_dir, self.infile)
+        kwargs = {'outdir': self.outdir, 'checkpoint_dir': checkpoint_dir,
+                  'gen_report': False, 'verbose': 'WARNING'}
+
+        # Fail at the last stage, only the latest checkpoint is kept
+        config = load_config(CONFIG.replace('sfreq: 100', 'sfreq: -1'))
+        assert(not run_proc_chain(config, self.infile, **kwargs))
+        assert(os.listdir(file_checkpoint_dir) == [get_checkpoint_key(self.infile, config, 1)])
+
+        # Resume, the checkpoints are removed once preprocessing succeeds
+        config = load_config(CONFIG)
+        dataset = run_proc_chain(config, self.infile, **kwargs)
+        assert(not os.path.exists(file_checkpoint_dir))
+
+        expected = run_proc_chain(config, self.infile, gen_report=False, verbose='WARNING')
+        assert(np.allclose(dataset['raw'].get_data(), expected['raw'].get_data()))
+
+        # unless we ask to keep them
+        run_proc_chain(config, self.infile, keep_checkpoints=True, overwrite=True, **kwargs)
+        assert(len(os.listdir(file_checkpoint_dir)) == 3)
+
+
+class TestBatchProfile(BatchTestCase):
+
+    def test_only_this_batch(self):
+        import csv
+        from ..preprocessing import run_proc_batch
+
+        infiles = [self.infile, os.path.join(self.tmpdir, 'sub-02_raw.fif')]
+        shutil.copy(self.infile, infiles[1])
+
+        # Stale profile from an earlier run of a file which is skipped
+        # because its output exists
+        logsdir = os.path.join(self.outdir, 'logs')
+        os.makedirs(logsdir)
+        shutil.copy(self.infile, os.path.join(self.outdir, 'sub-02_preproc_raw.fif'))
+        with open(os.path.join(logsdir, 'sub-02_preproc_profile.json'), 'w') as f:
+            f.write('[{"index": 0, "stage": "stale", "wall_time": 1, "cpu_time": 1, '
+                    '"peak_rss_delta_mb": 0}]')
+
+        flags = run_proc_batch(
+            CONFIG, infiles, outdir=self.outdir, gen_report=False, verbose='WARNING'
+        )
+        assert(flags == [True, False])
+
+        with open(os.path.join(logsdir, 'batch_profile.csv'), 'r') as f:
+            summary = {row['stage']: row for row in csv.DictReader(f)}
+        assert('stale' not in summary)
+        assert(summary['filter']['n_runs'] == '1')
+
+
+class TestCacheManifest(BatchTestCase):
+
+    def test_read_write(self):
+        from ..utils.cache import read_manifest, write_manifest
+
+        fname = os.path.join(self.tmpdir, 'cache.json')
+        assert(read_manifest(fname) is None)
+        write_manifest(fname, {'a': 1, 'b': [1, 2]})
+        assert(read_manifest(fname) == {'a': 1, 'b': [1, 2]})
+        assert(os.listdir(self.tmpdir).count('cache.json.tmp') == 0)
+
+        # Corrupt manifests are treated as missing
+        with open(fname, 'w') as f:
+            f.write('{')
+        assert(read_manifest(fname) is None)
+
+    def test_manifest(self):
+        from ..preprocessing import load_config
+        from ..preprocessing.batch import get_cache_manifest
+
+        config = load_config(CONFIG)
+        manifest = get_cache_manifest(self.infile, config)
+        assert(get_cache_manifest(self.infile, load_config(CONFIG)) == manifest)
+        assert(get_cache_manifest(self.infile, config, [double_data]) != manifest)
+
+        edited = load_config(CONFIG.replace('tmin: 1', 'tmin: 2'))
+        assert(get_cache_manifest(self.infile, edited)['config_hash'] != manifest['config_hash'])
+
+        os.utime(self.infile, (0, 0))
+        assert(get_cache_manifest(self.infile, config)['infile_hash'] != manifest['infile_hash'])
+
+    def test_run_proc_chain(self):
+        import json
+        from ..preprocessing import run_proc_chain, load_config
+        from ..utils.profiling import read_profile
+
+        fifout = os.path.join(self.outdir, 'sub-01_preproc_raw.fif')
+        cachefile = os.path.join(self.outdir, 'sub-01_cache.json')
+        profile_file = os.path.join(self.outdir, 'logs', 'sub-01_preproc_profile.json')
+        kwargs = {'outdir': self.outdir, 'gen_report': False, 'verbose': 'WARNING',
+                  'ret_dataset': False}
+
+        def is_reprocessed(config, **extra_kwargs):
+            os.utime(fifout, (0, 0))
+            assert(run_proc_chain(config, self.infile, **kwargs, **extra_kwargs))
+            return os.path.getmtime(fifout) != 0
+
+        config = load_config(CONFIG)
+        assert(run_proc_chain(config, self.infile, **kwargs))
+        assert(os.path.exists(cachefile))
+        profile = read_profile(profile_file)
+        assert(len(profile) > 0)
+
+        # Hit, the profile of the run which created the output is kept
+        assert(not is_reprocessed(config))
+        assert(read_profile(profile_file) == profile)
+        assert(run_proc_chain(config, self.infile, ret_profile=True, **kwargs) == (True, None))
+
+        # Misses
+        assert(is_reprocessed(load_config(CONFIG.replace('tmin: 1', 'tmin: 2'))))
+        assert(is_reprocessed(config, extra_funcs=[double_data]))
+        assert(is_reprocessed(config))
+        os.utime(self.infile, None)
+        assert(is_reprocessed(config))
+
+        # Output created with a different version of a package
+        with open(cachefile, 'r') as f:
+            manifest = json.load(f)
+        manifest['versions']['mne'] = '0.1'
+        with open(cachefile, 'w') as f:
+            json.dump(manifest, f)
+        assert(is_reprocessed(config))
+        assert(not is_reprocessed(config))
+
+        # Outputs without a manifest aren't overwritten
+        os.remove(cachefile)
+        assert(not run_proc_chain(config, self.infile, **kwargs))
+
+
+    def test_run_proc_batch(self):
+        import csv
+        from ..preprocessing import run_proc_batch
+
+        logsdir = os.path.join(self.outdir, 'logs')
+        kwargs = {'outdir': self.outdir, 'gen_report': False, 'verbose': 'WARNING'}
+        assert(run_proc_batch(CONFIG, [self.infile], **kwargs) == [True])
+        with open(os.path.join(logsdir, 'batch_profile.csv'), 'r') as f:
+            summary = list(csv.DictReader(f))
+
+        # Cached files are summarised with the profile of the run which
+        # created the output
+        fifout = os.path.join(self.outdir, 'sub-01_preproc_raw.fif')
+        os.utime(fifout, (0, 0))
+        assert(run_proc_batch(CONFIG, [self.infile], **kwargs) == [True])
+        assert(os.path.getmtime(fifout) == 0)
+        with open(os.path.join(logsdir, 'batch_profile.csv'), 'r') as f:
+            assert(list(csv.DictReader(f)) == summary)
+
+if __name__ == '__main__':
+    unittest.main()
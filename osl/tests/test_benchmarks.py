@@ -0,0 +1,59 @@
+"""Tests for the benchmarking utilities."""
+
+import unittest
+
+import numpy as np
+
+
+class TestBenchmarkUtils(unittest.TestCase):
+
+    def test_measure(self):
+        from ..benchmarks import measure
+
+        result = measure(np.ones, 10**6, n_repeats=2)
+        assert(len(result['wall_times']) == 2)
+        assert(result['peak_memory_mb'] >= 8)
+
+        # Setup output replaces the positional arguments
+        result = measure(np.sum, n_repeats=1, setup=lambda: (np.ones(10),))
+        assert(result['wall_time'] > 0)
+
+    def test_measure_memory_run(self):
+        import tracemalloc
+        from ..benchmarks import measure
+
+        # Timed calls are run without tracemalloc, plus one call for memory
+        tracing = []
+        measure(lambda: tracing.append(tracemalloc.is_tracing()), n_repeats=3)
+        assert(tracing == [False, False, False, True])
+
+    def test_measure_check(self):
+        from ..benchmarks import measure
+
+        result = measure(lambda: {'raw': 1}, check=bool)
+        assert(result['wall_time'] > 0)
+        with self.assertRaises(RuntimeError):
+            measure(lambda: {}, check=bool)
+
+    def test_lazy_import(self):
+        import sys
+        import subprocess
+
+        code = 'import sys, osl; assert "osl.benchmarks" not in sys.modules; osl.benchmarks.measure'
+        subprocess.run([sys.executable, '-c', code], check=True)
+
+    def test_compare_results(self):
+        from ..benchmarks import compare_results
+
+        reference = {'benchmarks': [
+            {'name': 'a', 'wall_time': 1, 'peak_memory_mb': 10},
+            {'name': 'b', 'wall_time': 1, 'peak_memory_mb': 10},
+        ]}
+        results = {'benchmarks': [
+            {'name': 'a', 'wall_time': 1.1, 'peak_memory_mb': 10},
+            {'name': 'b', 'wall_time': 2, 'peak_memory_mb': 10},
+            {'name': 'c', 'wall_time': 2, 'peak_memory_mb': 10},
+        ]}
+        comparison = compare_results(reference, results)
+        assert([c['name'] for c in comparison] == ['a', 'b'])
+        assert([c['regression'] for c in comparison] == [False, True])
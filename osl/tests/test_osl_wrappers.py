@@ -0,0 +1,151 @@
+"""Tests for the OSL preprocessing wrappers."""
+
+import unittest
+
+import numpy as np
+import mne
+import sails
+
+
+def _make_raw(n_times=10050, seed=0):
+    # Magnetometers and gradiometers with bad channels and segments
+    ch_types = ["mag"] * 10 + ["grad"] * 20
+    info = mne.create_info(
+        ["MEG{0:03d}".format(i) for i in range(len(ch_types))], 100.0, ch_types
+    )
+    rng = np.random.default_rng(seed)
+    data = rng.normal(size=(len(ch_types), n_times)) * 1e-12
+    data[3] *= 3
+    data[15] *= 3
+    for start, stop in [(1000, 1250), (5030, 5100), (10010, n_times)]:
+        data[:, start:stop] += 1e-11 * np.sin(np.arange(stop - start))
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+def _detect_badsegments_sails(raw, segment_len, picks, mode):
+    # Previous implementation of detect_badsegments, which used
+    # sails.utils.detect_artefacts on all the data
+    if mode is None:
+        XX = raw.get_data(picks=picks)
+    elif mode == "diff":
+        XX = np.diff(raw.get_data(picks=picks), axis=1)
+
+    bdinds = sails.utils.detect_artefacts(
+        XX, 1, reject_mode="segments", segment_len=segment_len, ret_mode="bad_inds"
+    )
+
+    onsets = np.where(np.diff(bdinds.astype(float)) == 1)[0]
+    if bdinds[0]:
+        onsets = np.r_[0, onsets]
+    offsets = np.where(np.diff(bdinds.astype(float)) == -1)[0]
+    if bdinds[-1]:
+        offsets = np.r_[offsets, len(bdinds) - 1]
+    durations = offsets - onsets
+    onsets = (onsets + raw.first_samp) / raw.info["sfreq"]
+    durations = durations / raw.info["sfreq"]
+    return onsets, durations
+
+
+class TestDetectBadSegments(unittest.TestCase):
+
+    def test_matches_sails(self):
+        from ..preprocessing.osl_wrappers import detect_badsegments
+
+        raw = _make_raw()
+        for picks in ["mag", "grad"]:
+            for mode in [None, "diff"]:
+                expected_onsets, expected_durations = _detect_badsegments_sails(
+                    raw, 100, picks, mode
+                )
+                assert(len(expected_onsets) > 0)
+
+                # Read in the default block size, one segment and a few
+                # segments at a time
+                for max_block_size in [2**22, 1, 1000]:
+                    raw_copy = raw.copy()
+                    detect_badsegments(
+                        raw_copy, segment_len=100, picks=picks, mode=mode,
+                        max_block_size=max_block_size,
+                    )
+                    annot = raw_copy.annotations
+                    assert(np.allclose(annot.onset, expected_onsets))
+                    assert(np.allclose(annot.duration, expected_durations))
+                    assert(set(annot.description) == {"bad_segment_" + picks})
+
+    def test_segment_metric(self):
+        from ..preprocessing.osl_wrappers import _get_segment_metric
+
+        XX = np.random.default_rng(0).normal(size=(4, 250))
+        metric = _get_segment_metric(XX, 100)
+        expected = [np.std(XX[:, :100]), np.std(XX[:, 100:200]), np.std(XX[:, 200:])]
+        assert(np.allclose(metric, expected))
+        assert(len(_get_segment_metric(XX[:, :200], 100)) == 2)
+
+
+class TestDetectBadChannelsAndSegments(unittest.TestCase):
+
+    def test_matches_separate(self):
+        from ..preprocessing.osl_wrappers import (
+            detect_badchannels,
+            detect_badsegments,
+            detect_badchannels_and_segments,
+        )
+
+        raw = _make_raw()
+        modes = [None, "diff"]
+
+        expected = raw.copy()
+        expected_bads = []
+        for picks in ["mag", "grad"]:
+            detect_badchannels(expected, picks)
+            expected_bads += expected.info["bads"]
+            for mode in modes:
+                detect_badsegments(expected, segment_len=100, picks=picks, mode=mode)
+
+        combined = raw.copy()
+        detect_badchannels_and_segments(
+            combined, picks=["mag", "grad"], segment_len=100, modes=modes
+        )
+
+        # Bad channels from each modality are appended, detect_badchannels
+        # replaces the bad channels found in the previous modality
+        assert(expected_bads == ["MEG003", "MEG015"])
+        assert(expected.info["bads"] == ["MEG015"])
+        assert(combined.info["bads"] == expected_bads)
+
+        assert(len(combined.annotations) == 12)
+        assert(np.allclose(combined.annotations.onset, expected.annotations.onset))
+        assert(np.allclose(combined.annotations.duration, expected.annotations.duration))
+        assert(list(combined.annotations.description) == list(expected.annotations.description))
+
+    def test_ref_meg(self):
+        from ..preprocessing.osl_wrappers import (
+            detect_badchannels,
+            detect_badsegments,
+            detect_badchannels_and_segments,
+        )
+
+        # Noisy reference channel, which would be the only bad channel
+        raw = _make_raw()
+        info = mne.create_info(["REF001"], raw.info["sfreq"], "ref_meg")
+        ref = mne.io.RawArray(
+            np.random.default_rng(1).normal(size=(1, raw.n_times)) * 1e-9, info, verbose=False
+        )
+        raw.add_channels([ref])
+
+        expected = raw.copy()
+        detect_badchannels(expected, "meg")
+        detect_badsegments(expected, segment_len=100, picks="meg")
+
+        combined = raw.copy()
+        detect_badchannels_and_segments(combined, picks="meg", segment_len=100)
+
+        assert("REF001" not in combined.info["bads"])
+        assert(combined.info["bads"] == expected.info["bads"])
+        assert(len(combined.annotations) == 3)
+        assert(np.allclose(combined.annotations.onset, expected.annotations.onset))
+        assert(np.allclose(combined.annotations.duration, expected.annotations.duration))
+
+
+if __name__ == "__main__":
+    unittest.main()
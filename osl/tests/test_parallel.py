@@ -1,11 +1,18 @@
 """Tests for passing arguments into batch preprocessing."""
 
+import time
+import operator
 import unittest
 
 import numpy as np
 from dask.distributed import Client, default_client
 
 
+def _sleep_and_return(x):
+    time.sleep(x)
+    return x
+
+
 class TestSimpleDask(unittest.TestCase):
 
     @classmethod
@@ -80,3 +87,45 @@ class TestSimpleDask(unittest.TestCase):
                                    func_args=[5],
                                    func_kwargs=func_kwargs)
         assert(np.all(result == np.array([5, 14, 69, 230, 581])))
+
+    def test_callback(self):
+        from ..utils.parallel import dask_parallel_bag
+
+        completed = {}
+        result = dask_parallel_bag(_sleep_and_return, [0.2, 0, 0.1],
+                                   callback=completed.__setitem__)
+        assert(result == [0.2, 0, 0.1])
+        assert(completed == {0: 0.2, 1: 0, 2: 0.1})
+
+
+class TestProcessParallel(unittest.TestCase):
+
+    def test_simple_func(self):
+        from ..utils.parallel import process_parallel
+
+        result = process_parallel(np.sqrt, [0, 1, 4, 9], n_jobs=2)
+        assert(np.all(np.array(result) == np.arange(4)))
+
+    def test_func_with_fixed_args(self):
+        from ..utils.parallel import process_parallel
+
+        inputs = [(a,) for a in np.arange(5)]
+        result = process_parallel(operator.mul, inputs, n_jobs=2, func_args=[3])
+        assert(np.all(np.array(result) == np.arange(5) * 3))
+
+    def test_failures_and_timeouts(self):
+        from ..utils.parallel import process_parallel
+
+        # Bad input raises in the worker, slow input exceeds the timeout
+        result = process_parallel(_sleep_and_return, [0, -1, 30, 0.1],
+                                  n_jobs=2, timeout=2)
+        assert(result == [0, False, False, 0.1])
+
+    def test_callback(self):
+        from ..utils.parallel import process_parallel
+
+        # Callback is only called for inputs which succeed
+        completed = {}
+        process_parallel(_sleep_and_return, [0, -1, 0.1], n_jobs=2,
+                         callback=completed.__setitem__)
+        assert(completed == {0: 0, 2: 0.1})
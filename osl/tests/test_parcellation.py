@@ -0,0 +1,185 @@
+"""Tests for parcellation."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.sparse.linalg
+
+
+def _simulate_voxels(nvoxels, ntpts, nsources=5, seed=0):
+    # Voxel time courses which are mixtures of a few sources plus noise
+    rng = np.random.default_rng(seed)
+    sources = rng.normal(size=(nsources, ntpts)) * np.arange(nsources, 0, -1)[:, None]
+    mixing = rng.normal(size=(nvoxels, nsources))
+    return mixing @ sources + 0.1 * rng.normal(size=(nvoxels, ntpts)) + 0.5
+
+
+def _simulate_parcellation(nvoxels, nparcels, binary, seed=0):
+    rng = np.random.default_rng(seed)
+    if binary:
+        labels = rng.integers(nparcels, size=nvoxels)
+        return (labels[:, None] == np.arange(nparcels)).astype(float)
+    # Overlapping weighted maps with a positive peak
+    maps = rng.uniform(-0.2, 1, size=(nvoxels, nparcels))
+    maps[rng.uniform(size=maps.shape) < 0.3] = 0
+    return maps
+
+
+def _old_parcel_timeseries(voxel_timeseries, parcellation_asmatrix, method):
+    # Previous implementation of _get_parcel_timeseries, which used
+    # scipy.sparse.linalg.eigs on the voxel Gram matrix of each parcel
+    eps = np.finfo(float).eps
+    temporal_std = np.maximum(np.std(voxel_timeseries, axis=1), eps)
+    parcel_timeseries = np.zeros([parcellation_asmatrix.shape[1], voxel_timeseries.shape[1]])
+    voxel_weightings = np.zeros(parcellation_asmatrix.shape)
+    for pp in range(parcellation_asmatrix.shape[1]):
+        parcel_map = parcellation_asmatrix[:, pp]
+        if method == "spatial_basis":
+            thresh = np.percentile(np.abs(parcel_map), 95)
+            mapsign = np.sign(np.mean(parcel_map[parcel_map > thresh]))
+            scaled = mapsign * parcel_map / np.max(np.abs(parcel_map))
+            inds = np.where(scaled > 0)[0]
+            data = voxel_timeseries[inds] * scaled[inds, None]
+            mask = scaled[inds] > 0.5
+        else:
+            inds = np.where(parcel_map > 0)[0]
+            data = voxel_timeseries[inds]
+            data = data - np.mean(data, axis=1, keepdims=True)
+            mask = np.ones(len(inds), dtype=bool)
+        d, U = scipy.sparse.linalg.eigs(data @ data.T, k=1)
+        U = np.real(U)
+        S = np.sqrt(np.abs(np.real(d)))
+        pca_scores = S @ (data.T @ U / S).T
+        relative_weighting = np.abs(U[mask]) / np.sum(np.abs(U[mask]))
+        ts_sign = np.sign(np.mean(U[mask]))
+        ts_scale = np.dot(relative_weighting[:, 0], temporal_std[inds][mask])
+        norm = ts_sign * ts_scale / np.maximum(np.std(pca_scores), eps)
+        parcel_timeseries[pp] = norm * pca_scores
+        voxel_weightings[inds, pp] = norm * U[:, 0]
+        if method == "spatial_basis":
+            voxel_weightings[inds, pp] *= scaled[inds]
+    return parcel_timeseries, voxel_weightings
+
+
+class TestParcelTimeseries(unittest.TestCase):
+
+    def test_matches_old_implementation(self):
+        from ..source_recon.parcellation.parcellation import _get_parcel_timeseries
+
+        # The first shape uses the full eigendecomposition of the voxel Gram
+        # matrices, the second the sparse eigensolver on the time Gram matrices
+        for nvoxels, ntpts in [(120, 400), (900, 300)]:
+            voxel_timeseries = _simulate_voxels(nvoxels, ntpts)
+            for method, binary in [("spatial_basis", False), ("pca", True)]:
+                parcellation = _simulate_parcellation(nvoxels, 3, binary)
+                expected_ts, expected_weightings = _old_parcel_timeseries(
+                    voxel_timeseries, parcellation, method
+                )
+                for n_jobs in [1, -1]:
+                    parcel_ts, voxel_weightings, _ = _get_parcel_timeseries(
+                        voxel_timeseries, parcellation, method=method, n_jobs=n_jobs
+                    )
+                    # Same up to floating point error (about 1e-15 relative to
+                    # the largest value)
+                    atol = 1e-12 * np.abs(expected_ts).max()
+                    assert(np.allclose(parcel_ts, expected_ts, rtol=0, atol=atol))
+                    atol = 1e-12 * np.abs(expected_weightings).max()
+                    assert(np.allclose(voxel_weightings, expected_weightings, rtol=0, atol=atol))
+
+
+    def test_chunked(self):
+        from ..source_recon.parcellation.parcellation import (
+            _get_parcel_timeseries,
+            _get_parcel_timeseries_chunked,
+        )
+
+        voxel_timeseries = _simulate_voxels(150, 500)
+        tmpdir = tempfile.mkdtemp()
+        fname = os.path.join(tmpdir, "voxels.npy")
+        np.save(fname, voxel_timeseries)
+        try:
+            for method, binary in [("spatial_basis", False), ("pca", True)]:
+                parcellation = _simulate_parcellation(150, 4, binary)
+                expected_ts, expected_weightings, _ = _get_parcel_timeseries(
+                    voxel_timeseries, parcellation, method=method
+                )
+                ts_atol = 1e-10 * np.abs(expected_ts).max()
+                weightings_atol = 1e-10 * np.abs(expected_weightings).max()
+
+                # Memory-mapped data read in chunks
+                memmap = np.load(fname, mmap_mode="r")
+                parcel_ts, voxel_weightings, _ = _get_parcel_timeseries(
+                    memmap, parcellation, method=method, chunk_size=77
+                )
+                assert(np.allclose(parcel_ts, expected_ts, rtol=0, atol=ts_atol))
+                assert(np.allclose(voxel_weightings, expected_weightings, rtol=0, atol=weightings_atol))
+
+                # Gram matrices accumulated one parcel at a time
+                parcel_ts, voxel_weightings = _get_parcel_timeseries_chunked(
+                    memmap, parcellation, method, 77, max_gram_size=1
+                )
+                assert(np.allclose(parcel_ts, expected_ts, rtol=0, atol=ts_atol))
+                del memmap
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_group_parcels(self):
+        from ..source_recon.parcellation.parcellation import _group_parcels
+
+        parcel_inds = [np.arange(n) for n in [3, 2, 4, 1]]
+        assert(_group_parcels(parcel_inds, 100) == [[0, 1, 2, 3]])
+        assert(_group_parcels(parcel_inds, 13) == [[0, 1], [2], [3]])
+        assert(_group_parcels(parcel_inds, 1) == [[0], [1], [2], [3]])
+
+class TestParcellation2Matrix(unittest.TestCase):
+
+    def test_matches_per_voxel_query(self):
+        import scipy.sparse
+        from scipy.spatial import KDTree
+        from ..source_recon.parcellation.parcellation import _parcellation2matrix
+        from ..source_recon.rhino.utils import niimask2mmpointcloud
+
+        parcellation_file = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)),
+            "source_recon",
+            "parcellation",
+            "files",
+            "fmri_d100_parcellation_with_PCC_reduced_2mm_ss5mm_ds8mm.nii.gz",
+        )
+        gridstep = 8
+
+        # Points around the brain, some of which are further than gridstep
+        # from any parcel
+        rng = np.random.default_rng(0)
+        voxel_coords = rng.uniform(-100, 100, size=(3, 1000))
+
+        # Previous implementation, which queried each parcel and voxel separately
+        nparcels = 38
+        expected = np.zeros((voxel_coords.shape[1], nparcels))
+        for parcel_index in range(nparcels):
+            parcellation_coords, parcellation_vals = niimask2mmpointcloud(
+                parcellation_file, parcel_index
+            )
+            kdtree = KDTree(parcellation_coords.T)
+            for ind in range(voxel_coords.shape[1]):
+                distance, index = kdtree.query(voxel_coords[:, ind])
+                if distance < gridstep:
+                    expected[ind, parcel_index] = parcellation_vals[index]
+        assert(np.count_nonzero(expected) > 0)
+        assert(np.any(np.all(expected == 0, axis=1)))
+
+        parcellation_asmatrix = _parcellation2matrix(parcellation_file, voxel_coords, gridstep)
+        assert(isinstance(parcellation_asmatrix, np.ndarray))
+        assert(np.array_equal(parcellation_asmatrix, expected))
+
+        parcellation_asmatrix = _parcellation2matrix(
+            parcellation_file, voxel_coords, gridstep, sparse=True
+        )
+        assert(scipy.sparse.issparse(parcellation_asmatrix))
+        assert(np.array_equal(parcellation_asmatrix.toarray(), expected))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+"""Tests for profiling processing chains."""
+
+import unittest
+import tempfile
+import os
+
+import numpy as np
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_profiler(self):
+        from ..utils.profiling import Profiler, read_profile
+
+        profiler = Profiler()
+        with profiler.stage("first", index=0):
+            np.linalg.svd(np.random.randn(100, 100))
+        with profiler.stage("second", index=1):
+            pass
+
+        assert([p["stage"] for p in profiler.stages] == ["first", "second"])
+        assert(profiler.stages[0]["wall_time"] > 0)
+
+        fbase = os.path.join(tempfile.mkdtemp(), "profile")
+        profiler.save(fbase)
+        assert(os.path.exists(fbase + ".csv"))
+        assert(read_profile(fbase + ".json") == profiler.stages)
+
+    def test_aggregate_profiles(self):
+        from ..utils.profiling import aggregate_profiles
+
+        profiles = []
+        for wall_time in [1, 2, 3]:
+            profiles.append([
+                {"index": 0, "stage": "filter", "wall_time": wall_time,
+                 "cpu_time": 1, "peak_rss_delta_mb": 0},
+                {"index": 1, "stage": "ica", "wall_time": 10 * wall_time,
+                 "cpu_time": 1, "peak_rss_delta_mb": 0},
+            ])
+
+        summary = aggregate_profiles(profiles)
+        assert([s["stage"] for s in summary] == ["ica", "filter"])
+        assert(summary[1]["n_runs"] == 3)
+        assert(summary[1]["wall_time_p50"] == 2)
+        assert(summary[0]["wall_time_total"] == 60)
@@ -0,0 +1,104 @@
+"""Tests for the raw data report."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import mne
+import matplotlib
+
+matplotlib.use("Agg")
+
+
+def _make_raw():
+    ch_types = ["mag"] * 5 + ["grad"] * 6 + ["eeg"] * 4 + ["stim"]
+    info = mne.create_info(
+        ["CH{0:03d}".format(i) for i in range(len(ch_types))], 200.0, ch_types
+    )
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(len(ch_types), 4000)) * rng.uniform(1, 2, size=(len(ch_types), 1))
+    raw = mne.io.RawArray(data * 1e-12, info, verbose=False)
+    raw.info["bads"] = ["CH001"]
+    return raw
+
+
+def _spectra_lines(ax):
+    # Lines with the spectra, other lines (e.g. at zero) only have a couple of points
+    return [
+        (np.asarray(line.get_xdata()), np.asarray(line.get_ydata()))
+        for line in ax.get_lines()
+        if len(line.get_xdata()) > 2
+    ]
+
+
+class TestComputeChannelStats(unittest.TestCase):
+
+    def test_matches_numpy(self):
+        from ..report.raw_report import compute_channel_stats
+
+        raw = _make_raw()
+        stats = compute_channel_stats(raw)
+        assert(sorted(stats) == ["eeg", "grad", "mag"])
+
+        # Bad channels are excluded
+        ch_names = {
+            "mag": ["CH000", "CH002", "CH003", "CH004"],
+            "grad": ["CH{0:03d}".format(i) for i in range(5, 11)],
+            "eeg": ["CH{0:03d}".format(i) for i in range(11, 15)],
+        }
+        for name, channels in ch_names.items():
+            x = [raw.get_data(picks=[ch])[0] for ch in channels]
+            assert(np.allclose(stats[name]["std"], [np.std(xx) for xx in x]))
+            assert(np.allclose(stats[name]["sumsq"], np.sum([xx ** 2 for xx in x], axis=0)))
+
+
+class TestPlotSpectra(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, "sub-01"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_zoom(self):
+        from ..report import raw_report
+
+        raw = _make_raw()
+        savebase = os.path.join(self.tmpdir, "sub-01", "{0}.png")
+
+        # Keep hold of the figure when it's closed
+        with mock.patch.object(raw_report.plt, "close") as close:
+            filenames = raw_report.plot_spectra(raw, savebase=savebase)
+        [fig] = [call.args[0] for call in close.call_args_list]
+
+        assert(filenames == ("sub-01/spectra_full.png", "sub-01/spectra_zoom.png"))
+        for name in ["spectra_full", "spectra_zoom"]:
+            assert(os.path.exists(savebase.format(name)))
+
+        # The zoomed in spectra are the same as the spectra computed for 1-48 Hz
+        expected_fig = raw.plot_psd(show=False, fmin=1, fmax=48, verbose=0)
+        n_spectra_axes = 0
+        for ax, expected_ax in zip(fig.axes, expected_fig.axes):
+            lines = _spectra_lines(ax)
+            expected_lines = _spectra_lines(expected_ax)
+            assert(len(lines) == len(expected_lines))
+            if len(lines) == 0:
+                continue
+            n_spectra_axes += 1
+            assert(ax.get_xlim() == (1, 48))
+            ymin, ymax = ax.get_ylim()
+            for (x, y), (expected_x, expected_y) in zip(lines, expected_lines):
+                keep = (x >= 1) & (x <= 48)
+                assert(np.allclose(x[keep], expected_x))
+                assert(np.allclose(y[keep], expected_y))
+                assert(ymin <= y[keep].min() and y[keep].max() <= ymax)
+        assert(n_spectra_axes == 3)
+        matplotlib.pyplot.close("all")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Tests for RHINO utility functions."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nib
+
+
+class TestResampleNii(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.files_dir = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)),
+            "source_recon",
+            "parcellation",
+            "files",
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_grid(self):
+        from ..source_recon.rhino.utils import resample_nii
+
+        # Same grid as the 8 mm version of the parcellation shipped with OSL
+        out_file = os.path.join(self.tmpdir, "resampled.nii.gz")
+        resample_nii(
+            os.path.join(self.files_dir, "fMRI_parcellation_ds2mm.nii.gz"), out_file, 8
+        )
+        resampled = nib.load(out_file)
+        ds8mm = nib.load(os.path.join(self.files_dir, "fMRI_parcellation_ds8mm.nii.gz"))
+
+        assert(resampled.shape == ds8mm.shape)
+        assert(np.allclose(resampled.affine, ds8mm.affine))
+        assert(resampled.header["sform_code"] == ds8mm.header["sform_code"])
+
+    def test_values(self):
+        from ..source_recon.rhino.utils import resample_nii
+
+        # Trilinear interpolation of a linear function of the world
+        # coordinates is exact, so the resampled values must be the same
+        # function of the output world coordinates
+        coeffs = np.array([0.3, -0.2, 0.5])
+        for det_sign in [-1, 1]:
+            affine = np.diag([2.0 * det_sign, 2.0, 2.0, 1.0])
+            affine[:3, 3] = [-30 * det_sign, -40, -20]
+            ijk = np.stack(
+                np.meshgrid(*[np.arange(n) for n in (30, 40, 20)], indexing="ij"),
+                axis=-1,
+            )
+            data = (ijk @ affine[:3, :3].T + affine[:3, 3]) @ coeffs + 100
+            img = nib.Nifti1Image(data.astype(np.float32), affine)
+            img.set_sform(affine, 4)
+            in_file = os.path.join(self.tmpdir, "linear.nii.gz")
+            out_file = os.path.join(self.tmpdir, "linear_resampled.nii.gz")
+            nib.save(img, in_file)
+
+            resample_nii(in_file, out_file, 6)
+            resampled = nib.load(out_file)
+            assert(resampled.shape == (10, 13, 7))
+
+            ijk = np.stack(
+                np.meshgrid(*[np.arange(n) for n in resampled.shape], indexing="ij"),
+                axis=-1,
+            )
+            expected = (ijk @ resampled.affine[:3, :3].T + resampled.affine[:3, 3]) @ coeffs + 100
+            assert(np.allclose(resampled.get_fdata(), expected, atol=1e-3))
+
+    def test_cache(self):
+        from ..source_recon.rhino.utils import get_resampled_nii
+
+        nii_file = os.path.join(self.files_dir, "fMRI_parcellation_ds8mm.nii.gz")
+        cache_dir = os.path.join(self.tmpdir, "cache")
+        resampled_file = get_resampled_nii(nii_file, 16, cache_dir=cache_dir)
+        mtime = os.path.getmtime(resampled_file)
+
+        # Second call reuses the cached file
+        assert(get_resampled_nii(nii_file, 16, cache_dir=cache_dir) == resampled_file)
+        assert(os.path.getmtime(resampled_file) == mtime)
+        assert(os.listdir(cache_dir) == [os.path.basename(resampled_file)])
+
+    def test_out_file(self):
+        from ..source_recon.rhino.utils import get_resampled_nii
+
+        subject_dir = os.path.join(self.tmpdir, "subject")
+        os.makedirs(subject_dir)
+        nii_file = os.path.join(subject_dir, "smri.nii.gz")
+        shutil.copy(os.path.join(self.files_dir, "fMRI_parcellation_ds8mm.nii.gz"), nii_file)
+        out_file = os.path.join(subject_dir, "smri_16mm.nii.gz")
+        cache_dir = os.path.join(self.tmpdir, "unused_cache")
+
+        # Subject specific files are saved to out_file, not the cache
+        assert(get_resampled_nii(nii_file, 16, cache_dir=cache_dir, out_file=out_file) == out_file)
+        assert(not os.path.exists(cache_dir))
+        assert(sorted(os.listdir(subject_dir)) == ["smri.nii.gz", "smri_16mm.nii.gz"])
+
+        # and only recomputed if the input is newer
+        os.utime(out_file, (0, 0))
+        os.utime(nii_file, (0, 0))
+        get_resampled_nii(nii_file, 16, out_file=out_file)
+        assert(os.path.getmtime(out_file) == 0)
+        os.utime(nii_file, (10, 10))
+        get_resampled_nii(nii_file, 16, out_file=out_file)
+        assert(os.path.getmtime(out_file) > 10)
@@ -0,0 +1,288 @@
+"""Tests for sign flipping."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+
+class TestFindFlips(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from ..source_recon.sign_flipping import time_embed, std_data
+
+        cls.n_embeddings = 3
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(2000, 6))
+        x = np.cumsum(x, axis=0) * 0.1 + x
+        cls.signs = np.array([1, -1, 1, 1, -1, -1])
+
+        def cov(y):
+            y = std_data(time_embed(y, cls.n_embeddings))
+            return np.cov(y, rowvar=False)
+
+        cls.template_cov = cov(x + rng.normal(size=x.shape))
+        cls.cov = cov((x + rng.normal(size=x.shape)) * cls.signs)
+
+    def test_flipped_correlation(self):
+        from ..source_recon.sign_flipping import (
+            _get_flip_sums,
+            _get_flip_state,
+            _update_flip_sums,
+            _flip_correlation,
+            apply_flips_to_covariance,
+            covariance_matrix_correlation,
+        )
+
+        flip_sums = _get_flip_sums(self.cov, self.template_cov, self.n_embeddings)
+        flips = np.array([1, 1, -1, 1, 1, -1])
+        state = _get_flip_state(flip_sums, flips)
+        for new_flips in [flips, -flips, self.signs, np.ones(6)]:
+            metric = _flip_correlation(
+                flip_sums, *_update_flip_sums(flip_sums, state, flips, new_flips)
+            )
+            flipped_cov = apply_flips_to_covariance(
+                self.cov, new_flips, self.n_embeddings
+            )
+            expected = covariance_matrix_correlation(
+                flipped_cov, self.template_cov, self.n_embeddings
+            )
+            assert(np.isclose(metric, expected))
+
+    def test_find_flips(self):
+        from ..source_recon.sign_flipping import find_flips
+
+        np.random.seed(0)
+        flips, metrics = find_flips(
+            self.cov, self.template_cov, self.n_embeddings, 2, 200, 3
+        )
+        assert(np.all(flips == self.signs) or np.all(flips == -self.signs))
+        assert(metrics[-1] > 0.9)
+
+    def test_find_flips_parallel(self):
+        from ..source_recon.sign_flipping import find_flips
+
+        args = (self.cov, self.template_cov, self.n_embeddings, 4, 50, 3)
+        flips, metrics = find_flips(*args, random_state=0)
+        parallel_flips, parallel_metrics = find_flips(*args, random_state=0, n_jobs=2)
+        assert(np.all(flips == parallel_flips))
+        assert(np.allclose(metrics, parallel_metrics))
+
+
+class TestTimeEmbeddedCovariance(unittest.TestCase):
+
+    def test_matches_time_embed(self):
+        from ..source_recon.sign_flipping import (
+            time_embed,
+            std_data,
+            time_embedded_covariance,
+        )
+
+        rng = np.random.default_rng(0)
+        x = np.cumsum(rng.normal(size=(1000, 4)), axis=0) + 5
+        for n_embeddings in [1, 5]:
+            for standardize in [True, False]:
+                y = time_embed(x, n_embeddings)
+                if standardize:
+                    y = std_data(y)
+                expected = np.cov(y, rowvar=False)
+                cov = time_embedded_covariance(
+                    x, n_embeddings, standardize, chunk_size=77
+                )
+                assert(np.allclose(cov, expected))
+
+
+class TestFindTemplateSubject(unittest.TestCase):
+
+    def test_matches_pairwise(self):
+        from ..source_recon.sign_flipping import (
+            covariance_matrix_correlation,
+            find_template_subject,
+        )
+
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(9, 100, 8))
+        x[:, :, 1:] += rng.uniform(0, 2, size=(9, 1, 1)) * x[:, :, :1]
+        covs = np.array([np.cov(y, rowvar=False) for y in x])
+
+        metric = np.zeros([9, 9])
+        for i in range(9):
+            for j in range(9):
+                if i != j:
+                    metric[i, j] = covariance_matrix_correlation(
+                        covs[i], covs[j], 1, mode="abs"
+                    )
+        metric_sum = np.sum(metric, axis=1)
+        expected = np.argsort(metric_sum)[len(metric_sum) // 2]
+
+        assert(find_template_subject(covs, 1, chunk_size=5) == expected)
+
+
+class TestLoadCovariances(unittest.TestCase):
+
+    def test_cache(self):
+        from ..source_recon.sign_flipping import load_covariances
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            parc_file = os.path.join(tmpdir, "parc.npy")
+            np.save(parc_file, np.random.default_rng(0).normal(size=(500, 4)))
+
+            loaded = []
+
+            def loader(fname):
+                loaded.append(fname)
+                return np.load(fname)
+
+            kwargs = {"loader": loader, "use_tqdm": False, "use_cache": True}
+            covs = load_covariances([parc_file], 3, **kwargs)
+            assert(os.path.exists(os.path.join(tmpdir, "parc_cov.npz")))
+            cached_covs = load_covariances([parc_file], 3, **kwargs)
+            assert(len(loaded) == 1)
+            assert(np.array_equal(covs, cached_covs))
+
+            # Different options aren't read from the cache
+            load_covariances([parc_file], 5, **kwargs)
+            assert(len(loaded) == 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestFixSignAmbiguityGroup(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.subjects = ["sub-01", "sub-02", "sub-03"]
+
+        # Subjects with the same sources but different signs
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(2000, 6))
+        x = np.cumsum(x, axis=0) * 0.1 + x
+        for subject in cls.subjects:
+            signs = rng.choice([-1, 1], size=6)
+            os.makedirs(os.path.join(cls.tmpdir, subject, "rhino"))
+            os.makedirs(os.path.join(cls.tmpdir, "report", subject))
+            np.save(
+                os.path.join(cls.tmpdir, subject, "rhino", "parc.npy"),
+                (x + rng.normal(size=x.shape)) * signs,
+            )
+
+        cls.kwargs = {
+            "template": "sub-01",
+            "n_embeddings": 3,
+            "standardize": True,
+            "n_init": 2,
+            "n_iter": 20,
+            "max_flips": 3,
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def load_flipped(self, subjects):
+        return [np.load(os.path.join(self.tmpdir, subject, "sflip_parc.npy")) for subject in subjects]
+
+    def test_matches_single_subject(self):
+        import logging
+        from ..source_recon.wrappers import fix_sign_ambiguity, fix_sign_ambiguity_group
+
+        summary = fix_sign_ambiguity_group(
+            self.tmpdir, self.subjects, n_jobs=2, random_state=0, **self.kwargs
+        )
+        flipped = self.load_flipped(self.subjects)
+        assert(sorted(summary) == self.subjects)
+
+        # The temporary directory for the template covariance is removed
+        assert(sorted(os.listdir(self.tmpdir)) == ["report"] + self.subjects)
+
+        # Each subject is sign flipped with its own seed
+        seeds = np.random.SeedSequence(0).generate_state(len(self.subjects))
+        for subject, seed, expected in zip(self.subjects, seeds, flipped):
+            fix_sign_ambiguity(
+                self.tmpdir,
+                subject,
+                None,
+                None,
+                logging.getLogger(__name__),
+                random_state=seed,
+                **self.kwargs,
+            )
+            [result] = self.load_flipped([subject])
+            assert(np.array_equal(result, expected))
+
+        # so the result doesn't depend on the number of jobs
+        for n_jobs, n_init_jobs in [(1, 1), (1, 2)]:
+            other_summary = fix_sign_ambiguity_group(
+                self.tmpdir,
+                self.subjects,
+                n_jobs=n_jobs,
+                n_init_jobs=n_init_jobs,
+                random_state=0,
+                **self.kwargs,
+            )
+            assert(other_summary == summary)
+            for result, expected in zip(self.load_flipped(self.subjects), flipped):
+                assert(np.array_equal(result, expected))
+
+    def test_memmapped_template(self):
+        import logging
+        from ..source_recon.sign_flipping import get_parc_file, load_covariances
+        from ..source_recon.wrappers import fix_sign_ambiguity, _fix_sign_ambiguity_subject
+
+        # Each subject reads the template covariance from a memory mapped
+        # file, which gives the same result as using the template directly
+        [template_cov] = load_covariances(
+            [get_parc_file(self.tmpdir, "sub-01")], 3, True, use_tqdm=False
+        )
+        template_cov_file = os.path.join(self.tmpdir, "sub-01", "template_cov.npy")
+        np.save(template_cov_file, template_cov)
+        try:
+            args = {key: value for key, value in self.kwargs.items() if key != "template"}
+            result = _fix_sign_ambiguity_subject(
+                "sub-02", 1, self.tmpdir, template_cov_file, **args
+            )
+            assert(result["metric"] >= result["unflipped_metric"])
+            [flipped] = self.load_flipped(["sub-02"])
+
+            # and doesn't modify the shared file
+            assert(np.array_equal(np.load(template_cov_file), template_cov))
+        finally:
+            os.remove(template_cov_file)
+
+        fix_sign_ambiguity(
+            self.tmpdir,
+            "sub-02",
+            None,
+            None,
+            logging.getLogger(__name__),
+            random_state=1,
+            **self.kwargs,
+        )
+        [expected] = self.load_flipped(["sub-02"])
+        assert(np.array_equal(flipped, expected))
+
+    def test_failed_subject(self):
+        from ..source_recon.wrappers import fix_sign_ambiguity_group
+
+        # sub-04 doesn't have any parcellated data
+        summary = fix_sign_ambiguity_group(
+            self.tmpdir, self.subjects + ["sub-04"], n_jobs=2, random_state=0, **self.kwargs
+        )
+        assert(summary["sub-04"] is None)
+        for subject in self.subjects:
+            assert(summary[subject]["metric"] >= summary[subject]["unflipped_metric"])
+
+        # A missing template is an error
+        with self.assertRaises(ValueError):
+            fix_sign_ambiguity_group(
+                self.tmpdir, self.subjects, **{**self.kwargs, "template": "sub-04"}
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
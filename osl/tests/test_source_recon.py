@@ -0,0 +1,429 @@
+"""Tests for source reconstruction using a simulated subject."""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+import mne
+
+
+def _make_subject(tmpdir, subject="sub-01", n_channels=40):
+    """Make the files for a simulated subject with a spherical head.
+
+    The MRI, head and MNI spaces are the same, so the forward model can be
+    computed without FSL.
+    """
+    from mne.surface import write_surface, _get_ico_surface
+    from mne.transforms import Transform, write_trans
+
+    from ..source_recon import rhino
+
+    # MNI brain in a fake FSL directory
+    std_dir = os.path.join(tmpdir, "fsl", "data", "standard")
+    os.makedirs(std_dir, exist_ok=True)
+    affine = np.array(
+        [[-4, 0, 0, 90], [0, 4, 0, -126], [0, 0, 4, -72], [0, 0, 0, 1.0]]
+    )
+    ijk = np.stack(
+        np.meshgrid(*[np.arange(n) for n in (46, 55, 46)], indexing="ij"), axis=-1
+    )
+    xyz = ijk @ affine[:3, :3].T + affine[:3, 3]
+    brain = (np.linalg.norm(xyz, axis=-1) < 65).astype(np.float32)
+    img = nib.Nifti1Image(brain, affine)
+    img.set_sform(affine, 4)
+    img.set_qform(affine, 4)
+    nib.save(img, os.path.join(std_dir, "MNI152_T1_1mm_brain.nii.gz"))
+
+    surfaces_filenames = rhino.get_surfaces_filenames(tmpdir, subject)
+    coreg_filenames = rhino.get_coreg_filenames(tmpdir, subject)
+
+    # Spherical surfaces in mm
+    ico = _get_ico_surface(2)
+    for name, radius in [
+        ("bet_inskull_surf_file", 70),
+        ("bet_outskull_surf_file", 80),
+        ("bet_outskin_surf_file", 90),
+    ]:
+        write_surface(
+            surfaces_filenames[name],
+            ico["rr"] * radius,
+            ico["tris"],
+            file_format="freesurfer",
+            overwrite=True,
+        )
+
+    affine = np.eye(4)
+    affine[:3, :3] *= 4
+    affine[:3, 3] = -100
+    nib.save(
+        nib.Nifti1Image(np.zeros((50, 50, 50), np.float32), affine),
+        surfaces_filenames["smri_file"],
+    )
+    write_trans(coreg_filenames["head_mri_t_file"], Transform("head", "mri"))
+    write_trans(surfaces_filenames["mni_mri_t_file"], Transform("mni_tal", "mri"))
+
+    # Magnetometers on a helmet, pointing outwards
+    info = mne.create_info(
+        ["MEG{:03d}".format(i) for i in range(n_channels)], 100.0, "mag"
+    )
+    rng = np.random.default_rng(0)
+    normals = rng.normal(size=(n_channels, 3))
+    normals[:, 2] = np.abs(normals[:, 2])
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    for ch, ez in zip(info["chs"], normals):
+        ex = np.cross([0, 0, 1.0], ez)
+        ex /= np.linalg.norm(ex)
+        ey = np.cross(ez, ex)
+        ch["loc"][:3] = 0.12 * ez
+        ch["loc"][3:12] = np.concatenate([ex, ey, ez])
+    with info._unlock():
+        info["dev_head_t"] = Transform("meg", "head")
+    mne.io.RawArray(np.zeros((n_channels, 10)), info, verbose=False).save(
+        coreg_filenames["fif_file"], verbose=False
+    )
+
+    return info
+
+
+class SimulatedSubjectTestCase(unittest.TestCase):
+    """Base class for tests which need a subject with a forward model."""
+
+    @classmethod
+    def setUpClass(cls):
+        from ..source_recon import rhino
+
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.environ = dict(os.environ)
+        os.environ["FSLDIR"] = os.path.join(cls.tmpdir, "fsl")
+        os.environ["OSL_CACHE_DIR"] = os.path.join(cls.tmpdir, "cache")
+
+        cls.src_dir = Path(cls.tmpdir)
+        cls.subject = "sub-01"
+        cls.info = _make_subject(cls.tmpdir, cls.subject)
+        rhino.forward_model(cls.tmpdir, cls.subject, gridstep=15, verbose=False)
+
+        # Preprocessed data with some bad segments
+        rng = np.random.default_rng(1)
+        data = rng.normal(size=(len(cls.info["ch_names"]), 3000)) * 1e-12
+        raw = mne.io.RawArray(data, cls.info, verbose=False)
+        raw.set_annotations(
+            mne.Annotations([2.5, 14.01], [3.2, 1.7], ["bad_segment", "BAD_other"])
+        )
+        cls.preproc_file = os.path.join(cls.tmpdir, "preproc_raw.fif")
+        raw.save(cls.preproc_file, verbose=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.clear()
+        os.environ.update(cls.environ)
+        shutil.rmtree(cls.tmpdir)
+
+    def run_beamform_and_parcellate(self, **kwargs):
+        from ..source_recon import wrappers
+
+        files_dir = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)),
+            "source_recon",
+            "parcellation",
+            "files",
+        )
+        args = {
+            "chantypes": ["mag"],
+            "rank": {"mag": 30},
+            "freq_range": [1, 20],
+            "parcellation_file": os.path.join(
+                files_dir, "fmri_d100_parcellation_with_PCC_reduced_2mm_ss5mm_ds8mm.nii.gz"
+            ),
+            "method": "spatial_basis",
+            "orthogonalisation": None,
+        }
+        args.update(kwargs)
+        wrappers.beamform_and_parcellate(
+            self.src_dir,
+            self.subject,
+            self.preproc_file,
+            None,
+            logging.getLogger(__name__),
+            **args,
+        )
+
+
+class TestBeamformAndParcellate(SimulatedSubjectTestCase):
+
+    def test_fused(self):
+        parc_file = self.src_dir / self.subject / "rhino" / "parc.npy"
+
+        self.run_beamform_and_parcellate()
+        expected = np.load(parc_file)
+
+        self.run_beamform_and_parcellate(fused=True, chunk_size=333)
+        parc_ts = np.load(parc_file)
+
+        # Bad segments are omitted
+        assert(parc_ts.shape[0] == 3000 - 320 - 170)
+        assert(np.abs(parc_ts).max() > 0)
+        assert(np.allclose(parc_ts, expected, rtol=0, atol=1e-10 * np.abs(expected).max()))
+
+    def test_multiple_bands(self):
+        rhino_dir = self.src_dir / self.subject / "rhino"
+        bands = {"a": [1, 20], "b": [5, 30]}
+
+        expected = {}
+        for name, band in bands.items():
+            self.run_beamform_and_parcellate(freq_range=band)
+            expected[name] = np.load(rhino_dir / "parc.npy")
+
+        # Bands are beamformed in the main thread and parcellated in parallel
+        for fused in [False, True]:
+            self.run_beamform_and_parcellate(freq_range=bands, n_jobs=-1, fused=fused)
+            for name in bands:
+                parc_ts = np.load(rhino_dir / f"parc_{name}.npy")
+                assert(np.allclose(parc_ts, expected[name], rtol=0, atol=1e-10 * np.abs(expected[name]).max()))
+
+    def test_bands_in_flight(self):
+        import threading
+        import time
+        from unittest import mock
+        from ..source_recon import beamforming
+        from ..source_recon.parcellation import Parcellation
+
+        lock = threading.Lock()
+        counts = {"live": 0, "max": 0}
+        apply_recon_mapping = beamforming.apply_recon_mapping
+        parcellate = Parcellation.parcellate
+        parcellate_sensor_data = Parcellation.parcellate_sensor_data
+
+        # Count the bands which have been beamformed but not parcellated.
+        # Parcellation is slowed down so bands would pile up without a limit
+        def counted_apply_recon_mapping(*args, **kwargs):
+            out = apply_recon_mapping(*args, **kwargs)
+            with lock:
+                counts["live"] += 1
+                counts["max"] = max(counts["max"], counts["live"])
+            return out
+
+        def slow(func):
+            def wrapped(*args, **kwargs):
+                time.sleep(1)
+                out = func(*args, **kwargs)
+                with lock:
+                    counts["live"] -= 1
+                return out
+            return wrapped
+
+        bands = {"a": [1, 20], "b": [5, 30], "c": [2, 10], "d": [8, 12]}
+        with mock.patch.object(beamforming, "apply_recon_mapping", counted_apply_recon_mapping), \
+                mock.patch.object(Parcellation, "parcellate", slow(parcellate)), \
+                mock.patch.object(Parcellation, "parcellate_sensor_data", slow(parcellate_sensor_data)):
+            for fused in [False, True]:
+                counts["max"] = 0
+                self.run_beamform_and_parcellate(freq_range=bands, n_jobs=2, fused=fused)
+                assert(counts["live"] == 0)
+                assert(counts["max"] == 2)
+
+    def test_sign_flipping_band(self):
+        from ..source_recon import wrappers
+
+        self.run_beamform_and_parcellate(freq_range={"alpha": [8, 12]})
+        os.makedirs(self.src_dir / "report" / self.subject, exist_ok=True)
+        wrappers.fix_sign_ambiguity(
+            self.src_dir,
+            self.subject,
+            None,
+            None,
+            logging.getLogger(__name__),
+            template=self.subject,
+            n_embeddings=1,
+            standardize=True,
+            n_init=1,
+            n_iter=5,
+            max_flips=2,
+            band="alpha",
+        )
+        parc_ts = np.load(self.src_dir / self.subject / "rhino" / "parc_alpha.npy")
+        flipped = np.load(self.src_dir / self.subject / "sflip_parc_alpha.npy")
+        assert(flipped.shape == parc_ts.shape)
+        assert(np.allclose(np.abs(flipped), np.abs(parc_ts)))
+
+
+class TestSourceGrid(SimulatedSubjectTestCase):
+
+    def test_save_load(self):
+        from ..source_recon.rhino import get_coreg_filenames
+        from ..source_recon.rhino.forward_model import save_source_grid, load_source_grid
+
+        filenames = get_coreg_filenames(self.tmpdir, self.subject)
+        fwd = mne.read_forward_solution(filenames["forward_model_file"], verbose=False)
+        vs = fwd["src"][0]
+
+        grid = save_source_grid(self.tmpdir, self.subject, fwd)
+        assert(grid["gridstep"] == 15)
+        assert(np.array_equal(grid["vertno"], vs["vertno"]))
+        assert(np.allclose(grid["coords_head"], vs["rr"][vs["vertno"]] * 1000))
+        assert(len(grid["coords_head"]) == fwd["nsource"])
+
+        # The head, MRI and MNI spaces of the simulated subject are the same
+        assert(np.allclose(grid["coords_mri"], grid["coords_head"]))
+        assert(np.allclose(grid["coords_mni"], grid["coords_head"]))
+
+        loaded = load_source_grid(self.tmpdir, self.subject)
+        assert(sorted(loaded) == sorted(grid))
+        assert(isinstance(loaded["gridstep"], int))
+        for key in grid:
+            assert(np.array_equal(loaded[key], grid[key]))
+
+    def test_rebuild(self):
+        from ..source_recon.rhino import get_coreg_filenames
+        from ..source_recon.rhino.forward_model import load_source_grid
+
+        filenames = get_coreg_filenames(self.tmpdir, self.subject)
+        grid_file = filenames["source_grid_file"]
+        # The forward model file is single precision, so grids rebuilt from
+        # it differ slightly from the grid saved by forward_model
+        expected = load_source_grid(self.tmpdir, self.subject)
+
+        # Missing grid
+        os.remove(grid_file)
+        grid = load_source_grid(self.tmpdir, self.subject)
+        assert(os.path.exists(grid_file))
+        for key in expected:
+            assert(np.allclose(grid[key], expected[key], rtol=0, atol=1e-4))
+
+        # Grid older than the forward model
+        fwd_mtime = os.path.getmtime(filenames["forward_model_file"])
+        os.utime(grid_file, (fwd_mtime - 10, fwd_mtime - 10))
+        grid = load_source_grid(self.tmpdir, self.subject)
+        assert(os.path.getmtime(grid_file) > fwd_mtime - 10)
+        for key in expected:
+            assert(np.allclose(grid[key], expected[key], rtol=0, atol=1e-4))
+
+        # Up to date grids are read from the file
+        os.utime(grid_file, (fwd_mtime + 10, fwd_mtime + 10))
+        load_source_grid(self.tmpdir, self.subject)
+        assert(os.path.getmtime(grid_file) == fwd_mtime + 10)
+
+
+class TestForwardModelCache(SimulatedSubjectTestCase):
+
+    def get_keys(self, **kwargs):
+        from ..source_recon.rhino.forward_model import _get_forward_model_keys
+
+        args = {"conductivity": (0.3,), "gridstep": 15, "mindist": 4.0,
+                "exclude": 0.0, "eeg": False, "meg": True}
+        args.update(kwargs)
+        return _get_forward_model_keys(self.tmpdir, self.subject, **args)
+
+    def test_keys(self):
+        keys = self.get_keys()
+        assert(self.get_keys() == keys)
+
+        # Each key only depends on the inputs to that step
+        edited = self.get_keys(gridstep=10)
+        assert(edited["src"] != keys["src"] and edited["bem"] == keys["bem"])
+        assert(edited["forward"] != keys["forward"])
+        edited = self.get_keys(conductivity=(0.3, 0.006, 0.3))
+        assert(edited["src"] == keys["src"] and edited["bem"] != keys["bem"])
+        assert(edited["forward"] != keys["forward"])
+        edited = self.get_keys(eeg=True)
+        assert(edited["src"] == keys["src"] and edited["bem"] == keys["bem"])
+        assert(edited["forward"] != keys["forward"])
+
+    def test_cache(self):
+        from ..source_recon import rhino
+        from ..source_recon.rhino import get_coreg_filenames
+        from ..source_recon.rhino.forward_model import load_source_grid
+        from ..utils.cache import read_manifest
+
+        filenames = get_coreg_filenames(self.tmpdir, self.subject)
+        fwd_file = filenames["forward_model_file"]
+        bem_dir = self.src_dir / self.subject / "bem"
+
+        def cached_files():
+            return {f for f in os.listdir(bem_dir) if f.startswith("rhino-")}
+
+        keys = self.get_keys()
+        assert(read_manifest(filenames["forward_model_manifest_file"]) == keys)
+        bem_file = "rhino-{}-bem-sol.fif".format(keys["bem"][:16])
+        assert(cached_files() == {bem_file, "rhino-{}-src.fif".format(keys["src"][:16])})
+
+        # Hit
+        os.utime(fwd_file, (0, 0))
+        rhino.forward_model(self.tmpdir, self.subject, gridstep=15, verbose=False)
+        assert(os.path.getmtime(fwd_file) == 0)
+
+        # Miss, the BEM solution is reused and only the current source space
+        # is kept
+        os.utime(bem_dir / bem_file, (0, 0))
+        rhino.forward_model(self.tmpdir, self.subject, gridstep=20, verbose=False)
+        assert(os.path.getmtime(fwd_file) != 0)
+        assert(os.path.getmtime(bem_dir / bem_file) == 0)
+        edited = self.get_keys(gridstep=20)
+        assert(read_manifest(filenames["forward_model_manifest_file"]) == edited)
+        assert(cached_files() == {bem_file, "rhino-{}-src.fif".format(edited["src"][:16])})
+        assert(load_source_grid(self.tmpdir, self.subject)["gridstep"] == 20)
+
+        # Everything is recomputed without the cache
+        os.utime(fwd_file, (0, 0))
+        rhino.forward_model(self.tmpdir, self.subject, gridstep=20, use_cache=False, verbose=False)
+        assert(os.path.getmtime(fwd_file) != 0)
+        assert(os.path.getmtime(bem_dir / bem_file) != 0)
+
+
+class TestApplyLcmvRaw(SimulatedSubjectTestCase):
+
+    def test_matches_mne(self):
+        from mne.beamformer import apply_lcmv_raw as mne_apply_lcmv_raw
+        from ..source_recon import beamforming
+
+        raw = mne.io.read_raw_fif(self.preproc_file, preload=True, verbose=False)
+        filters = beamforming.make_lcmv(
+            self.tmpdir,
+            self.subject,
+            raw,
+            ["mag"],
+            weight_norm="nai",
+            rank={"mag": 30},
+        )
+        expected = mne_apply_lcmv_raw(raw, filters, verbose=False).data
+
+        # Bad segments are omitted, MNE keeps them
+        _, times = raw.get_data(reject_by_annotation="omit", return_times=True)
+        good = np.isin(raw.times, times)
+        assert(np.sum(~good) == 320 + 170)
+
+        for kwargs in [{}, {"chunk_size": 333}, {"dtype": np.float32}]:
+            stc = beamforming.apply_lcmv_raw(raw, filters, reject_by_annotations=None, **kwargs)
+            atol = 1e-5 if "dtype" in kwargs else 1e-10
+            assert(stc.data.shape == expected.shape)
+            assert(np.allclose(stc.data, expected, rtol=0, atol=atol * np.abs(expected).max()))
+
+            stc = beamforming.apply_lcmv_raw(raw, filters, **kwargs)
+            assert(stc.data.shape == (expected.shape[0], np.sum(good)))
+            assert(np.allclose(stc.data, expected[:, good], rtol=0, atol=atol * np.abs(expected).max()))
+            assert(np.isclose(stc.tmin, raw.times[0]))
+
+        # Without bad segments all the data is kept
+        raw.set_annotations(None)
+        for kwargs in [{}, {"chunk_size": 333}]:
+            stc = beamforming.apply_lcmv_raw(raw, filters, **kwargs)
+            assert(np.allclose(stc.data, expected, rtol=0, atol=1e-10 * np.abs(expected).max()))
+
+
+class TestGetFreqBands(unittest.TestCase):
+
+    def test_get_freq_bands(self):
+        from ..source_recon.wrappers import _get_freq_bands
+
+        assert(_get_freq_bands(None) == [(None, None)])
+        assert(_get_freq_bands([1, 45]) == [(None, [1, 45])])
+        assert(_get_freq_bands([[1, 4], (4, 8)]) == [("1-4Hz", [1, 4]), ("4-8Hz", (4, 8))])
+        assert(_get_freq_bands({"delta": [1, 4]}) == [("delta", [1, 4])])
+
+
+if __name__ == "__main__":
+    unittest.main()
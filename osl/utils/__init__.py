@@ -5,6 +5,6 @@ from . import logger  ## noqa: F401, F403
 from .study import Study  # noqa: F401, F403
 from .file_handling import *  # noqa: F401, F403
 from .spmio import SPMMEEG  # noqa: F401, F403
-from .parallel import dask_parallel_bag  # noqa: F401, F403
+from .parallel import dask_parallel_bag, process_parallel  # noqa: F401, F403
 from .simulate import *  # noqa: F401, F403
 from .package import soft_import
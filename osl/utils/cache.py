@@ -0,0 +1,161 @@
+"""Utility functions for caching intermediate results on disk.
+
+"""
+
+import os
+import json
+import hashlib
+
+# Housekeeping for logging
+import logging
+osl_logger = logging.getLogger(__name__)
+
+
+def hash_file(fname, content=False, chunk_size=2**20):
+    """Hash a file or directory (e.g. a CTF .ds directory).
+
+    Parameters
+    ----------
+    fname : str
+        Path to file or directory.
+    content : bool
+        Should we hash the contents of the file? If False, the path, size and
+        modification time are hashed, which is much quicker for large files.
+    chunk_size : int
+        Number of bytes to read at a time when hashing the contents.
+
+    Returns
+    -------
+    str
+        Hex digest.
+    """
+    fname = os.path.abspath(str(fname))
+    if os.path.isdir(fname):
+        files = sorted(
+            os.path.join(root, f) for root, _, fs in os.walk(fname) for f in fs
+        )
+    else:
+        files = [fname]
+
+    h = hashlib.sha256()
+    for f in files:
+        h.update(f.encode())
+        if content:
+            with open(f, "rb") as fp:
+                for chunk in iter(lambda: fp.read(chunk_size), b""):
+                    h.update(chunk)
+        else:
+            stat = os.stat(f)
+            h.update("{0} {1}".format(stat.st_size, stat.st_mtime_ns).encode())
+
+    return h.hexdigest()
+
+
+def hash_object(obj):
+    """Hash a JSON-like object such as a config dict.
+
+    Dictionary keys are sorted before hashing so the hash does not depend on
+    key order. Objects which can't be serialised are converted to str.
+
+    Parameters
+    ----------
+    obj : dict or list or str or float or int
+        Object to hash.
+
+    Returns
+    -------
+    str
+        Hex digest.
+    """
+    s = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+def get_package_versions(packages=("osl", "mne")):
+    """Get the installed versions of packages.
+
+    Parameters
+    ----------
+    packages : list of str
+        Package names.
+
+    Returns
+    -------
+    dict
+        Version for each package. 'unknown' if the version can't be found.
+    """
+    try:
+        from importlib.metadata import version
+    except ImportError:  # python < 3.8
+        from pkg_resources import get_distribution
+
+        def version(name):
+            return get_distribution(name).version
+
+    versions = {}
+    for package in packages:
+        try:
+            versions[package] = version(package)
+        except Exception:
+            versions[package] = "unknown"
+    return versions
+
+
+def read_manifest(fname):
+    """Read a cache manifest.
+
+    Parameters
+    ----------
+    fname : str
+        Path to manifest file.
+
+    Returns
+    -------
+    dict or None
+        Manifest. None if the file doesn't exist or can't be read.
+    """
+    try:
+        with open(fname, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_manifest(fname, manifest):
+    """Write a cache manifest.
+
+    Parameters
+    ----------
+    fname : str
+        Path to manifest file.
+    manifest : dict
+        Manifest to write.
+    """
+    tmpname = str(fname) + ".tmp"
+    with open(tmpname, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True, default=str)
+    os.replace(tmpname, fname)
+
+
+def get_cache_dir(subdir=None):
+    """Get the directory used to cache files shared between runs.
+
+    This is $OSL_CACHE_DIR if set, otherwise ~/.cache/osl.
+
+    Parameters
+    ----------
+    subdir : str
+        Subdirectory of the cache directory.
+
+    Returns
+    -------
+    str
+        Path to cache directory. It is created if it doesn't exist.
+    """
+    cache_dir = os.environ.get(
+        "OSL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "osl")
+    )
+    if subdir is not None:
+        cache_dir = os.path.join(cache_dir, subdir)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
@@ -4,18 +4,48 @@
 
 # Authors: Andrew Quinn <a.quinn@bham.ac.uk>
 
+import os
+import time
 from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import dask.bag as db
-from dask.distributed import Client, LocalCluster, wait, default_client
+from dask.distributed import Client, LocalCluster, default_client, as_completed
 
 # Housekeeping for logging
 import logging
 osl_logger = logging.getLogger(__name__)
 
+# Environment variables used by BLAS/OpenMP libraries to set their thread count
+_THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def get_n_jobs(n_jobs):
+    """Get the number of parallel jobs to use.
+
+    Parameters
+    ----------
+    n_jobs : int
+        Requested number of jobs. None or less than 1 uses all available CPUs.
+
+    Returns
+    -------
+    int
+        Number of jobs.
+    """
+    if n_jobs is None or n_jobs < 1:
+        return os.cpu_count() or 1
+    return n_jobs
+
 
 def dask_parallel_bag(func, iter_args,
-                      func_args=None, func_kwargs=None):
-    """A maybe more consistent alternative to dask_parallel."""
+                      func_args=None, func_kwargs=None, callback=None):
+    """A maybe more consistent alternative to dask_parallel.
+
+    If callback is passed, it is called with the index and output of each
+    input as soon as it completes, e.g. to queue more work, and the inputs
+    are submitted to the client individually instead of as a dask bag.
+    """
 
     func_args = [] if func_args is None else func_args
     func_kwargs = {} if func_kwargs is None else func_kwargs
@@ -43,6 +73,17 @@ def dask_parallel_bag(func, iter_args,
     if func_args is not None:
         iter_args = [list(aa) + func_args for aa in iter_args]
 
+    if callback is not None:
+        # Collect outputs as they complete
+        futures = {client.submit(run_func, *aa, pure=False): ind
+                   for ind, aa in enumerate(iter_args)}
+        flags = [None] * len(futures)
+        for future, result in as_completed(futures, with_results=True):
+            flags[futures[future]] = result
+            callback(futures[future], result)
+        osl_logger.info('Computation complete')
+        return flags
+
     # Make dask bag from inputs: https://docs.dask.org/en/stable/bag.html
     b = db.from_sequence(iter_args)
 
@@ -55,3 +96,140 @@ def dask_parallel_bag(func, iter_args,
     osl_logger.info('Computation complete')
 
     return flags
+
+
+def process_parallel(func, iter_args, n_jobs=-1, timeout=None, blas_threads=None,
+                     func_args=None, func_kwargs=None, callback=None):
+    """Run a function over a set of inputs using a local pool of processes.
+
+    An alternative to dask_parallel_bag which doesn't need a dask cluster. Each
+    worker process has its BLAS/OpenMP thread pools limited so that n_jobs
+    workers don't oversubscribe the machine. Results are logged as they
+    complete and returned in the order of iter_args.
+
+    Parameters
+    ----------
+    func : function
+        Function to run. Must be picklable (i.e. defined at module level).
+    iter_args : list
+        Arguments to map over. Each item is either a single argument or a
+        list/tuple of positional arguments.
+    n_jobs : int
+        Number of worker processes. -1 uses all available CPUs.
+    timeout : float
+        Maximum time in seconds to wait for a single input. Inputs which run
+        for longer are marked as failed. If None, there is no limit.
+    blas_threads : int
+        Number of BLAS/OpenMP threads each worker may use. If None, the CPUs
+        are divided evenly between the workers.
+    func_args : list
+        Fixed positional arguments appended to each item in iter_args.
+    func_kwargs : dict
+        Fixed keyword arguments passed to each function call.
+    callback : function
+        Function called in the parent process with the index and output of
+        each input as soon as it completes successfully.
+
+    Returns
+    -------
+    list
+        Output of func for each item in iter_args. False is returned for
+        inputs which raised an exception or timed out.
+    """
+
+    func_args = [] if func_args is None else func_args
+    func_kwargs = {} if func_kwargs is None else func_kwargs
+
+    n_cpus = os.cpu_count() or 1
+    n_jobs = get_n_jobs(n_jobs)
+    if blas_threads is None:
+        blas_threads = max(1, n_cpus // n_jobs)
+
+    # Ensure input iter_args is list of lists
+    if all(isinstance(aa, (list, tuple)) for aa in iter_args) is False:
+        iter_args = [[aa] for aa in iter_args]
+    iter_args = [list(aa) + list(func_args) for aa in iter_args]
+
+    osl_logger.info('Process pool : {0} workers, {1} BLAS threads each'.format(n_jobs, blas_threads))
+    osl_logger.debug('Running function : {0}'.format(func.__repr__()))
+
+    n_inputs = len(iter_args)
+    results = [False] * n_inputs
+    n_done = 0
+    n_hung = 0
+
+    executor = ProcessPoolExecutor(max_workers=n_jobs,
+                                   initializer=_limit_worker_threads,
+                                   initargs=(blas_threads,))
+
+    # We only submit as many inputs as there are free workers so each input
+    # starts running when it is submitted - this lets us time each input
+    pending = {}
+    next_ind = 0
+    try:
+        while next_ind < n_inputs or len(pending) > 0:
+            while next_ind < n_inputs and len(pending) < n_jobs - n_hung:
+                future = executor.submit(func, *iter_args[next_ind], **func_kwargs)
+                pending[future] = (next_ind, time.monotonic())
+                next_ind += 1
+
+            if len(pending) == 0:
+                # Every worker is stuck on an input which timed out
+                osl_logger.error('All workers have timed out, {0} inputs not run'.format(n_inputs - next_ind))
+                break
+
+            wait_time = None
+            if timeout is not None:
+                oldest = min(start for _, start in pending.values())
+                wait_time = max(0, oldest + timeout - time.monotonic())
+
+            done, _ = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                ind, start = pending.pop(future)
+                n_done += 1
+                try:
+                    results[ind] = future.result()
+                    osl_logger.info('Completed input {0} ({1}/{2}) in {3:.1f}s'.format(
+                        ind, n_done, n_inputs, time.monotonic() - start))
+                except Exception as e:
+                    osl_logger.error('Input {0} failed: {1!r}'.format(ind, e))
+                    continue
+                if callback is not None:
+                    callback(ind, results[ind])
+
+            if timeout is not None:
+                now = time.monotonic()
+                for future, (ind, start) in list(pending.items()):
+                    if now - start > timeout:
+                        # The worker can't be stopped without breaking the
+                        # pool, we stop waiting and don't reuse its slot
+                        del pending[future]
+                        future.cancel()
+                        n_done += 1
+                        n_hung += 1
+                        osl_logger.error('Input {0} timed out after {1}s'.format(ind, timeout))
+    finally:
+        if n_hung > 0:
+            # Kill workers still running inputs that timed out
+            for process in list(executor._processes.values()):
+                process.terminate()
+        executor.shutdown(wait=n_hung == 0)
+
+    osl_logger.info('Computation complete')
+
+    return results
+
+
+def _limit_worker_threads(n_threads):
+    """Limit the threads used by numerical libraries in a worker process."""
+    for var in _THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+
+    # Environment variables only take effect before BLAS is loaded, so also
+    # limit any thread pools which are already running
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=n_threads)
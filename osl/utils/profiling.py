@@ -0,0 +1,191 @@
+"""Utility functions for profiling processing chains.
+
+"""
+
+import os
+import csv
+import json
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Housekeeping for logging
+import logging
+osl_logger = logging.getLogger(__name__)
+
+# Fields recorded for each stage
+PROFILE_FIELDS = [
+    "index",
+    "stage",
+    "wall_time",
+    "cpu_time",
+    "peak_rss_delta_mb",
+    "read_mb",
+    "write_mb",
+]
+
+
+def _get_usage():
+    """Get the peak RSS and bytes read/written by this process so far."""
+    peak_rss = read_bytes = write_bytes = np.nan
+
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # ru_maxrss is in bytes on macOS and kilobytes on Linux
+        scale = 1 if os.uname().sysname == "Darwin" else 1024
+        peak_rss = usage.ru_maxrss * scale
+        # Block counts are in units of 512 bytes
+        read_bytes = usage.ru_inblock * 512
+        write_bytes = usage.ru_oublock * 512
+
+    try:
+        import psutil
+        io = psutil.Process().io_counters()
+        read_bytes, write_bytes = io.read_bytes, io.write_bytes
+    except (ImportError, AttributeError, OSError):
+        pass
+
+    return peak_rss, read_bytes, write_bytes
+
+
+class Profiler:
+    """Record the resources used by each stage of a processing chain.
+
+    For each stage we record the wall time and CPU time in seconds, the
+    increase in the peak resident set size (RSS) of the process and the amount
+    of data read/written in MB.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, index=None):
+        """Context manager to profile a stage.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        index : int
+            Index of the stage in the chain.
+        """
+        rss0, read0, write0 = _get_usage()
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall1, cpu1 = time.perf_counter(), time.process_time()
+            rss1, read1, write1 = _get_usage()
+            self.stages.append(
+                {
+                    "index": index,
+                    "stage": name,
+                    "wall_time": wall1 - wall0,
+                    "cpu_time": cpu1 - cpu0,
+                    "peak_rss_delta_mb": (rss1 - rss0) / 1e6,
+                    "read_mb": (read1 - read0) / 1e6,
+                    "write_mb": (write1 - write0) / 1e6,
+                }
+            )
+
+    def save(self, fbase):
+        """Save the profile as JSON and CSV files.
+
+        Parameters
+        ----------
+        fbase : str
+            Path to save to without a file extension.
+        """
+        with open(fbase + ".json", "w") as f:
+            json.dump(self.stages, f, indent=2)
+        write_profile_csv(fbase + ".csv", self.stages, PROFILE_FIELDS)
+
+
+def write_profile_csv(fname, rows, fields):
+    """Write a list of dicts to a CSV file.
+
+    Parameters
+    ----------
+    fname : str
+        Path to CSV file.
+    rows : list of dict
+        Rows to write.
+    fields : list of str
+        Column names.
+    """
+    with open(fname, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: row.get(key) for key in fields})
+
+
+def aggregate_profiles(profiles):
+    """Aggregate stage profiles across runs.
+
+    Parameters
+    ----------
+    profiles : list of list of dict
+        Profile for each run, i.e. Profiler.stages.
+
+    Returns
+    -------
+    list of dict
+        Summary for each stage containing the number of runs and the total,
+        median (p50), 95th percentile (p95) and maximum wall time, as well as
+        the median CPU time and peak RSS increase. Sorted by total wall time,
+        i.e. the most expensive stage first.
+    """
+    stages = {}
+    for profile in profiles:
+        for stage in profile:
+            key = (stage["index"], stage["stage"])
+            stages.setdefault(key, []).append(stage)
+
+    summary = []
+    for (index, name), records in stages.items():
+        wall_time = np.array([r["wall_time"] for r in records])
+        cpu_time = np.array([r["cpu_time"] for r in records])
+        rss = np.array([r["peak_rss_delta_mb"] for r in records], dtype=float)
+        summary.append(
+            {
+                "index": index,
+                "stage": name,
+                "n_runs": len(records),
+                "wall_time_total": np.sum(wall_time),
+                "wall_time_p50": np.percentile(wall_time, 50),
+                "wall_time_p95": np.percentile(wall_time, 95),
+                "wall_time_max": np.max(wall_time),
+                "cpu_time_p50": np.percentile(cpu_time, 50),
+                "peak_rss_delta_mb_p50": np.nanpercentile(rss, 50)
+                if np.any(~np.isnan(rss)) else np.nan,
+            }
+        )
+
+    return sorted(summary, key=lambda s: s["wall_time_total"], reverse=True)
+
+
+def read_profile(fname):
+    """Read a profile saved with Profiler.save.
+
+    Parameters
+    ----------
+    fname : str
+        Path to JSON file.
+
+    Returns
+    -------
+    list of dict
+        Profile. None if the file doesn't exist.
+    """
+    if not os.path.exists(fname):
+        return None
+    with open(fname, "r") as f:
+        return json.load(f)
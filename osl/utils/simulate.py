@@ -32,13 +32,14 @@ def simulate_data(model, num_samples=1000, num_realisations=1, use_cov=True):
     return Y
 
 
-def simulate_raw_from_template(sim_samples, bad_segments=None, bad_channels=None, flat_channels=None):
+def simulate_raw_from_template(sim_samples, bad_segments=None, bad_channels=None, flat_channels=None,
+                               sfreq=150):
 
     basedir = os.path.dirname(os.path.realpath(__file__))
     basedir = os.path.join(basedir, 'simulation_config')
     info = mne.io.read_info(os.path.join(basedir, 'megin_template_info.fif'))
     with info._unlock():
-        info['sfreq'] = 150
+        info['sfreq'] = sfreq
 
     Y = np.zeros((306, sim_samples))
     for mod in ['mag', 'grad']:
@@ -17,7 +17,7 @@ setup(name=name,
       license='MIT',
       packages=['osl', 'osl.report', 'osl.maxfilter',
                 'osl.preprocessing', 'osl.utils', 'osl.utils.spmio',
-                'osl.source_recon'],
+                'osl.source_recon', 'osl.benchmarks'],
       zip_safe=False,
       entry_points={
           'console_scripts': [